@@ -43,6 +43,18 @@ def preprocess_opts(parser):
     parser.add_argument('-save_data_dir', required=True, help='The saving path for the data')
     parser.add_argument('-remove_title_eos', action="store_true", help='Remove the eos after the title')
     parser.add_argument('-one2many', action="store_true", help='Save one2many file.')
+    parser.add_argument('-data_format', default='mmap', choices=['mmap', 'pt'],
+                        help='mmap: columnar memory-mapped directories, e.g. train.one2many.mmap/; '
+                             'pt: the whole split pickled by torch.save, e.g. train.one2many.pt')
+    parser.add_argument('-streaming', action="store_true",
+                        help='Never load the whole corpus: one pass over the files to count the vocabulary, '
+                             'a second pass to write the examples shard by shard. Requires -data_format mmap')
+    parser.add_argument('-shard_size', type=int, default=100000,
+                        help='Number of examples per shard in -streaming mode, the shards are merged into a single '
+                             'split at the end')
+    parser.add_argument('-num_workers', type=int, default=1,
+                        help='Number of processes, > 1 splits the files into line aligned byte ranges that are '
+                             'tokenized and indexed in parallel, implies -streaming')
     parser.add_argument('-log_path', type=str, default="logs")
     return parser
 
@@ -65,6 +77,10 @@ def model_opts(parser):
                         help="Multi-head numbers")
     parser.add_argument('-dim_ff', type=int, default=2048,
                         help="Feed-forward dimension")
+    parser.add_argument('-attn_impl', type=str, default='einsum', choices=['einsum', 'sdpa'],
+                        help='`einsum` computes the attention weights of all the heads, '
+                             '`sdpa` uses torch scaled_dot_product_attention and only keeps the weights of the first '
+                             'head (read by the copy mechanism). Requires torch >= 2.1.')
 
     parser.add_argument('-copy_attention', action="store_true",
                         help='Train the model with copy mechanism.')
@@ -95,6 +111,22 @@ def model_opts(parser):
                         help='whether to forcibly set cost of `null trg` as zero.')
     parser.add_argument('-interrupt_cost', action="store_true", default=False,
                         help='whether to add small gaussian noise to cost matrix.')
+    parser.add_argument('-ot_backend', type=str, default='torch', choices=['torch', 'numpy'],
+                        help='`torch` solves the optimal transport of the whole batch at once on the model device, '
+                             '`numpy` solves each instance separately in a thread pool.')
+    parser.add_argument('-sinkhorn_tol', type=float, default=1e-6,
+                        help='stop the sinkhorn iterations early once the marginals are within this tolerance, '
+                             '0 to always run all the iterations. Only used by the `torch` ot_backend.')
+    parser.add_argument('-hungarian_backend', type=str, default='serial', choices=['serial', 'process'],
+                        help='`serial` solves the hungarian assignment of each instance in the main process, '
+                             '`process` solves them in a pool of worker processes while the main process runs the '
+                             'training encoder forward. It gains little with -share_assign_memory, which moves that '
+                             'encoder forward before the assignment. The solve takes only a few ms per step: in the '
+                             'benchmark `python -m pykp.utils.assign_solver` (CPU, batch size 12 to 128) `process` is '
+                             'slower than `serial` even with the overlap, keep `serial` unless the benchmark shows a '
+                             'gain on the training machine.')
+    parser.add_argument('-hungarian_workers', type=int, default=4,
+                        help='number of worker processes of the `process` hungarian_backend')
 
 
 def train_opts(parser):
@@ -133,6 +165,13 @@ def train_opts(parser):
                         help='Maximum batch size')
     parser.add_argument('-batch_workers', type=int, default=0,
                         help='Number of workers for generating batches')
+    parser.add_argument('-bucket_batches', action="store_true", default=False,
+                        help='Group the training examples of similar source length into the same batches')
+    parser.add_argument('-bucket_size', type=int, default=100,
+                        help='Number of batches sorted by source length together, used with -bucket_batches')
+    parser.add_argument('-max_tokens', type=int, default=0,
+                        help='If > 0, used with -bucket_batches, limit the padded source tokens of a batch '
+                             'instead of the number of examples (-batch_size)')
 
     # Optimization options
     parser.add_argument('-epochs', type=int, default=20,
@@ -175,6 +214,16 @@ def train_opts(parser):
                         help='Whether to use set loss')
     parser.add_argument('-assign_steps', type=int, default=2,
                         help='Assignment steps K')
+    parser.add_argument('-share_assign_memory', action="store_true", default=False,
+                        help='With set_loss, encode a batch only once: the target assignment reuses the encoder output '
+                             'and encoder attention keys/values of the training forward (detached, computed in train '
+                             'mode with dropout) instead of encoding the batch again in eval mode. The encoder then no '
+                             'longer overlaps with the hungarian solve, so it does not combine usefully with '
+                             '-hungarian_backend process.')
+    parser.add_argument('-sparse_copy_loss', action="store_true", default=False,
+                        help='Compute the loss from the probabilities of the target tokens only, without building the '
+                             'distribution over the whole vocabulary and the oov words of the batch. '
+                             'Not supported with adaptive_lr_scale.')
     
     # Stats options
     parser.add_argument('-stats_only', action="store_true", default=False,
@@ -286,3 +335,15 @@ def post_predict_opts(parser):
                         help='If it is true, when computing precision, it will divided by the number pf predictions, instead of divided by k.')
     parser.add_argument('-use_name_variations', action="store_true", default=False,
                         help='Match the ground-truth with name variations.')
+    parser.add_argument('-stem_cache_path', type=str, default="",
+                        help='Pickle file of the stems of the tokens, loaded if it exists and saved after the evaluation, '
+                             'so that evaluating new predictions on the same test set does not stem it again.')
+    parser.add_argument('-stem_cache_size', type=int, default=1000000,
+                        help='Max number of stems kept in the stem cache.')
+    parser.add_argument('-num_workers', type=int, default=1,
+                        help='Number of processes computing the scores of the documents, 1 to evaluate in the main process.')
+    parser.add_argument('-chunk_size', type=int, default=500,
+                        help='Number of documents sent to a worker at a time.')
+    parser.add_argument('-gold_cache_path', type=str, default="",
+                        help='Pickle file of the stemmed sources and the unique, present and absent stemmed targets, '
+                             'used if it was built from the same source and target files and options, built otherwise.')
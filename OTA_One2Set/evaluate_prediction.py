@@ -6,6 +6,9 @@ from collections import defaultdict
 import os
 import pykp.utils.io as io
 import pickle
+import itertools
+import multiprocessing
+import hashlib
 
 
 def check_valid_keyphrases(str_list):
@@ -90,51 +93,22 @@ def check_duplicate_shorter_keyphrases(keyphrase_str_list):
 
 def check_present_keyphrases(src_str, keyphrase_str_list, match_by_str=False):
     """
-    :param src_str: stemmed word list of source text
+    :param src_str: stemmed word list of source text, or its SourceNgramIndex
     :param keyphrase_str_list: stemmed list of word list
     :return:
     """
-    num_keyphrases = len(keyphrase_str_list)
-    is_present = np.zeros(num_keyphrases, dtype=bool)
-
-    for i, keyphrase_word_list in enumerate(keyphrase_str_list):
-        joined_keyphrase_str = ' '.join(keyphrase_word_list)
-
-        if joined_keyphrase_str.strip() == "":  # if the keyphrase is an empty string
-            is_present[i] = False
-        else:
-            if not match_by_str:  # match by word
-                # check if it appears in source text
-                match = False
-                for src_start_idx in range(len(src_str) - len(keyphrase_word_list) + 1):
-                    match = True
-                    for keyphrase_i, keyphrase_w in enumerate(keyphrase_word_list):
-                        src_w = src_str[src_start_idx + keyphrase_i]
-                        if src_w != keyphrase_w:
-                            match = False
-                            break
-                    if match:
-                        break
-                if match:
-                    is_present[i] = True
-                else:
-                    is_present[i] = False
-            else:  # match by str
-                if joined_keyphrase_str in ' '.join(src_str):
-                    is_present[i] = True
-                else:
-                    is_present[i] = False
-    return is_present
+    src_index = build_source_index(src_str)
+    return np.array([src_index.contains(keyphrase_word_list, match_by_str)
+                     for keyphrase_word_list in keyphrase_str_list], dtype=bool)
 
 
 def find_present_and_absent_index(src_str, keyphrase_str_list, use_name_variations=False):
     """
-    :param src_str: stemmed word list of source text
+    :param src_str: stemmed word list of source text, or its SourceNgramIndex
     :param keyphrase_str_list: stemmed list of word list
     :return:
     """
-    num_keyphrases = len(keyphrase_str_list)
-    # is_present = np.zeros(num_keyphrases, dtype=bool)
+    src_index = build_source_index(src_str)
     present_indices = []
     absent_indices = []
 
@@ -143,34 +117,16 @@ def find_present_and_absent_index(src_str, keyphrase_str_list, use_name_variatio
             keyphrase_word_list = v[0]
         else:
             keyphrase_word_list = v
-        joined_keyphrase_str = ' '.join(keyphrase_word_list)
-        if joined_keyphrase_str.strip() == "":  # if the keyphrase is an empty string
-            # is_present[i] = False
-            absent_indices.append(i)
+        if src_index.contains(keyphrase_word_list):
+            present_indices.append(i)
         else:
-            # check if it appears in source text
-            match = False
-            for src_start_idx in range(len(src_str) - len(keyphrase_word_list) + 1):
-                match = True
-                for keyphrase_i, keyphrase_w in enumerate(keyphrase_word_list):
-                    src_w = src_str[src_start_idx + keyphrase_i]
-                    if src_w != keyphrase_w:
-                        match = False
-                        break
-                if match:
-                    break
-            if match:
-                # is_present[i] = True
-                present_indices.append(i)
-            else:
-                # is_present[i] = False
-                absent_indices.append(i)
+            absent_indices.append(i)
     return present_indices, absent_indices
 
 
 def separate_present_absent_by_source_with_variations(src_token_list, keyphrase_variation_token_3dlist,
                                                       use_name_variations=True):
-    num_keyphrases = len(keyphrase_variation_token_3dlist)
+    src_index = build_source_index(src_token_list)
     present_indices = []
     absent_indices = []
 
@@ -183,28 +139,10 @@ def separate_present_absent_by_source_with_variations(src_token_list, keyphrase_
         absent_flag = False
         # iterate every variation of a keyphrase
         for variation_idx, keyphrase_token_list in enumerate(keyphrase_variation_token_2dlist):
-            joined_keyphrase_str = ' '.join(keyphrase_token_list)
-            if joined_keyphrase_str.strip() == "":  # if the keyphrase is an empty string
+            if src_index.contains(keyphrase_token_list):
+                present_flag = True
+            else:  # an empty keyphrase is absent
                 absent_flag = True
-            else:  # check if it appears in source text
-                match = False
-                for src_start_idx in range(len(src_token_list) - len(keyphrase_token_list) + 1):
-                    match = True
-                    for keyphrase_i, keyphrase_w in enumerate(keyphrase_token_list):
-                        src_w = src_token_list[src_start_idx + keyphrase_i]
-                        if src_w != keyphrase_w:
-                            match = False
-                            break
-                    if match:
-                        break
-                if match:
-                    # is_present[i] = True
-                    # present_indices.append(i)
-                    present_flag = True
-                else:
-                    # is_present[i] = False
-                    # absent_indices.append(i)
-                    absent_flag = True
         if present_flag and absent_flag:
             present_indices.append(keyphrase_idx)
             absent_indices.append(keyphrase_idx)
@@ -225,12 +163,12 @@ def separate_present_absent_by_source_with_variations(src_token_list, keyphrase_
 
 def check_present_and_duplicate_keyphrases(src_str, keyphrase_str_list, match_by_str=False):
     """
-    :param src_str: stemmed word list of source text
+    :param src_str: stemmed word list of source text, or its SourceNgramIndex
     :param keyphrase_str_list: stemmed list of word list
     :return:
     """
     num_keyphrases = len(keyphrase_str_list)
-    is_present = np.zeros(num_keyphrases, dtype=bool)
+    is_present = check_present_keyphrases(src_str, keyphrase_str_list, match_by_str)
     not_duplicate = np.ones(num_keyphrases, dtype=bool)
     keyphrase_set = set()
 
@@ -240,31 +178,6 @@ def check_present_and_duplicate_keyphrases(src_str, keyphrase_str_list, match_by
             not_duplicate[i] = False
         else:
             not_duplicate[i] = True
-
-        if joined_keyphrase_str.strip() == "":  # if the keyphrase is an empty string
-            is_present[i] = False
-        else:
-            if not match_by_str:  # match by word
-                # check if it appears in source text
-                match = False
-                for src_start_idx in range(len(src_str) - len(keyphrase_word_list) + 1):
-                    match = True
-                    for keyphrase_i, keyphrase_w in enumerate(keyphrase_word_list):
-                        src_w = src_str[src_start_idx + keyphrase_i]
-                        if src_w != keyphrase_w:
-                            match = False
-                            break
-                    if match:
-                        break
-                if match:
-                    is_present[i] = True
-                else:
-                    is_present[i] = False
-            else:  # match by str
-                if joined_keyphrase_str in ' '.join(src_str):
-                    is_present[i] = True
-                else:
-                    is_present[i] = False
         keyphrase_set.add(joined_keyphrase_str)
 
     return is_present, not_duplicate
@@ -301,37 +214,47 @@ def compute_match_result_backup(trg_str_list, pred_str_list, type='exact'):
 
 
 def compute_match_result(trg_str_list, pred_str_list, type='exact', dimension=1):
+    """
+    :param trg_str_list: stemmed list of word list
+    :param pred_str_list: stemmed list of word list
+    :param type: 'exact' if the joined prediction equals the joined target, 'sub' if it is a substring of it
+    :param dimension: 1 for a boolean np array [num_predictions], 1 = matches at least one target,
+                      2 for a boolean np array [num_targets, num_predictions]
+    """
     assert type in ['exact', 'sub'], "Right now only support exact matching and substring matching"
     assert dimension in [1, 2], "only support 1 or 2"
-    num_pred_str = len(pred_str_list)
-    num_trg_str = len(trg_str_list)
+    # intern the joined keyphrases to integer ids, every distinct keyphrase is joined and compared once
+    trg_ids, unique_trgs = _intern_keyphrases(trg_str_list)
+    pred_ids, unique_preds = _intern_keyphrases(pred_str_list)
+    if type == 'exact':
+        if dimension == 1:
+            trg_set = set(unique_trgs)
+            return np.array([pred in trg_set for pred in unique_preds], dtype=bool)[pred_ids]
+        # ids of the targets in the id space of the predictions, -1 if no prediction is the same
+        trg_as_pred_ids = np.array([unique_preds.get(trg, -1) for trg in unique_trgs], dtype=np.int64)
+        return trg_as_pred_ids[trg_ids][:, None] == pred_ids[None, :]
+
+    # a single substring search per prediction over all the targets, a line of words can not contain '\n'
+    joined_trgs = '\n'.join(unique_trgs)
+    is_sub = [len(unique_trgs) > 0 and pred in joined_trgs for pred in unique_preds]
     if dimension == 1:
-        is_match = np.zeros(num_pred_str, dtype=bool)
-        for pred_idx, pred_word_list in enumerate(pred_str_list):
-            joined_pred_word_list = ' '.join(pred_word_list)
-            for trg_idx, trg_word_list in enumerate(trg_str_list):
-                joined_trg_word_list = ' '.join(trg_word_list)
-                if type == 'exact':
-                    if joined_pred_word_list == joined_trg_word_list:
-                        is_match[pred_idx] = True
-                        break
-                elif type == 'sub':
-                    if joined_pred_word_list in joined_trg_word_list:
-                        is_match[pred_idx] = True
-                        break
-    else:
-        is_match = np.zeros((num_trg_str, num_pred_str), dtype=bool)
-        for trg_idx, trg_word_list in enumerate(trg_str_list):
-            joined_trg_word_list = ' '.join(trg_word_list)
-            for pred_idx, pred_word_list in enumerate(pred_str_list):
-                joined_pred_word_list = ' '.join(pred_word_list)
-                if type == 'exact':
-                    if joined_pred_word_list == joined_trg_word_list:
-                        is_match[trg_idx][pred_idx] = True
-                elif type == 'sub':
-                    if joined_pred_word_list in joined_trg_word_list:
-                        is_match[trg_idx][pred_idx] = True
-    return is_match
+        return np.array(is_sub, dtype=bool)[pred_ids]
+    # only the predictions found in some target are searched in every target
+    is_match = np.zeros((len(unique_trgs), len(unique_preds)), dtype=bool)
+    for pred_idx, pred in enumerate(unique_preds):
+        if is_sub[pred_idx]:
+            is_match[:, pred_idx] = [pred in trg for trg in unique_trgs]
+    return is_match[trg_ids][:, pred_ids]
+
+
+def _intern_keyphrases(keyphrase_str_list):
+    """
+    :param keyphrase_str_list: list of word list
+    :return: an int np array of the id of every keyphrase, the dict of the distinct joined keyphrases to their id
+    """
+    keyphrase_ids = {}
+    ids = [keyphrase_ids.setdefault(' '.join(word_list), len(keyphrase_ids)) for word_list in keyphrase_str_list]
+    return np.array(ids, dtype=np.int64), keyphrase_ids
 
 
 def prepare_classification_result_dict(precision_k, recall_k, f1_k, num_matches_k, num_predictions_k, num_targets_k,
@@ -498,49 +421,6 @@ def dcg_at_k(r, k, num_trgs, method=1):
     return dcg
 
 
-def dcg_at_ks(r, k_list, num_trgs, method=1):
-    num_predictions = r.shape[0]
-    if num_predictions == 0:
-        dcg_array = np.array([0] * len(k_list))
-    else:
-        k_max = -1
-        for k in k_list:
-            if k == 'M':
-                k = num_predictions
-            elif k == 'G':
-                # k = num_trgs
-                if num_predictions < num_trgs:
-                    k = num_trgs
-                else:
-                    k = num_predictions
-
-            if k > k_max:
-                k_max = k
-        if num_predictions > k_max:
-            r = r[:k_max]
-            num_predictions = k_max
-        if method == 1:
-            discounted_gain = r / np.log2(np.arange(2, r.size + 2))
-            dcg = np.cumsum(discounted_gain)
-            return_indices = []
-            for k in k_list:
-                if k == 'M':
-                    k = num_predictions
-                elif k == 'G':
-                    # k = num_trgs
-                    if num_predictions < num_trgs:
-                        k = num_trgs
-                    else:
-                        k = num_predictions
-
-                return_indices.append((k - 1) if k <= num_predictions else (num_predictions - 1))
-            return_indices = np.array(return_indices, dtype=int)
-            dcg_array = dcg[return_indices]
-        else:
-            raise ValueError('method must 1.')
-    return dcg_array
-
-
 def ndcg_at_k(r, k, num_trgs, method=1, include_dcg=False):
     """Score is normalized discounted cumulative gain (ndcg)
     Relevance is positive real values.  Can use binary
@@ -572,22 +452,6 @@ def ndcg_at_k(r, k, num_trgs, method=1, include_dcg=False):
         return ndcg
 
 
-def ndcg_at_ks(r, k_list, num_trgs, method=1, include_dcg=False):
-    if r.shape[0] == 0:
-        ndcg_array = [0.0] * len(k_list)
-        dcg_array = [0.0] * len(k_list)
-    else:
-        dcg_array = dcg_at_ks(r, k_list, num_trgs, method)
-        ideal_r = np.array(sorted(r, reverse=True))
-        dcg_max_array = dcg_at_ks(ideal_r, k_list, num_trgs, method)
-        ndcg_array = dcg_array / dcg_max_array
-        ndcg_array = np.nan_to_num(ndcg_array)
-    if include_dcg:
-        return ndcg_array, dcg_array
-    else:
-        return ndcg_array
-
-
 def alpha_dcg_at_k(r_2d, k, method=1, alpha=0.5):
     """
     :param r_2d: 2d relevance np array, shape: [num_trg_str, num_pred_str]
@@ -620,42 +484,6 @@ def alpha_dcg_at_k(r_2d, k, method=1, alpha=0.5):
     return alpha_dcg
 
 
-def alpha_dcg_at_ks(r_2d, k_list, method=1, alpha=0.5):
-    """
-    :param r_2d: 2d relevance np array, shape: [num_trg_str, num_pred_str]
-    :param ks:
-    :param method:
-    :param alpha:
-    :return:
-    """
-    if r_2d.shape[-1] == 0:
-        return [0.0] * len(k_list)
-    # convert r_2d to gain vector
-    num_trg_str, num_pred_str = r_2d.shape
-    # k_max = max(k_list)
-    k_max = -1
-    for k in k_list:
-        if k == 'M':
-            k = num_pred_str
-        elif k == 'G':
-            # k = num_trg_str
-            if num_pred_str < num_trg_str:
-                k = num_trg_str
-            else:
-                k = num_pred_str
-
-        if k > k_max:
-            k_max = k
-    if num_pred_str > k_max:
-        num_pred_str = k_max
-    gain_vector = np.zeros(num_pred_str)
-    one_minus_alpha_vec = np.ones(num_trg_str) * (1 - alpha)  # [num_trg_str]
-    cum_r = np.concatenate((np.zeros((num_trg_str, 1)), np.cumsum(r_2d, axis=1)), axis=1)
-    for j in range(num_pred_str):
-        gain_vector[j] = np.dot(r_2d[:, j], np.power(one_minus_alpha_vec, cum_r[:, j]))
-    return dcg_at_ks(gain_vector, k_list, num_trg_str, method)
-
-
 def alpha_ndcg_at_k(r_2d, k, method=1, alpha=0.5, include_dcg=False):
     """
     :param r_2d: 2d relevance np array, shape: [num_trg_str, num_pred_str]
@@ -693,46 +521,6 @@ def alpha_ndcg_at_k(r_2d, k, method=1, alpha=0.5, include_dcg=False):
         return alpha_ndcg
 
 
-def alpha_ndcg_at_ks(r_2d, k_list, method=1, alpha=0.5, include_dcg=False):
-    """
-    :param r_2d: 2d relevance np array, shape: [num_trg_str, num_pred_str]
-    :param k:
-    :param method:
-    :param alpha:
-    :return:
-    """
-    if r_2d.shape[-1] == 0:
-        alpha_ndcg_array = [0] * len(k_list)
-        alpha_dcg_array = [0] * len(k_list)
-    else:
-        # k_max = max(k_list)
-        num_trg_str, num_pred_str = r_2d.shape
-        k_max = -1
-        for k in k_list:
-            if k == 'M':
-                k = num_pred_str
-            elif k == 'G':
-                # k = num_trg_str
-                if num_pred_str < num_trg_str:
-                    k = num_trg_str
-                else:
-                    k = num_pred_str
-
-            if k > k_max:
-                k_max = k
-        # convert r to gain vector
-        alpha_dcg_array = alpha_dcg_at_ks(r_2d, k_list, method, alpha)
-        # compute alpha_dcg_max
-        r_2d_ideal = compute_ideal_r_2d(r_2d, k_max, alpha)
-        alpha_dcg_max_array = alpha_dcg_at_ks(r_2d_ideal, k_list, method, alpha)
-        alpha_ndcg_array = alpha_dcg_array / alpha_dcg_max_array
-        alpha_ndcg_array = np.nan_to_num(alpha_ndcg_array)
-    if include_dcg:
-        return alpha_ndcg_array, alpha_dcg_array
-    else:
-        return alpha_ndcg_array
-
-
 def compute_ideal_r_2d(r_2d, k, alpha=0.5):
     num_trg_str, num_pred_str = r_2d.shape
     one_minus_alpha_vec = np.ones(num_trg_str) * (1 - alpha)  # [num_trg_str]
@@ -786,42 +574,163 @@ def average_precision_at_k(r, k, num_predictions, num_trgs):
     return average_precision(r, num_predictions, num_trgs)
 
 
-def average_precision_at_ks(r, k_list, num_predictions, num_trgs):
-    if num_predictions == 0 or num_trgs == 0:
-        return [0] * len(k_list)
-    # k_max = max(k_list)
-    k_max = -1
-    for k in k_list:
-        if k == 'M':
-            k = num_predictions
-        elif k == 'G':
-            # k = num_trgs
-            if num_predictions < num_trgs:
-                k = num_trgs
-            else:
-                k = num_predictions
-        if k > k_max:
-            k_max = k
-    if num_predictions > k_max:
-        num_predictions = k_max
-        r = r[:num_predictions]
-    r_cum_sum = np.cumsum(r, axis=0)
-    precision_array = [compute_precision(r_cum_sum[k], k + 1) * r[k] for k in range(num_predictions)]
-    precision_cum_sum = np.cumsum(precision_array, axis=0)
-    average_precision_array = precision_cum_sum / num_trgs
-    return_indices = []
-    for k in k_list:
+def resolve_ks(k_list, num_predictions, num_trgs):
+    """
+    :param num_predictions: int np array [num_docs]
+    :param num_trgs: int np array [num_docs]
+    :return: int np array [num_docs, len(k_list)], 'M' is the number of predictions of the document, 'G' the max of its
+             numbers of predictions and targets
+    """
+    ks = np.zeros((len(num_predictions), len(k_list)), dtype=np.int64)
+    for i, k in enumerate(k_list):
         if k == 'M':
-            k = num_predictions
+            ks[:, i] = num_predictions
         elif k == 'G':
-            # k = num_trgs
-            if num_predictions < num_trgs:
-                k = num_trgs
-            else:
-                k = num_predictions
-        return_indices.append((k - 1) if k <= num_predictions else (num_predictions - 1))
-    return_indices = np.array(return_indices, dtype=int)
-    return average_precision_array[return_indices]
+            ks[:, i] = np.maximum(num_predictions, num_trgs)
+        else:
+            ks[:, i] = k
+    return ks
+
+
+def pad_match_results(is_match_list, is_match_2d_list=None):
+    """
+    :param is_match_list: list of the boolean np arrays [num_predictions] of the documents
+    :param is_match_2d_list: list of the boolean np arrays [num_targets, num_predictions] of the documents
+    :return: is_match [num_docs, max_num_predictions] and is_match_2d [num_docs, max_num_targets, max_num_predictions],
+             padded with False, max_num_predictions is at least 1
+    """
+    num_docs = len(is_match_list)
+    max_num_predictions = max([1] + [is_match.shape[0] for is_match in is_match_list])
+    is_match_padded = np.zeros((num_docs, max_num_predictions), dtype=bool)
+    for i, is_match in enumerate(is_match_list):
+        is_match_padded[i, :is_match.shape[0]] = is_match
+    if is_match_2d_list is None:
+        return is_match_padded, None
+    max_num_trgs = max([0] + [is_match_2d.shape[0] for is_match_2d in is_match_2d_list])
+    is_match_2d_padded = np.zeros((num_docs, max_num_trgs, max_num_predictions), dtype=bool)
+    for i, is_match_2d in enumerate(is_match_2d_list):
+        is_match_2d_padded[i, :is_match_2d.shape[0], :is_match_2d.shape[1]] = is_match_2d
+    return is_match_padded, is_match_2d_padded
+
+
+def _divide(numerator, denominator):
+    # 0 where the denominator is 0, like compute_precision and the nan_to_num of the ndcg
+    return np.where(denominator > 0, numerator / np.where(denominator > 0, denominator, 1), 0.0)
+
+
+def compute_classification_metrics_batch(is_match, num_predictions, num_trgs, k_list, meng_rui_precision=False):
+    """
+    Same values as compute_classification_metrics_at_ks for a batch of documents, from a single cumulative sum
+    :param is_match: boolean np array [num_docs, max_num_predictions] padded with False
+    :param num_predictions: int np array [num_docs]
+    :param num_trgs: int np array [num_docs]
+    :return: dict of np arrays [num_docs, len(k_list)], keys are precision, recall, f1_score, num_matches and
+             num_predictions
+    """
+    ks = resolve_ks(k_list, num_predictions, num_trgs)
+    has_predictions = (num_predictions > 0)[:, None]
+    num_predictions_2d = num_predictions[:, None]
+    num_matches = np.cumsum(is_match, axis=1)
+    # the matches in the first k predictions, or in all of them if there are less than k
+    last_indices = np.maximum(np.minimum(ks, num_predictions_2d) - 1, 0)
+    num_matches_ks = np.where(has_predictions, np.take_along_axis(num_matches, last_indices, axis=1), 0)
+    if meng_rui_precision:
+        num_predictions_ks = np.minimum(ks, num_predictions_2d)
+    else:
+        num_predictions_ks = np.where(has_predictions, ks, 0)
+    precision_ks = _divide(num_matches_ks, num_predictions_ks)
+    recall_ks = _divide(num_matches_ks, np.broadcast_to(num_trgs[:, None], ks.shape))
+    f1_ks = _divide(2 * (precision_ks * recall_ks), precision_ks + recall_ks)
+    return {'precision': precision_ks, 'recall': recall_ks, 'f1_score': f1_ks, 'num_matches': num_matches_ks,
+            'num_predictions': num_predictions_ks}
+
+
+def _dcg_batch(gains):
+    """
+    :param gains: np array [num_docs, max_num_predictions]
+    :return: the dcg at every rank, np array [num_docs, max_num_predictions]
+    """
+    return np.cumsum(gains / np.log2(np.arange(2, gains.shape[1] + 2)), axis=1)
+
+
+def _alpha_gains_batch(r_3d, alpha=0.5):
+    """
+    :param r_3d: boolean np array [num_docs, max_num_trgs, max_num_predictions]
+    :return: the gain vectors of alpha_dcg_at_k, np array [num_docs, max_num_predictions]
+    """
+    # number of times each target was matched by the previous predictions
+    cum_r = np.cumsum(r_3d, axis=2) - r_3d
+    return np.sum(r_3d * np.power(1 - alpha, cum_r.astype(float)), axis=1)
+
+
+def compute_ideal_r_3d(r_3d, num_predictions, depth, alpha=0.5):
+    """
+    compute_ideal_r_2d for a batch of documents, the greedy ranking is done at the same time in all of them
+    :param r_3d: boolean np array [num_docs, max_num_trgs, max_num_predictions] padded with False
+    :param num_predictions: int np array [num_docs]
+    :param depth: int np array [num_docs], number of predictions ranked in each document, <= num_predictions
+    :return: boolean np array [num_docs, max_num_trgs, max(depth)], the columns of r_3d in the ideal order,
+             padded with False
+    """
+    num_docs, num_trgs, max_num_predictions = r_3d.shape
+    max_depth = int(depth.max()) if num_docs > 0 else 0
+    doc_indices = np.arange(num_docs)
+    r_float = r_3d.astype(float)
+    cum_r = np.zeros((num_docs, num_trgs))
+    # the padding predictions are never picked
+    is_ranked = np.arange(max_num_predictions)[None, :] >= num_predictions[:, None]
+    ideal_ranking = np.zeros((num_docs, max_depth), dtype=np.int64)
+    for rank in range(max_depth):
+        gain = np.einsum('dtp,dt->dp', r_float, np.power(1 - alpha, cum_r))
+        gain[is_ranked] = -1000.0
+        best = np.argmax(gain, axis=1)
+        active = rank < depth
+        ideal_ranking[:, rank] = best
+        is_ranked[doc_indices[active], best[active]] = True
+        cum_r[active] += r_float[doc_indices[active], :, best[active]]
+    r_ideal = np.take_along_axis(r_3d, ideal_ranking[:, None, :], axis=2)
+    return r_ideal & (np.arange(max_depth)[None, None, :] < depth[:, None, None])
+
+
+def compute_ranking_metrics_batch(is_match, is_match_2d, num_predictions, num_trgs, k_list, alpha=0.5):
+    """
+    Same values as average_precision_at_k, ndcg_at_k and alpha_ndcg_at_k (the reference definitions of the metrics)
+    at every k of k_list for a batch of documents, the metrics at every k are read from a single cumulative sum
+    :param is_match: boolean np array [num_docs, max_num_predictions] padded with False
+    :param is_match_2d: boolean np array [num_docs, max_num_trgs, max_num_predictions] padded with False
+    :param num_predictions: int np array [num_docs]
+    :param num_trgs: int np array [num_docs]
+    :return: dict of np arrays [num_docs, len(k_list)], keys are AP, NDCG and AlphaNDCG
+    """
+    ks = resolve_ks(k_list, num_predictions, num_trgs)
+    has_predictions = (num_predictions > 0)[:, None]
+    last_indices = np.maximum(np.minimum(ks, num_predictions[:, None]) - 1, 0)
+
+    def at_ks(cumulative):
+        return np.take_along_axis(cumulative, last_indices, axis=1)
+
+    # AP
+    ranks = np.arange(1, is_match.shape[1] + 1)
+    precision_cum_sum = np.cumsum(np.cumsum(is_match, axis=1) / ranks * is_match, axis=1)
+    ap_ks = _divide(at_ks(precision_cum_sum), np.broadcast_to(num_trgs[:, None], ks.shape))
+
+    # NDCG, the ideal ranking puts all the matches first
+    dcg_ks = at_ks(_dcg_batch(is_match))
+    ideal_is_match = np.arange(is_match.shape[1])[None, :] < is_match.sum(axis=1)[:, None]
+    ndcg_ks = _divide(dcg_ks, at_ks(_dcg_batch(ideal_is_match)))
+
+    # AlphaNDCG
+    alpha_dcg_ks = at_ks(_dcg_batch(_alpha_gains_batch(is_match_2d, alpha)))
+    depth = np.minimum(num_predictions, ks.max(axis=1, initial=0))
+    r_3d_ideal = compute_ideal_r_3d(is_match_2d, num_predictions, depth, alpha)
+    alpha_dcg_max_ks = np.zeros(ks.shape)
+    if r_3d_ideal.shape[2] > 0:
+        alpha_dcg_max_ks = np.take_along_axis(_dcg_batch(_alpha_gains_batch(r_3d_ideal, alpha)),
+                                              np.minimum(last_indices, r_3d_ideal.shape[2] - 1), axis=1)
+    alpha_ndcg_ks = _divide(alpha_dcg_ks, alpha_dcg_max_ks)
+
+    return {'AP': np.where(has_predictions, ap_ks, 0.0), 'NDCG': np.where(has_predictions, ndcg_ks, 0.0),
+            'AlphaNDCG': np.where(has_predictions, alpha_ndcg_ks, 0.0)}
 
 
 def find_v(f1_dict, num_samples, k_list, tag):
@@ -867,41 +776,63 @@ def update_f1_dict_with_name_variation(trg_variation_token_3dlist, pred_token_2d
     return f1_dict
 
 
-def update_score_dict(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed, k_list, score_dict, tag):
-    num_targets = len(trg_token_2dlist_stemmed)
-    num_predictions = len(pred_token_2dlist_stemmed)
-
+def match_document(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed):
+    """
+    :return: the exact matches [num_predictions], the substring matches [num_targets, num_predictions] and the number
+             of targets of a document, scored by update_score_dict_batch
+    """
     is_match = compute_match_result(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed,
                                     type='exact', dimension=1)
     is_match_substring_2d = compute_match_result(trg_token_2dlist_stemmed,
                                                  pred_token_2dlist_stemmed, type='sub', dimension=2)
-    # Classification metrics
-    precision_ks, recall_ks, f1_ks, num_matches_ks, num_predictions_ks = \
-        compute_classification_metrics_at_ks(is_match, num_predictions, num_targets, k_list=k_list,
-                                             meng_rui_precision=opt.meng_rui_precision)
+    return is_match, is_match_substring_2d, len(trg_token_2dlist_stemmed)
 
-    # Ranking metrics
-    ndcg_ks, dcg_ks = ndcg_at_ks(is_match, k_list=k_list, num_trgs=num_targets, method=1, include_dcg=True)
-    alpha_ndcg_ks, alpha_dcg_ks = alpha_ndcg_at_ks(is_match_substring_2d, k_list=k_list, method=1,
-                                                   alpha=0.5, include_dcg=True)
-    ap_ks = average_precision_at_ks(is_match, k_list=k_list,
-                                    num_predictions=num_predictions, num_trgs=num_targets)
 
-    for topk, precision_k, recall_k, f1_k, num_matches_k, num_predictions_k, ndcg_k, dcg_k, alpha_ndcg_k, alpha_dcg_k, ap_k in \
-            zip(k_list, precision_ks, recall_ks, f1_ks, num_matches_ks, num_predictions_ks, ndcg_ks, dcg_ks,
-                alpha_ndcg_ks, alpha_dcg_ks, ap_ks):
-        score_dict['precision@{}_{}'.format(topk, tag)].append(precision_k)
-        score_dict['recall@{}_{}'.format(topk, tag)].append(recall_k)
-        score_dict['f1_score@{}_{}'.format(topk, tag)].append(f1_k)
-        score_dict['num_matches@{}_{}'.format(topk, tag)].append(num_matches_k)
-        score_dict['num_predictions@{}_{}'.format(topk, tag)].append(num_predictions_k)
-        score_dict['num_targets@{}_{}'.format(topk, tag)].append(num_targets)
-        score_dict['AP@{}_{}'.format(topk, tag)].append(ap_k)
-        score_dict['NDCG@{}_{}'.format(topk, tag)].append(ndcg_k)
-        score_dict['AlphaNDCG@{}_{}'.format(topk, tag)].append(alpha_ndcg_k)
+def match_document_with_name_variation(trg_variation_token_3dlist, pred_token_2dlist):
+    """
+    :return: same as match_document without the substring matches, only the classification metrics are computed
+             with the name variations
+    """
+    is_match = compute_var_match_result(trg_variation_token_3dlist, pred_token_2dlist)
+    return is_match, None, len(trg_variation_token_3dlist)
 
-    score_dict['num_targets_{}'.format(tag)].append(num_targets)
-    score_dict['num_predictions_{}'.format(tag)].append(num_predictions)
+
+def update_score_dict(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed, k_list, score_dict, tag):
+    return update_score_dict_batch([match_document(trg_token_2dlist_stemmed, pred_token_2dlist_stemmed)], k_list,
+                                   score_dict, tag)
+
+
+def update_score_dict_batch(match_results, k_list, score_dict, tag):
+    """
+    Compute the metrics of a batch of documents at every k at once and append them to score_dict in the order of the
+    documents, the keys are the same as the ones read by report_classification_scores and report_ranking_scores
+    :param match_results: list of the results of match_document (or match_document_with_name_variation, then the
+                          ranking metrics are not computed) of the documents
+    """
+    if len(match_results) == 0:
+        return score_dict
+    ranking = match_results[0][1] is not None
+    num_predictions = np.array([is_match.shape[0] for is_match, _, _ in match_results], dtype=np.int64)
+    num_trgs = np.array([num_targets for _, _, num_targets in match_results], dtype=np.int64)
+    is_match, is_match_substring_2d = pad_match_results(
+        [is_match for is_match, _, _ in match_results],
+        [is_match_2d for _, is_match_2d, _ in match_results] if ranking else None)
+
+    metrics = compute_classification_metrics_batch(is_match, num_predictions, num_trgs, k_list,
+                                                   meng_rui_precision=opt.meng_rui_precision)
+    metric_names = ['precision', 'recall', 'f1_score', 'num_matches', 'num_predictions', 'num_targets']
+    metrics['num_targets'] = np.broadcast_to(num_trgs[:, None], (len(match_results), len(k_list)))
+    if ranking:
+        metrics.update(compute_ranking_metrics_batch(is_match, is_match_substring_2d, num_predictions, num_trgs,
+                                                     k_list, alpha=0.5))
+        metric_names += ['AP', 'NDCG', 'AlphaNDCG']
+
+    for i, topk in enumerate(k_list):
+        for name in metric_names:
+            score_dict['{}@{}_{}'.format(name, topk, tag)].extend(metrics[name][:, i].tolist())
+    if ranking:
+        score_dict['num_targets_{}'.format(tag)].extend(num_trgs.tolist())
+        score_dict['num_predictions_{}'.format(tag)].extend(num_predictions.tolist())
     return score_dict
 
 
@@ -925,22 +856,8 @@ def update_score_dict_with_name_variation_backup(is_match_all, pred_indices, num
 
 
 def update_score_dict_with_name_variation(trg_variation_token_3dlist, pred_token_2dlist, k_list, score_dict, tag):
-    num_targets = len(trg_variation_token_3dlist)
-    num_predictions = len(pred_token_2dlist)
-    is_match = compute_var_match_result(trg_variation_token_3dlist, pred_token_2dlist)
-    # Classification metrics
-    precision_ks, recall_ks, f1_ks, num_matches_ks, num_predictions_ks = \
-        compute_classification_metrics_at_ks(is_match, num_predictions, num_targets, k_list=k_list,
-                                             meng_rui_precision=opt.meng_rui_precision)
-    for topk, precision_k, recall_k, f1_k, num_matches_k, num_predictions_k in \
-            zip(k_list, precision_ks, recall_ks, f1_ks, num_matches_ks, num_predictions_ks):
-        score_dict['precision@{}_{}'.format(topk, tag)].append(precision_k)
-        score_dict['recall@{}_{}'.format(topk, tag)].append(recall_k)
-        score_dict['f1_score@{}_{}'.format(topk, tag)].append(f1_k)
-        score_dict['num_matches@{}_{}'.format(topk, tag)].append(num_matches_k)
-        score_dict['num_predictions@{}_{}'.format(topk, tag)].append(num_predictions_k)
-        score_dict['num_targets@{}_{}'.format(topk, tag)].append(num_targets)
-    return score_dict
+    return update_score_dict_batch([match_document_with_name_variation(trg_variation_token_3dlist, pred_token_2dlist)],
+                                   k_list, score_dict, tag)
 
 
 def compute_var_match_result(trg_variation_token_3dlist, pred_token_2dlist):
@@ -1140,6 +1057,352 @@ def report_ranking_scores(score_dict, topk_list, present_tag):
     return output_str, field_list, result_list
 
 
+def prepare_gold_document(src_l, trg_l):
+    """
+    Stem the source and the targets of a document, remove the duplicated targets and separate the present and the
+    absent ones. Only depends on the source and target files and the options in gold_cache_key, not on the predictions.
+    :param src_l: line of the source file
+    :param trg_l: line of the target file
+    :return: dict with the stemmed source, the unique targets and the present and absent unique targets
+    """
+    trg_str_list = trg_l.strip().split(';')
+    if opt.use_name_variations:
+        # trg_token_2dlist = [trg_str.strip().split('|') for trg_str in trg_str_list]
+        trg_variation_token_3dlist = []
+        for trg_str in trg_str_list:
+            name_variation_list = trg_str.strip().split('|')
+            name_variation_tokens_2dlist = []
+            for name_variation in name_variation_list:
+                name_variation_tokens_2dlist.append(name_variation.strip().split())
+            trg_variation_token_3dlist.append(name_variation_tokens_2dlist)
+    else:
+        trg_token_2dlist = [trg_str.strip().split(' ') for trg_str in trg_str_list]
+
+    # TODO: test name_variation_tokens_3dlist
+    [title, context] = src_l.strip().split('<eos>')
+    src_token_list = title.strip().split(' ') + context.strip().split(' ')
+
+    # perform stemming
+    stemmed_src_token_list = stem_word_list(src_token_list)
+    src_index = SourceNgramIndex(stemmed_src_token_list)
+
+    if opt.use_name_variations:
+        if opt.target_already_stemmed:
+            stemmed_trg_variation_token_3dlist = trg_variation_token_3dlist
+        else:
+            stemmed_trg_variation_token_3dlist = stem_str_2d_list(trg_variation_token_3dlist)
+        # testing set with name variation have removed all duplicates during preprocessing
+        unique_trgs = stemmed_trg_variation_token_3dlist
+        present_trgs, absent_trgs = separate_present_absent_by_source_with_variations(src_index, unique_trgs,
+                                                                                      use_name_variations=True)
+    else:
+        if opt.target_already_stemmed:
+            stemmed_trg_token_2dlist = trg_token_2dlist
+        else:
+            stemmed_trg_token_2dlist = stem_str_list(trg_token_2dlist)
+        # Remove duplicated targets
+        unique_trgs, num_duplicated_trg = find_unique_target(stemmed_trg_token_2dlist)
+        if opt.target_separated:
+            if opt.reverse_sorting:
+                absent_trgs, present_trgs = separate_present_absent_by_segmenter(unique_trgs, present_absent_segmenter)
+            else:
+                present_trgs, absent_trgs = separate_present_absent_by_segmenter(unique_trgs, present_absent_segmenter)
+        else:
+            present_trgs, absent_trgs = separate_present_absent_by_source(src_index, unique_trgs, opt.match_by_str)
+    # TODO: test stemmed_trg_variation_token_3dlist
+
+    return {'stemmed_src': stemmed_src_token_list, 'unique_trgs': unique_trgs, 'present_trgs': present_trgs,
+            'absent_trgs': absent_trgs}
+
+
+def evaluate_document(pred_l, gold, topk_dict):
+    """
+    Compute the statistics and the scores of a document
+    :param pred_l: line of the prediction file
+    :param gold: the source and targets of the document, prepared by prepare_gold_document
+    :return: dict with the counts of the document, its entries of f1_dict, its matching results for each tag scored by
+             update_score_dict_batch, and its filtered predictions
+    """
+    # int instead of a lambda as default factory, the result is sent back from the worker processes
+    counts = defaultdict(int)
+    if opt.tune_f1_v:
+        f1_dict = defaultdict(int)
+        match_results = None
+    else:
+        match_results = {}
+        f1_dict = None
+
+    counts['total_num_src'] += 1
+    # convert the str to token list
+    pred_str_list = pred_l.strip().split(';')
+    if pred_str_list == ['']:
+        pred_str_list = []
+    pred_str_list = pred_str_list[:opt.num_preds]
+    pred_token_2dlist = [pred_str.strip().split(' ') for pred_str in pred_str_list]
+
+    num_predictions = len(pred_str_list)
+
+    # n-gram index of the source, shared by all the present keyphrase checks of this document
+    src_index = SourceNgramIndex(gold['stemmed_src'])
+    stemmed_pred_token_2dlist = stem_str_list(pred_token_2dlist)
+
+    # remove peos in predictions, then check if the model can successfuly separate present and absent keyphrases by segmenter
+    if opt.prediction_separated:
+        if opt.reverse_sorting:
+            absent_stemmed_pred_token_2dlist_by_segmenter, present_stemmed_pred_token_2dlist_by_segmenter = separate_present_absent_by_segmenter(
+                stemmed_pred_token_2dlist, present_absent_segmenter)
+        else:
+            present_stemmed_pred_token_2dlist_by_segmenter, absent_stemmed_pred_token_2dlist_by_segmenter = separate_present_absent_by_segmenter(
+                stemmed_pred_token_2dlist, present_absent_segmenter)
+        stemmed_pred_token_2dlist = present_stemmed_pred_token_2dlist_by_segmenter + absent_stemmed_pred_token_2dlist_by_segmenter  # remove all the peos token
+        # check present absent
+        num_absent_before_segmenter = len(present_stemmed_pred_token_2dlist_by_segmenter) - sum(
+            check_present_keyphrases(src_index, present_stemmed_pred_token_2dlist_by_segmenter))
+        num_present_after_segmenter = sum(
+            check_present_keyphrases(src_index, absent_stemmed_pred_token_2dlist_by_segmenter))
+        incorrect_fraction_for_identifying_present = num_absent_before_segmenter / len(
+            present_stemmed_pred_token_2dlist_by_segmenter) if len(
+            present_stemmed_pred_token_2dlist_by_segmenter) > 0 else 0
+        incorrect_fraction_for_identifying_absent = num_present_after_segmenter / len(
+            absent_stemmed_pred_token_2dlist_by_segmenter) if len(
+            absent_stemmed_pred_token_2dlist_by_segmenter) > 0 else 0
+        counts['sum_incorrect_fraction_for_identifying_present'] += incorrect_fraction_for_identifying_present
+        counts['sum_incorrect_fraction_for_identifying_absent'] += incorrect_fraction_for_identifying_absent
+
+    # separate unfiltered predictions  #####!!!!
+    present_stemmed_pred_token_2dlist, absent_stemmed_pred_token_2dlist = separate_present_absent_by_source(
+            src_index, stemmed_pred_token_2dlist, opt.match_by_str)
+
+    # Filter out present and absent predictions respectively
+    _, present_num_duplicated_predictions = filter_prediction(opt.disable_valid_filter,
+                                                              opt.disable_extra_one_word_filter,
+                                                              present_stemmed_pred_token_2dlist)
+    counts['present_num_unique_predictions'] += (len(present_stemmed_pred_token_2dlist) - present_num_duplicated_predictions)
+    counts['present_num_predictions'] += len(present_stemmed_pred_token_2dlist)
+    _, absent_num_duplicated_predictions = filter_prediction(opt.disable_valid_filter,
+                                                             opt.disable_extra_one_word_filter,
+                                                             absent_stemmed_pred_token_2dlist)
+    counts['absent_num_unique_predictions'] += (len(absent_stemmed_pred_token_2dlist) - absent_num_duplicated_predictions)
+    counts['absent_num_predictions'] += len(absent_stemmed_pred_token_2dlist)
+
+    # Filter out duplicate, invalid, and extra one word predictions
+    filtered_stemmed_pred_token_2dlist, num_duplicated_predictions = filter_prediction(opt.disable_valid_filter,
+                                                                                       opt.disable_extra_one_word_filter,
+                                                                                       stemmed_pred_token_2dlist)
+    counts['total_num_unique_predictions'] += (num_predictions - num_duplicated_predictions)
+    counts['total_num_predictions'] += num_predictions
+
+    num_unique_targets = len(gold['unique_trgs'])
+    counts['max_unique_targets'] = num_unique_targets
+
+    # separate present and absent keyphrases
+    if opt.use_name_variations:
+        # separate prediction
+        present_filtered_stemmed_pred_token_2dlist, absent_filtered_stemmed_pred_token_2dlist = \
+            separate_present_absent_by_source_with_variations(src_index,
+                                                              filtered_stemmed_pred_token_2dlist,
+                                                              use_name_variations=False)
+        unique_stemmed_trg_variation_token_3dlist = gold['unique_trgs']
+        present_unique_stemmed_trg_variation_token_3dlist = gold['present_trgs']
+        absent_unique_stemmed_trg_variation_token_3dlist = gold['absent_trgs']
+
+        num_present_filtered_predictions = len(present_filtered_stemmed_pred_token_2dlist)
+        num_present_unique_targets = len(present_unique_stemmed_trg_variation_token_3dlist)
+        num_absent_filtered_predictions = len(absent_filtered_stemmed_pred_token_2dlist)
+        num_absent_unique_targets = len(absent_unique_stemmed_trg_variation_token_3dlist)
+
+        counts['total_num_present_filtered_predictions'] += num_present_filtered_predictions
+        counts['total_num_present_unique_targets'] += num_present_unique_targets
+        counts['total_num_absent_filtered_predictions'] += num_absent_filtered_predictions
+        counts['total_num_absent_unique_targets'] += num_absent_unique_targets
+
+        if num_present_unique_targets > 0:
+            counts['total_num_src_with_present_keyphrases'] += 1
+        if num_absent_unique_targets > 0:
+            counts['total_num_src_with_absent_keyphrases'] += 1
+
+        if opt.tune_f1_v:
+            # compute F1 score all
+            f1_dict = update_f1_dict(unique_stemmed_trg_variation_token_3dlist, filtered_stemmed_pred_token_2dlist,
+                                     topk_dict['all'], f1_dict, 'all')
+            # compute F1 score present
+            f1_dict = update_f1_dict(present_unique_stemmed_trg_variation_token_3dlist,
+                                     present_filtered_stemmed_pred_token_2dlist,
+                                     topk_dict['present'], f1_dict, 'present')
+            # compute F1 score absent
+            f1_dict = update_f1_dict(absent_unique_stemmed_trg_variation_token_3dlist,
+                                     absent_filtered_stemmed_pred_token_2dlist,
+                                     topk_dict['absent'], f1_dict, 'absent')
+        else:
+            # match the predictions with the targets, the metrics are computed for the whole chunk of documents
+            match_results['all'] = match_document_with_name_variation(
+                unique_stemmed_trg_variation_token_3dlist, filtered_stemmed_pred_token_2dlist)
+            # for present keyphrase
+            match_results['present'] = match_document_with_name_variation(
+                present_unique_stemmed_trg_variation_token_3dlist, present_filtered_stemmed_pred_token_2dlist)
+            # for absent keyphrase
+            match_results['absent'] = match_document_with_name_variation(
+                absent_unique_stemmed_trg_variation_token_3dlist, absent_filtered_stemmed_pred_token_2dlist)
+
+    else:
+        present_filtered_stemmed_pred_token_2dlist, absent_filtered_stemmed_pred_token_2dlist = separate_present_absent_by_source(
+            src_index, filtered_stemmed_pred_token_2dlist, opt.match_by_str)
+        unique_stemmed_trg_token_2dlist = gold['unique_trgs']
+        present_unique_stemmed_trg_token_2dlist = gold['present_trgs']
+        absent_unique_stemmed_trg_token_2dlist = gold['absent_trgs']
+
+        counts['total_num_present_filtered_predictions'] += len(present_filtered_stemmed_pred_token_2dlist)
+        counts['total_num_present_unique_targets'] += len(present_unique_stemmed_trg_token_2dlist)
+        counts['total_num_absent_filtered_predictions'] += len(absent_filtered_stemmed_pred_token_2dlist)
+        counts['total_num_absent_unique_targets'] += len(absent_unique_stemmed_trg_token_2dlist)
+        if len(present_unique_stemmed_trg_token_2dlist) > 0:
+            counts['total_num_src_with_present_keyphrases'] += 1
+        if len(absent_unique_stemmed_trg_token_2dlist) > 0:
+            counts['total_num_src_with_absent_keyphrases'] += 1
+
+        if opt.tune_f1_v:
+            # compute F1 score all
+            f1_dict = update_f1_dict(unique_stemmed_trg_token_2dlist, filtered_stemmed_pred_token_2dlist,
+                                     topk_dict['all'], f1_dict, 'all')
+            # compute F1 score present
+            f1_dict = update_f1_dict(present_unique_stemmed_trg_token_2dlist,
+                                     present_filtered_stemmed_pred_token_2dlist,
+                                     topk_dict['present'], f1_dict, 'present')
+            # compute F1 score absent
+            f1_dict = update_f1_dict(absent_unique_stemmed_trg_token_2dlist,
+                                     absent_filtered_stemmed_pred_token_2dlist,
+                                     topk_dict['absent'], f1_dict, 'absent')
+        else:
+            # match the predictions with the targets, the metrics are computed for the whole chunk of documents
+            match_results['all'] = match_document(unique_stemmed_trg_token_2dlist, filtered_stemmed_pred_token_2dlist)
+            # for present keyphrase
+            match_results['present'] = match_document(present_unique_stemmed_trg_token_2dlist,
+                                                      present_filtered_stemmed_pred_token_2dlist)
+            # for absent keyphrase
+            match_results['absent'] = match_document(absent_unique_stemmed_trg_token_2dlist,
+                                                     absent_filtered_stemmed_pred_token_2dlist)
+    final_pred_str_list = []
+    for word_list in filtered_stemmed_pred_token_2dlist:
+        final_pred_str_list.append(' '.join(word_list))
+    pred_print_out = ';'.join(final_pred_str_list) + '\n'
+
+    return {'counts': counts, 'f1_dict': f1_dict, 'match_results': match_results, 'filtered_pred': pred_print_out}
+
+
+def merge_document_result(doc_result, counts, f1_dict):
+    """
+    Add the result of a document to the accumulated counts and scores, the documents must be merged in order
+    """
+    for k, v in doc_result['counts'].items():
+        if k == 'max_unique_targets':
+            counts[k] = max(counts[k], v)
+        else:
+            counts[k] += v
+    if doc_result['f1_dict'] is not None:
+        for k, v in doc_result['f1_dict'].items():
+            f1_dict[k] += v
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def gold_cache_key(opt):
+    """
+    The prepared targets depend on the content of the source and target files, the options below and the stemmer
+    """
+    return {'src_sha256': file_sha256(opt.src_file_path), 'trg_sha256': file_sha256(opt.trg_file_path),
+            'use_name_variations': opt.use_name_variations, 'match_by_str': opt.match_by_str,
+            'target_separated': opt.target_separated, 'reverse_sorting': opt.reverse_sorting,
+            'target_already_stemmed': opt.target_already_stemmed, 'segmenter': present_absent_segmenter,
+            'stemmer': stem_cache._signature()}
+
+
+def load_gold_cache(path, key):
+    """
+    :return: the documents prepared by prepare_gold_document, None if the file is missing or was built from other files
+             or options
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        cache = pickle.load(f)
+    if cache['key'] != key:
+        return None
+    return cache['documents']
+
+
+def save_gold_cache(path, key, documents):
+    with open(path, 'wb') as f:
+        pickle.dump({'key': key, 'documents': documents}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def iter_document_chunks(src_file_path, trg_file_path, pred_file_path, chunk_size, golds=None):
+    """
+    :param golds: the cached documents of prepare_gold_document, the source and target files are not read if given
+    :return: generator of the lists of at most chunk_size aligned (src_l, trg_l, pred_l, gold) tuples,
+             gold is None if it is not cached, src_l and trg_l are None if it is
+    """
+    if golds is None:
+        lines = zip(open(src_file_path), open(trg_file_path), open(pred_file_path), itertools.repeat(None))
+    else:
+        lines = zip(itertools.repeat(None), itertools.repeat(None), open(pred_file_path), golds)
+    chunk = list(itertools.islice(lines, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(lines, chunk_size))
+
+
+def evaluate_chunk_documents(chunk, topk_dict, keep_gold=False):
+    """
+    :param keep_gold: add the documents prepared from the source and target lines to the results, to build the cache
+    :return: the results of the documents, and the score_dict of the chunk (None with tune_f1_v), the metrics of all
+             its documents are computed at once
+    """
+    doc_results = []
+    for src_l, trg_l, pred_l, gold in chunk:
+        if gold is None:
+            gold = prepare_gold_document(src_l, trg_l)
+        doc_result = evaluate_document(pred_l, gold, topk_dict)
+        if keep_gold:
+            doc_result['gold'] = gold
+        doc_results.append(doc_result)
+    if opt.tune_f1_v:
+        return doc_results, None
+    match_results = [doc_result.pop('match_results') for doc_result in doc_results]
+    score_dict = defaultdict(list)
+    for tag in ['all', 'present', 'absent']:
+        update_score_dict_batch([doc_match_results[tag] for doc_match_results in match_results], topk_dict[tag],
+                                score_dict, tag)
+    return doc_results, score_dict
+
+
+def _init_worker(worker_opt, worker_topk_dict, segmenter, keep_gold):
+    global opt, topk_dict, present_absent_segmenter, keep_gold_documents
+    opt = worker_opt
+    topk_dict = worker_topk_dict
+    present_absent_segmenter = segmenter
+    keep_gold_documents = keep_gold
+
+
+def _evaluate_chunk(chunk):
+    hits, misses = stem_cache.hits, stem_cache.misses
+    chunk_result = evaluate_chunk_documents(chunk, topk_dict, keep_gold_documents)
+    # the stems computed by the worker are sent back, to be saved with the cache of the main process
+    new_misses = stem_cache.misses - misses
+    return chunk_result, stem_cache.newest(new_misses), stem_cache.hits - hits, new_misses
+
+
+def _iter_pool_results(pool, chunks):
+    for chunk_result, new_stems, hits, misses in pool.imap(_evaluate_chunk, chunks):
+        stem_cache.update(new_stems, hits, misses)
+        yield chunk_result
+
+
 def main(opt):
     src_file_path = opt.src_file_path
     trg_file_path = opt.trg_file_path
@@ -1148,6 +1411,10 @@ def main(opt):
     if opt.export_filtered_pred:
         pred_output_file = open(os.path.join(opt.filtered_pred_path, "predictions_filtered.txt"), "w")
 
+    stem_cache.max_size = opt.stem_cache_size
+    if opt.stem_cache_path:
+        print("Loaded {} stems from {}".format(stem_cache.load(opt.stem_cache_path), opt.stem_cache_path))
+
     if opt.tune_f1_v:
         f1_dict = defaultdict(lambda: 0)
         max_k = 20
@@ -1160,240 +1427,72 @@ def main(opt):
         topk_dict = {'present': present_ks, 'absent': absent_ks, 'all': all_ks}
         # topk_dict = {'present': [5, 10, 'M'], 'absent': [5, 10, 50, 'M'], 'all': [5, 10, 'M']}
 
-    present_num_predictions = 0
-    present_num_unique_predictions = 0
-    absent_num_predictions = 0
-    absent_num_unique_predictions = 0
-    total_num_src = 0
-    total_num_src_with_present_keyphrases = 0
-    total_num_src_with_absent_keyphrases = 0
-    total_num_predictions = 0
-    total_num_unique_predictions = 0
-    total_num_present_filtered_predictions = 0
-    total_num_present_unique_targets = 0
-    total_num_absent_filtered_predictions = 0
-    total_num_absent_unique_targets = 0
-    max_unique_targets = 0
-
-    if opt.prediction_separated:
-        sum_incorrect_fraction_for_identifying_present = 0
-        sum_incorrect_fraction_for_identifying_absent = 0
-
-    for data_idx, (src_l, trg_l, pred_l) in enumerate(
-            zip(open(src_file_path), open(trg_file_path), open(pred_file_path))):
-        total_num_src += 1
-        # convert the str to token list
-        pred_str_list = pred_l.strip().split(';')
-        if pred_str_list == ['']:
-            pred_str_list = []
-        pred_str_list = pred_str_list[:opt.num_preds]
-        pred_token_2dlist = [pred_str.strip().split(' ') for pred_str in pred_str_list]
-        trg_str_list = trg_l.strip().split(';')
-        if opt.use_name_variations:
-            # trg_token_2dlist = [trg_str.strip().split('|') for trg_str in trg_str_list]
-            trg_variation_token_3dlist = []
-            for trg_str in trg_str_list:
-                name_variation_list = trg_str.strip().split('|')
-                name_variation_tokens_2dlist = []
-                for name_variation in name_variation_list:
-                    name_variation_tokens_2dlist.append(name_variation.strip().split())
-                trg_variation_token_3dlist.append(name_variation_tokens_2dlist)
-        else:
-            trg_token_2dlist = [trg_str.strip().split(' ') for trg_str in trg_str_list]
-
-        # TODO: test name_variation_tokens_3dlist
-        [title, context] = src_l.strip().split('<eos>')
-        src_token_list = title.strip().split(' ') + context.strip().split(' ')
-
-        num_predictions = len(pred_str_list)
-
-        # perform stemming
-        stemmed_src_token_list = stem_word_list(src_token_list)
-
-        if opt.use_name_variations:
-            if opt.target_already_stemmed:
-                stemmed_trg_variation_token_3dlist = trg_variation_token_3dlist
-            else:
-                stemmed_trg_variation_token_3dlist = stem_str_2d_list(trg_variation_token_3dlist)
-        else:
-            if opt.target_already_stemmed:
-                stemmed_trg_token_2dlist = trg_token_2dlist
-            else:
-                stemmed_trg_token_2dlist = stem_str_list(trg_token_2dlist)
-        # TODO: test stemmed_trg_variation_token_3dlist
-
-        stemmed_pred_token_2dlist = stem_str_list(pred_token_2dlist)
-
-        # remove peos in predictions, then check if the model can successfuly separate present and absent keyphrases by segmenter
-        if opt.prediction_separated:
-            if opt.reverse_sorting:
-                absent_stemmed_pred_token_2dlist_by_segmenter, present_stemmed_pred_token_2dlist_by_segmenter = separate_present_absent_by_segmenter(
-                    stemmed_pred_token_2dlist, present_absent_segmenter)
-            else:
-                present_stemmed_pred_token_2dlist_by_segmenter, absent_stemmed_pred_token_2dlist_by_segmenter = separate_present_absent_by_segmenter(
-                    stemmed_pred_token_2dlist, present_absent_segmenter)
-            stemmed_pred_token_2dlist = present_stemmed_pred_token_2dlist_by_segmenter + absent_stemmed_pred_token_2dlist_by_segmenter  # remove all the peos token
-            # check present absent
-            num_absent_before_segmenter = len(present_stemmed_pred_token_2dlist_by_segmenter) - sum(
-                check_present_keyphrases(stemmed_src_token_list, present_stemmed_pred_token_2dlist_by_segmenter))
-            num_present_after_segmenter = sum(
-                check_present_keyphrases(stemmed_src_token_list, absent_stemmed_pred_token_2dlist_by_segmenter))
-            incorrect_fraction_for_identifying_present = num_absent_before_segmenter / len(
-                present_stemmed_pred_token_2dlist_by_segmenter) if len(
-                present_stemmed_pred_token_2dlist_by_segmenter) > 0 else 0
-            incorrect_fraction_for_identifying_absent = num_present_after_segmenter / len(
-                absent_stemmed_pred_token_2dlist_by_segmenter) if len(
-                absent_stemmed_pred_token_2dlist_by_segmenter) > 0 else 0
-            sum_incorrect_fraction_for_identifying_present += incorrect_fraction_for_identifying_present
-            sum_incorrect_fraction_for_identifying_absent += incorrect_fraction_for_identifying_absent
-
-        # separate unfiltered predictions  #####!!!!
-        present_stemmed_pred_token_2dlist, absent_stemmed_pred_token_2dlist = separate_present_absent_by_source(
-                stemmed_src_token_list, stemmed_pred_token_2dlist, opt.match_by_str)
-
-        # Filter out present and absent predictions respectively
-        _, present_num_duplicated_predictions = filter_prediction(opt.disable_valid_filter,
-                                                                  opt.disable_extra_one_word_filter,
-                                                                  present_stemmed_pred_token_2dlist)
-        present_num_unique_predictions += (len(present_stemmed_pred_token_2dlist) - present_num_duplicated_predictions)
-        present_num_predictions += len(present_stemmed_pred_token_2dlist)
-        _, absent_num_duplicated_predictions = filter_prediction(opt.disable_valid_filter,
-                                                                 opt.disable_extra_one_word_filter,
-                                                                 absent_stemmed_pred_token_2dlist)
-        absent_num_unique_predictions += (len(absent_stemmed_pred_token_2dlist) - absent_num_duplicated_predictions)
-        absent_num_predictions += len(absent_stemmed_pred_token_2dlist)
-
-        # Filter out duplicate, invalid, and extra one word predictions
-        filtered_stemmed_pred_token_2dlist, num_duplicated_predictions = filter_prediction(opt.disable_valid_filter,
-                                                                                           opt.disable_extra_one_word_filter,
-                                                                                           stemmed_pred_token_2dlist)
-        total_num_unique_predictions += (num_predictions - num_duplicated_predictions)
-        total_num_predictions += num_predictions
-
-        # Remove duplicated targets
-        if opt.use_name_variations:  # testing set with name variation have removed all duplicates during preprocessing
-            num_unique_targets = len(stemmed_trg_variation_token_3dlist)
-            unique_stemmed_trg_variation_token_3dlist = stemmed_trg_variation_token_3dlist
-        else:
-            unique_stemmed_trg_token_2dlist, num_duplicated_trg = find_unique_target(stemmed_trg_token_2dlist)
-            # unique_stemmed_trg_token_2dlist = stemmed_trg_token_2dlist
-            num_unique_targets = len(unique_stemmed_trg_token_2dlist)
-            # max_unique_targets += (num_trg - num_duplicated_trg)
-
-        if num_unique_targets > max_unique_targets:
-            max_unique_targets = num_unique_targets
-
-        # separate present and absent keyphrases
-        if opt.use_name_variations:
-            # separate prediction
-            present_filtered_stemmed_pred_token_2dlist, absent_filtered_stemmed_pred_token_2dlist = \
-                separate_present_absent_by_source_with_variations(stemmed_src_token_list,
-                                                                  filtered_stemmed_pred_token_2dlist,
-                                                                  use_name_variations=False)
-            # separate target
-            present_unique_stemmed_trg_variation_token_3dlist, absent_unique_stemmed_trg_variation_token_3dlist = \
-                separate_present_absent_by_source_with_variations(stemmed_src_token_list,
-                                                                  unique_stemmed_trg_variation_token_3dlist,
-                                                                  use_name_variations=True)
-
-            num_present_filtered_predictions = len(present_filtered_stemmed_pred_token_2dlist)
-            num_present_unique_targets = len(present_unique_stemmed_trg_variation_token_3dlist)
-            num_absent_filtered_predictions = len(absent_filtered_stemmed_pred_token_2dlist)
-            num_absent_unique_targets = len(absent_unique_stemmed_trg_variation_token_3dlist)
-
-            total_num_present_filtered_predictions += num_present_filtered_predictions
-            total_num_present_unique_targets += num_present_unique_targets
-            total_num_absent_filtered_predictions += num_absent_filtered_predictions
-            total_num_absent_unique_targets += num_absent_unique_targets
-
-            if num_present_unique_targets > 0:
-                total_num_src_with_present_keyphrases += 1
-            if num_absent_unique_targets > 0:
-                total_num_src_with_absent_keyphrases += 1
-
-            if opt.tune_f1_v:
-                # compute F1 score all
-                f1_dict = update_f1_dict(unique_stemmed_trg_variation_token_3dlist, filtered_stemmed_pred_token_2dlist,
-                                         topk_dict['all'], f1_dict, 'all')
-                # compute F1 score present
-                f1_dict = update_f1_dict(present_unique_stemmed_trg_variation_token_3dlist,
-                                         present_filtered_stemmed_pred_token_2dlist,
-                                         topk_dict['present'], f1_dict, 'present')
-                # compute F1 score absent
-                f1_dict = update_f1_dict(absent_unique_stemmed_trg_variation_token_3dlist,
-                                         absent_filtered_stemmed_pred_token_2dlist,
-                                         topk_dict['absent'], f1_dict, 'absent')
-            else:
-                # compute all the metrics and update the score_dict
-                score_dict = update_score_dict_with_name_variation(unique_stemmed_trg_variation_token_3dlist,
-                                                                   filtered_stemmed_pred_token_2dlist,
-                                                                   topk_dict['all'], score_dict, 'all')
-                # compute all the metrics and update the score_dict for present keyphrase
-                score_dict = update_score_dict_with_name_variation(present_unique_stemmed_trg_variation_token_3dlist,
-                                                                   present_filtered_stemmed_pred_token_2dlist,
-                                                                   topk_dict['present'], score_dict, 'present')
-                # compute all the metrics and update the score_dict for present keyphrase
-                score_dict = update_score_dict_with_name_variation(absent_unique_stemmed_trg_variation_token_3dlist,
-                                                                   absent_filtered_stemmed_pred_token_2dlist,
-                                                                   topk_dict['absent'], score_dict, 'absent')
-
-        else:
-            present_filtered_stemmed_pred_token_2dlist, absent_filtered_stemmed_pred_token_2dlist = separate_present_absent_by_source(
-                stemmed_src_token_list, filtered_stemmed_pred_token_2dlist, opt.match_by_str)
-            if opt.target_separated:
-                if opt.reverse_sorting:
-                    absent_unique_stemmed_trg_token_2dlist, present_unique_stemmed_trg_token_2dlist = separate_present_absent_by_segmenter(
-                        unique_stemmed_trg_token_2dlist, present_absent_segmenter)
-                else:
-                    present_unique_stemmed_trg_token_2dlist, absent_unique_stemmed_trg_token_2dlist = separate_present_absent_by_segmenter(
-                        unique_stemmed_trg_token_2dlist, present_absent_segmenter)
-            else:
-                present_unique_stemmed_trg_token_2dlist, absent_unique_stemmed_trg_token_2dlist = separate_present_absent_by_source(
-                    stemmed_src_token_list, unique_stemmed_trg_token_2dlist, opt.match_by_str)
-
-            total_num_present_filtered_predictions += len(present_filtered_stemmed_pred_token_2dlist)
-            total_num_present_unique_targets += len(present_unique_stemmed_trg_token_2dlist)
-            total_num_absent_filtered_predictions += len(absent_filtered_stemmed_pred_token_2dlist)
-            total_num_absent_unique_targets += len(absent_unique_stemmed_trg_token_2dlist)
-            if len(present_unique_stemmed_trg_token_2dlist) > 0:
-                total_num_src_with_present_keyphrases += 1
-            if len(absent_unique_stemmed_trg_token_2dlist) > 0:
-                total_num_src_with_absent_keyphrases += 1
-
-            if opt.tune_f1_v:
-                # compute F1 score all
-                f1_dict = update_f1_dict(unique_stemmed_trg_token_2dlist, filtered_stemmed_pred_token_2dlist,
-                                         topk_dict['all'], f1_dict, 'all')
-                # compute F1 score present
-                f1_dict = update_f1_dict(present_unique_stemmed_trg_token_2dlist,
-                                         present_filtered_stemmed_pred_token_2dlist,
-                                         topk_dict['present'], f1_dict, 'present')
-                # compute F1 score absent
-                f1_dict = update_f1_dict(absent_unique_stemmed_trg_token_2dlist,
-                                         absent_filtered_stemmed_pred_token_2dlist,
-                                         topk_dict['absent'], f1_dict, 'absent')
-            else:
-                # compute all the metrics and update the score_dict
-                score_dict = update_score_dict(unique_stemmed_trg_token_2dlist, filtered_stemmed_pred_token_2dlist,
-                                               topk_dict['all'], score_dict, 'all')
-                # compute all the metrics and update the score_dict for present keyphrase
-                score_dict = update_score_dict(present_unique_stemmed_trg_token_2dlist,
-                                               present_filtered_stemmed_pred_token_2dlist,
-                                               topk_dict['present'], score_dict, 'present')
-                # compute all the metrics and update the score_dict for present keyphrase
-                score_dict = update_score_dict(absent_unique_stemmed_trg_token_2dlist,
-                                               absent_filtered_stemmed_pred_token_2dlist,
-                                               topk_dict['absent'], score_dict, 'absent')
-        if opt.export_filtered_pred:
-            final_pred_str_list = []
-            for word_list in filtered_stemmed_pred_token_2dlist:
-                final_pred_str_list.append(' '.join(word_list))
-            pred_print_out = ';'.join(final_pred_str_list) + '\n'
-            pred_output_file.write(pred_print_out)
+    counts = defaultdict(lambda: 0)
+    if opt.tune_f1_v:
+        score_dict = None
+    else:
+        f1_dict = None
+
+    # the stemmed and separated targets of the test set, they do not change between the evaluations of new predictions
+    golds = None
+    if opt.gold_cache_path:
+        gold_key = gold_cache_key(opt)
+        golds = load_gold_cache(opt.gold_cache_path, gold_key)
+        if golds is not None:
+            print("Loaded {} prepared documents from {}".format(len(golds), opt.gold_cache_path))
+    keep_gold = bool(opt.gold_cache_path) and golds is None
+    new_golds = []
+
+    chunks = iter_document_chunks(src_file_path, trg_file_path, pred_file_path, opt.chunk_size, golds)
+    if opt.num_workers > 1:
+        # the chunks are evaluated by the workers and merged in the order of the documents
+        pool = multiprocessing.Pool(opt.num_workers, initializer=_init_worker,
+                                    initargs=(opt, topk_dict, present_absent_segmenter, keep_gold))
+        chunk_results = _iter_pool_results(pool, chunks)
+    else:
+        pool = None
+        chunk_results = (evaluate_chunk_documents(chunk, topk_dict, keep_gold) for chunk in chunks)
+    for doc_results, chunk_score_dict in chunk_results:
+        if chunk_score_dict is not None:
+            for k, v in chunk_score_dict.items():
+                score_dict[k].extend(v)
+        for doc_result in doc_results:
+            merge_document_result(doc_result, counts, f1_dict)
+            if opt.export_filtered_pred:
+                pred_output_file.write(doc_result['filtered_pred'])
+            if keep_gold:
+                new_golds.append(doc_result['gold'])
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if keep_gold:
+        save_gold_cache(opt.gold_cache_path, gold_key, new_golds)
+
+    total_num_src = counts['total_num_src']
+    total_num_src_with_present_keyphrases = counts['total_num_src_with_present_keyphrases']
+    total_num_src_with_absent_keyphrases = counts['total_num_src_with_absent_keyphrases']
+    total_num_predictions = counts['total_num_predictions']
+    total_num_unique_predictions = counts['total_num_unique_predictions']
+    present_num_predictions = counts['present_num_predictions']
+    present_num_unique_predictions = counts['present_num_unique_predictions']
+    absent_num_predictions = counts['absent_num_predictions']
+    absent_num_unique_predictions = counts['absent_num_unique_predictions']
+    total_num_present_filtered_predictions = counts['total_num_present_filtered_predictions']
+    total_num_present_unique_targets = counts['total_num_present_unique_targets']
+    total_num_absent_filtered_predictions = counts['total_num_absent_filtered_predictions']
+    total_num_absent_unique_targets = counts['total_num_absent_unique_targets']
+    max_unique_targets = counts['max_unique_targets']
+    sum_incorrect_fraction_for_identifying_present = counts['sum_incorrect_fraction_for_identifying_present']
+    sum_incorrect_fraction_for_identifying_absent = counts['sum_incorrect_fraction_for_identifying_absent']
 
     if opt.export_filtered_pred:
         pred_output_file.close()
 
+    print("Stem cache: {} hits, {} misses, hit rate {:.3f}".format(stem_cache.hits, stem_cache.misses,
+                                                                    stem_cache.hit_rate()))
+    if opt.stem_cache_path:
+        stem_cache.save(opt.stem_cache_path)
+
     if opt.tune_f1_v:
         v_all = find_v(f1_dict, total_num_src, topk_dict['all'], 'all')
         print("V for all {}".format(v_all))
@@ -7,7 +7,9 @@ from pykp.utils.masked_loss import masked_cross_entropy
 from utils.statistics import LossStatistics
 from utils.string_helper import *
 from utils.functions import time_since
-from pykp.utils.label_assign import hungarian_assign, optimal_transport_assign
+from pykp.utils.assign_solver import get_hungarian_solver
+from pykp.utils.label_assign import hungarian_assign, optimal_transport_assign_set
+from pykp.utils.prefetcher import BatchPrefetcher
 import matplotlib.pyplot as plt
 
 EPS = 1e-8
@@ -21,7 +23,7 @@ def evaluate_loss(data_loader, model, opt):
     forward_time_total = 0.0
 
     with torch.no_grad():
-        for batch_i, batch in enumerate(data_loader):
+        for batch_i, batch in enumerate(BatchPrefetcher(data_loader, opt.device)):
             src, src_lens, src_mask, src_oov, oov_lists, src_str_list, \
             trg_str_2dlist, trg, trg_oov, trg_lens, trg_mask, _, = batch
 
@@ -34,7 +36,9 @@ def evaluate_loss(data_loader, model, opt):
             start_time = time.time()
             if opt.fix_kp_num_len:
                 memory_bank = model.encoder(src, src_lens, src_mask)
-                state = model.decoder.init_state(memory_bank, src_mask)
+                memory = model.decoder.prepare_memory(memory_bank)
+                state = model.decoder.init_state(memory_bank, src_mask, max_decode_length=opt.assign_steps,
+                                                 memory=memory)
                 control_embed = model.decoder.forward_seg(state)
 
                 y_t_init = target.new_ones(batch_size, opt.max_kp_num, 1) * word2idx[io.BOS_WORD]
@@ -56,99 +60,59 @@ def evaluate_loss(data_loader, model, opt):
                         mid_idx = opt.max_kp_num // 2
 
                         if opt.use_optimal_transport:
-                            background = torch.tensor([word2idx[io.NULL_WORD]] + 
-                                                      [word2idx[io.PAD_WORD]] * (opt.max_kp_len - 1)).to(opt.device)
-                            bg_mask = torch.tensor([1] + [0] * (opt.max_kp_len - 1)).to(opt.device)
-
-                            pre_targets, pre_trg_masks, ab_targets, ab_trg_masks = [], [], [], []
-                            pre_has_null, ab_has_null = [False] * batch_size, [False] * batch_size
-
-                            for b in range(batch_size):
-                                pre_target, pre_trg_mask, ab_target, ab_trg_mask = [], [], [], []
-
-                                for t in range(mid_idx):
-                                    if any(target[b, t] != background): # 去掉null kp，只保留真实的target kp
-                                        pre_target.append(list(target[b, t]))
-                                        pre_trg_mask.append(list(trg_mask[b, t]))
-                                
-                                if len(pre_target) != opt.max_kp_num // 2:
-                                    pre_has_null[b] = True
-                                    pre_target.append(list(background))  # 补上一个null kp作为学习的目标
-                                    pre_trg_mask.append(list(bg_mask))
-    
-                                pre_targets.append(torch.tensor(pre_target).to(opt.device))
-                                pre_trg_masks.append(torch.tensor(pre_trg_mask).to(opt.device))
-
-                                for t in range(mid_idx, opt.max_kp_num):
-                                    if any(target[b, t] != background):
-                                        ab_target.append(list(target[b, t]))
-                                        ab_trg_mask.append(list(trg_mask[b, t]))
-                                
-                                if len(ab_target) != opt.max_kp_num // 2:
-                                    ab_has_null[b] = True
-                                    ab_target.append(list(background))  # 补上一个null kp作为学习的目标
-                                    ab_trg_mask.append(list(bg_mask))
-
-                                ab_targets.append(torch.tensor(ab_target).to(opt.device))
-                                ab_trg_masks.append(torch.tensor(ab_trg_mask).to(opt.device))
-
-                            _, pre_reorder_cols, _ = optimal_transport_assign(
-                                opt, decoder_dists[:, :mid_idx], 
-                                pre_targets, 
-                                has_null=pre_has_null
+                            background = target.new_tensor([word2idx[io.NULL_WORD]] +
+                                                            [word2idx[io.PAD_WORD]] * (opt.max_kp_len - 1))
+                            bg_mask = trg_mask.new_tensor([1] + [0] * (opt.max_kp_len - 1))
+
+                            target[:, :mid_idx], trg_mask[:, :mid_idx], _, _ = optimal_transport_assign_set(
+                                opt, decoder_dists[:, :mid_idx],
+                                target[:, :mid_idx], trg_mask[:, :mid_idx],
+                                background, bg_mask
                             )
-                            
-                            _, ab_reorder_cols, _ = optimal_transport_assign(
+
+                            target[:, mid_idx:], trg_mask[:, mid_idx:], _, _ = optimal_transport_assign_set(
                                 opt, decoder_dists[:, mid_idx:],
-                                ab_targets,
-                                has_null=ab_has_null
+                                target[:, mid_idx:], trg_mask[:, mid_idx:],
+                                background, bg_mask
                             )
                             
-                            new_pre_targets, new_pre_trg_masks, new_ab_targets, new_ab_trg_masks = [], [], [], []
-                            for b in range(batch_size):
-                                new_pre_targets.append(pre_targets[b][pre_reorder_cols[b]])
-                                new_pre_trg_masks.append(pre_trg_masks[b][pre_reorder_cols[b]])
-                                new_ab_targets.append(ab_targets[b][ab_reorder_cols[b]])
-                                new_ab_trg_masks.append(ab_trg_masks[b][ab_reorder_cols[b]])
-
-                            target[:, :mid_idx] = torch.stack(new_pre_targets, axis=0)
-                            trg_mask[:, :mid_idx] = torch.stack(new_pre_trg_masks, axis=0)
-
-                            target[:, mid_idx:] = torch.stack(new_ab_targets, axis=0)
-                            trg_mask[:, mid_idx:] = torch.stack(new_ab_trg_masks, axis=0)
-                            
                         else:
                             pre_reorder_index = hungarian_assign(decoder_dists[:, :mid_idx],
                                                                 target[:, :mid_idx, :opt.assign_steps],
                                                                 ignore_indices=[word2idx[io.NULL_WORD],
-                                                                                word2idx[io.PAD_WORD]])
+                                                                                word2idx[io.PAD_WORD]],
+                                                                solver=get_hungarian_solver(opt))
                             target[:, :mid_idx] = target[:, :mid_idx][pre_reorder_index]
                             trg_mask[:, :mid_idx] = trg_mask[:, :mid_idx][pre_reorder_index]
 
                             ab_reorder_index = hungarian_assign(decoder_dists[:, mid_idx:],
                                                                 target[:, mid_idx:, :opt.assign_steps],
                                                                 ignore_indices=[word2idx[io.NULL_WORD],
-                                                                                word2idx[io.PAD_WORD]])
+                                                                                word2idx[io.PAD_WORD]],
+                                                                solver=get_hungarian_solver(opt))
                             target[:, mid_idx:] = target[:, mid_idx:][ab_reorder_index]
                             trg_mask[:, mid_idx:] = trg_mask[:, mid_idx:][ab_reorder_index]
                     else:
                         reorder_index = hungarian_assign(decoder_dists, target[:, :, :opt.assign_steps],
                                                          [word2idx[io.NULL_WORD],
-                                                          word2idx[io.PAD_WORD]])
+                                                          word2idx[io.PAD_WORD]],
+                                                         solver=get_hungarian_solver(opt))
                         target = target[reorder_index]
                         trg_mask = trg_mask[reorder_index]
 
-                state = model.decoder.init_state(memory_bank, src_mask)  # refresh the state
+                state = model.decoder.init_state(memory_bank, src_mask, memory=memory)  # refresh the state
                 input_tgt = torch.cat([y_t_init, target[:, :, :-1]], dim=-1)
                 input_tgt = input_tgt.masked_fill(input_tgt.gt(opt.vocab_size - 1), word2idx[io.UNK_WORD])
-                decoder_dist, attention_dist = model.decoder(input_tgt, state, src_oov, max_num_oov, control_embed)
+                decoder_dist, attention_dist = model.decoder(input_tgt, state, src_oov, max_num_oov, control_embed,
+                                                             target=target if opt.sparse_copy_loss else None)
 
             else:
                 y_t_init = trg.new_ones(batch_size, 1) * word2idx[io.BOS_WORD]  # [batch_size, 1]
                 input_tgt = torch.cat([y_t_init, trg[:, :-1]], dim=-1)
                 memory_bank = model.encoder(src, src_lens, src_mask)
                 state = model.decoder.init_state(memory_bank, src_mask)
-                decoder_dist, attention_dist = model.decoder(input_tgt, state, src_oov, max_num_oov)
+                decoder_dist, attention_dist = model.decoder(input_tgt, state, src_oov, max_num_oov,
+                                                             target=target if opt.sparse_copy_loss else None)
 
             if opt.adaptive_lr_scale:
                 # select the correctly predicted slots
@@ -247,7 +211,8 @@ def evaluate_loss(data_loader, model, opt):
                         target[:, :mid_idx].reshape(batch_size, -1),
                         trg_mask[:, :mid_idx].reshape(batch_size, -1),
                         loss_scales=[opt.loss_scale_pre],
-                        scale_indices=[word2idx[io.NULL_WORD]])
+                        scale_indices=[word2idx[io.NULL_WORD]],
+                        gathered=opt.sparse_copy_loss, log_probs=opt.sparse_copy_loss)
                     
                     ab_loss = masked_cross_entropy(
                         decoder_dist_reshape[:, mid_idx:]
@@ -255,7 +220,8 @@ def evaluate_loss(data_loader, model, opt):
                         target[:, mid_idx:].reshape(batch_size, -1),
                         trg_mask[:, mid_idx:].reshape(batch_size, -1),
                         loss_scales=[opt.loss_scale_ab],
-                        scale_indices=[word2idx[io.NULL_WORD]])
+                        scale_indices=[word2idx[io.NULL_WORD]],
+                        gathered=opt.sparse_copy_loss, log_probs=opt.sparse_copy_loss)
                     
                     if opt.adaptive_lr_scale:
                         pre_loss = pre_loss.reshape(batch_size, opt.max_kp_num//2, opt.max_kp_len)
@@ -272,9 +238,11 @@ def evaluate_loss(data_loader, model, opt):
                 else:
                     loss = masked_cross_entropy(decoder_dist, target.reshape(batch_size, -1),
                                                 trg_mask.reshape(batch_size, -1),
-                                                loss_scales=[opt.loss_scale], scale_indices=[word2idx[io.NULL_WORD]])
+                                                loss_scales=[opt.loss_scale], scale_indices=[word2idx[io.NULL_WORD]],
+                                                gathered=opt.sparse_copy_loss, log_probs=opt.sparse_copy_loss)
             else:
-                loss = masked_cross_entropy(decoder_dist, target, trg_mask)
+                loss = masked_cross_entropy(decoder_dist, target, trg_mask, gathered=opt.sparse_copy_loss,
+                                            log_probs=opt.sparse_copy_loss)
             loss_compute_time = time_since(start_time)
             loss_compute_time_total += loss_compute_time
 
@@ -294,7 +262,7 @@ def evaluate_greedy_generator(data_loader, generator, opt):
         idx2word = opt.vocab['idx2word']
         start_time = time.time()
         pre_null_ratio, ab_null_ratio = [], []
-        for batch_i, batch in enumerate(data_loader):
+        for batch_i, batch in enumerate(BatchPrefetcher(data_loader, opt.device)):
             if (batch_i + 1) % interval == 0:
                 logging.info("Batch %d: Time for running beam search on %d batches : %.1f" % (
                     batch_i + 1, interval, time_since(start_time)))
@@ -94,7 +94,7 @@ class SequenceGenerator(object):
         :param src: a LongTensor containing the word indices of source sentences, [batch, src_seq_len], with oov words replaced by unk idx
         :param src_lens: a list containing the length of src sequences for each batch, with len=batch
         :param src_oov: a LongTensor containing the word indices of source sentences, [batch, src_seq_len], contains the index of oov words (used by copy)
-        :param src_mask: a FloatTensor, [batch, src_seq_len]
+        :param src_mask: a BoolTensor, [batch, src_seq_len]
         :param oov_lists: list of oov words (idx2word) for each batch, len=batch
         :param word2idx: a dictionary
         """
@@ -111,7 +111,7 @@ class SequenceGenerator(object):
         src_mask = src_mask.repeat(beam_size, 1)  # [batch * beam_size, src_seq_len]
         src_oov = src_oov.repeat(self.beam_size, 1)  # [batch * beam_size, src_seq_len]
 
-        state = self.model.decoder.init_state(memory_bank, src_mask)
+        state = self.model.decoder.init_state(memory_bank, src_mask, max_decode_length=self.max_sequence_length)
 
         # exclusion_list = ["<t>", "</t>", "."]
         exclusion_tokens = set([word2idx[t]
@@ -16,7 +16,7 @@ class SetGenerator(object):
         :param src: a LongTensor containing the word indices of source sentences, [batch, src_seq_len], with oov words replaced by unk idx
         :param src_lens: a list containing the length of src sequences for each batch, with len=batch
         :param src_oov: a LongTensor containing the word indices of source sentences, [batch, src_seq_len], contains the index of oov words (used by copy)
-        :param src_mask: a FloatTensor, [batch, src_seq_len]
+        :param src_mask: a BoolTensor, [batch, src_seq_len]
         :param oov_lists: list of oov words (idx2word) for each batch, len=batch
         :param word2idx: a dictionary
         """
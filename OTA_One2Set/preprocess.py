@@ -1,21 +1,32 @@
 import argparse
 import logging
+import multiprocessing
 import os
 from collections import Counter
+import numpy as np
 import torch
 
 import config
 import pykp.utils.io as io
-from utils.functions import read_src_and_trg_files
+from pykp.utils.mmap_dataset import ShardedMmapExampleWriter, merge_mmap_shards, write_mmap_examples
+from utils.functions import iter_src_and_trg_files, read_src_and_trg_files, iter_src_and_trg_lines, \
+    line_aligned_byte_ranges, count_lines_in_range, find_line_offsets, iter_lines_in_range
 
 
-def build_vocab(tokenized_src_trg_pairs):
+def count_tokens(tokenized_src_trg_pairs):
     token_freq_counter = Counter()
     for src_word_list, trg_word_lists in tokenized_src_trg_pairs:
         token_freq_counter.update(src_word_list)
         for word_list in trg_word_lists:
             token_freq_counter.update(word_list)
+    return token_freq_counter
+
+
+def build_vocab(tokenized_src_trg_pairs):
+    return build_vocab_from_counter(count_tokens(tokenized_src_trg_pairs))
+
 
+def build_vocab_from_counter(token_freq_counter):
     # Discard special tokens if already present
     special_tokens = [io.PAD_WORD, io.UNK_WORD, io.BOS_WORD, io.EOS_WORD, io.SEP_WORD, io.PEOS_WORD,
                       io.NULL_WORD]
@@ -45,6 +56,18 @@ def build_vocab(tokenized_src_trg_pairs):
     return vocab
 
 
+def save_examples(examples, data_path, mode, opt):
+    """
+    :param data_path: the split without suffix, e.g. `save_data_dir/train.one2many`
+    """
+    if opt.data_format == 'mmap':
+        logging.info("Dumping %s to disk: %s" % (mode, data_path + '.mmap'))
+        write_mmap_examples(examples, data_path + '.mmap', mode, opt.vocab_size)
+    else:
+        logging.info("Dumping %s to disk: %s" % (mode, data_path + '.pt'))
+        torch.save(examples, open(data_path + '.pt', 'wb'))
+
+
 def main(opt):
     # Tokenize train_src and train_trg, return a list of tuple, (src_word_list, [trg_1_word_list, trg_2_word_list, ...])
     tokenized_train_pairs = read_src_and_trg_files(opt.train_src, opt.train_trg, is_train=True,
@@ -61,34 +84,133 @@ def main(opt):
     if not opt.one2many:
         # saving  one2one datasets
         train_one2one = io.build_dataset(tokenized_train_pairs, opt, mode='one2one')
-        logging.info("Dumping train one2one to disk: %s" % (opt.save_data_dir + '/train.one2one.pt'))
-        torch.save(train_one2one, open(opt.save_data_dir + '/train.one2one.pt', 'wb'))
+        save_examples(train_one2one, opt.save_data_dir + '/train.one2one', 'one2one', opt)
         len_train_one2one = len(train_one2one)
         del train_one2one
 
         valid_one2one = io.build_dataset(tokenized_valid_pairs, opt, mode='one2one')
-        logging.info("Dumping valid to disk: %s" % (opt.save_data_dir + '/valid.one2one.pt'))
-        torch.save(valid_one2one, open(opt.save_data_dir + '/valid.one2one.pt', 'wb'))
+        save_examples(valid_one2one, opt.save_data_dir + '/valid.one2one', 'one2one', opt)
 
         logging.info('#pairs of train_one2one  = %d' % len_train_one2one)
         logging.info('#pairs of valid_one2one  = %d' % len(valid_one2one))
     else:
         # saving  one2many datasets
         train_one2many = io.build_dataset(tokenized_train_pairs, opt, mode='one2many')
-        logging.info("Dumping train one2many to disk: %s" % (opt.save_data_dir + '/train.one2many.pt'))
-        torch.save(train_one2many, open(opt.save_data_dir + '/train.one2many.pt', 'wb'))
+        save_examples(train_one2many, opt.save_data_dir + '/train.one2many', 'one2many', opt)
         len_train_one2many = len(train_one2many)
         del train_one2many
 
         valid_one2many = io.build_dataset(tokenized_valid_pairs, opt, mode='one2many')
-        logging.info("Dumping valid to disk: %s" % (opt.save_data_dir + '/valid.one2many.pt'))
-        torch.save(valid_one2many, open(opt.save_data_dir + '/valid.one2many.pt', 'wb'))
+        save_examples(valid_one2many, opt.save_data_dir + '/valid.one2many', 'one2many', opt)
 
         logging.info('#pairs of train_one2many = %d' % len_train_one2many)
         logging.info('#pairs of valid_one2many = %d' % len(valid_one2many))
     logging.info('Done!')
 
 
+def main_streaming(opt):
+    """
+    Same outputs as main, without holding the corpus in memory: the first pass over the files counts the vocabulary,
+    the second pass builds the examples one by one and writes them to disk shard by shard
+    """
+    assert opt.data_format == 'mmap', "-streaming only supports -data_format mmap"
+
+    vocab = build_vocab(iter_src_and_trg_files(opt.train_src, opt.train_trg, is_train=True,
+                                               remove_title_eos=opt.remove_title_eos))
+    opt.vocab = vocab
+
+    logging.info("Dumping dict to disk: %s" % opt.save_data_dir + '/vocab.pt')
+    torch.save(vocab, open(opt.save_data_dir + '/vocab.pt', 'wb'))
+
+    mode = 'one2many' if opt.one2many else 'one2one'
+    for split, src_file, trg_file, is_train in [('train', opt.train_src, opt.train_trg, True),
+                                                ('valid', opt.valid_src, opt.valid_trg, False)]:
+        data_path = opt.save_data_dir + '/%s.%s.mmap' % (split, mode)
+        logging.info("Dumping %s %s to disk: %s" % (split, mode, data_path))
+        tokenized_pairs = iter_src_and_trg_files(src_file, trg_file, is_train=is_train,
+                                                 remove_title_eos=opt.remove_title_eos)
+        with ShardedMmapExampleWriter(data_path, mode, opt.vocab_size, opt.shard_size) as writer:
+            for example in io.iter_dataset(tokenized_pairs, opt, mode=mode):
+                writer.write(example)
+        logging.info('#pairs of %s_%s = %d (merged from %d shards)' % (
+            split, mode, writer.num_examples, len(writer.shards)))
+    logging.info('Done!')
+
+
+_worker_opt = None
+
+
+def _init_worker(opt):
+    global _worker_opt
+    _worker_opt = opt
+
+
+def _iter_shard_pairs(shard, is_train):
+    src_file, src_range, trg_file, trg_range = shard
+    return iter_src_and_trg_lines(iter_lines_in_range(src_file, *src_range),
+                                  iter_lines_in_range(trg_file, *trg_range),
+                                  is_train=is_train, remove_title_eos=_worker_opt.remove_title_eos)
+
+
+def _count_shard_tokens(shard):
+    return count_tokens(_iter_shard_pairs(shard, is_train=True))
+
+
+def _write_shard(shard, is_train, data_path, mode):
+    return write_mmap_examples(io.iter_dataset(_iter_shard_pairs(shard, is_train), _worker_opt, mode=mode),
+                               data_path, mode, _worker_opt.vocab_size)
+
+
+def split_src_and_trg_files(pool, src_file, trg_file, n_shards):
+    """
+    Split a pair of src/trg files into shards of consecutive lines
+    :return: a list of (src_file, src byte range, trg_file, trg byte range) covering the same lines in the two files
+    """
+    src_ranges = line_aligned_byte_ranges(src_file, n_shards)
+    n_lines = pool.starmap(count_lines_in_range, [(src_file, start, end) for start, end in src_ranges])
+    first_lines = np.cumsum([0] + n_lines[:-1]).tolist()
+    trg_starts = find_line_offsets(trg_file, first_lines)
+    trg_ranges = list(zip(trg_starts, trg_starts[1:] + [os.path.getsize(trg_file)]))
+    return [(src_file, src_range, trg_file, trg_range) for src_range, trg_range in zip(src_ranges, trg_ranges)]
+
+
+def main_parallel(opt):
+    """
+    Same outputs as main_streaming, computed by opt.num_workers processes on line aligned byte range shards.
+    The token counters of the shards are merged in the order of the shards, so that the words with the same frequency
+    keep the order of their first occurrence and word2idx is the same as in a single process.
+    The shards are only the unit of work of the pool, they are merged into a single split on disk
+    """
+    assert opt.data_format == 'mmap', "-num_workers > 1 only supports -data_format mmap"
+    n_shards = opt.num_workers * 4  # more shards than workers, to balance the load
+
+    with multiprocessing.Pool(opt.num_workers, initializer=_init_worker, initargs=(opt,)) as pool:
+        train_shards = split_src_and_trg_files(pool, opt.train_src, opt.train_trg, n_shards)
+        valid_shards = split_src_and_trg_files(pool, opt.valid_src, opt.valid_trg, n_shards)
+        token_freq_counter = Counter()
+        for shard_counter in pool.imap(_count_shard_tokens, train_shards):
+            token_freq_counter.update(shard_counter)
+
+    vocab = build_vocab_from_counter(token_freq_counter)
+    opt.vocab = vocab
+
+    logging.info("Dumping dict to disk: %s" % opt.save_data_dir + '/vocab.pt')
+    torch.save(vocab, open(opt.save_data_dir + '/vocab.pt', 'wb'))
+
+    mode = 'one2many' if opt.one2many else 'one2one'
+    # the workers are started again to receive the vocab
+    with multiprocessing.Pool(opt.num_workers, initializer=_init_worker, initargs=(opt,)) as pool:
+        for split, shards, is_train in [('train', train_shards, True), ('valid', valid_shards, False)]:
+            data_path = opt.save_data_dir + '/%s.%s.mmap' % (split, mode)
+            logging.info("Dumping %s %s to disk: %s" % (split, mode, data_path))
+            shard_names = ['shard_%05d' % i for i in range(len(shards))]
+            pool.starmap(_write_shard, [(shard, is_train, os.path.join(data_path, name), mode)
+                                        for shard, name in zip(shards, shard_names)])
+            num_examples = merge_mmap_shards(data_path, mode, opt.vocab_size, shard_names)
+            logging.info('#pairs of %s_%s = %d (merged from %d shards)' % (split, mode, num_examples, len(shards)))
+    logging.info('Done!')
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='preprocess.py',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -98,10 +220,11 @@ if __name__ == "__main__":
 
     logging = config.init_logging(log_file=opt.log_path + "/output.log", stdout=True)
 
+    suffix = '.mmap' if opt.data_format == 'mmap' else '.pt'
     if not opt.one2many:
-        test_exists = os.path.join(opt.save_data_dir, "train.one2one.pt")
+        test_exists = os.path.join(opt.save_data_dir, "train.one2one" + suffix)
     else:
-        test_exists = os.path.join(opt.save_data_dir, "train.one2many.pt")
+        test_exists = os.path.join(opt.save_data_dir, "train.one2many" + suffix)
     if os.path.exists(test_exists):
         logging.info("file exists %s, exit! " % test_exists)
         exit()
@@ -110,4 +233,9 @@ if __name__ == "__main__":
     opt.train_trg = opt.data_dir + '/train_trg.txt'
     opt.valid_src = opt.data_dir + '/valid_src.txt'
     opt.valid_trg = opt.data_dir + '/valid_trg.txt'
-    main(opt)
+    if opt.num_workers > 1:
+        main_parallel(opt)
+    elif opt.streaming:
+        main_streaming(opt)
+    else:
+        main(opt)
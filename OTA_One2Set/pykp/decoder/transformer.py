@@ -6,19 +6,20 @@ import torch
 import torch.nn as nn
 from pykp.modules.multi_head_attn import MultiHeadAttention
 from pykp.utils.seq2seq_state import TransformerState
+from pykp.utils.masked_loss import EPS
 import torch.nn.functional as F
 import math
 
 
 class TransformerSeq2SeqDecoderLayer(nn.Module):
-    def __init__(self, d_model=512, n_head=8, dim_ff=2048, dropout=0.1, layer_idx=None,
-                 fix_kp_num_len=False, max_kp_num=20):
+    def __init__(self, d_model=512, n_head=8, dim_ff=2048, dropout=0.1, layer_idx=None, attn_impl='einsum'):
         """
         :param int d_model: 输入、输出的维度
         :param int n_head: 多少个head，需要能被d_model整除
         :param int dim_ff:
         :param float dropout:
         :param int layer_idx: layer的编号
+        :param str attn_impl: attention的实现，einsum或sdpa
         """
         super().__init__()
         self.d_model = d_model
@@ -27,11 +28,10 @@ class TransformerSeq2SeqDecoderLayer(nn.Module):
         self.dropout = dropout
         self.layer_idx = layer_idx  # 记录layer的层索引，以方便获取state的信息
 
-        self.self_attn = MultiHeadAttention(d_model, n_head, dropout, layer_idx,
-                                            fix_kp_num_len, max_kp_num)
+        self.self_attn = MultiHeadAttention(d_model, n_head, dropout, layer_idx, attn_impl)
         self.self_attn_layer_norm = nn.LayerNorm(d_model)
 
-        self.encoder_attn = MultiHeadAttention(d_model, n_head, dropout, layer_idx)
+        self.encoder_attn = MultiHeadAttention(d_model, n_head, dropout, layer_idx, attn_impl)
         self.encoder_attn_layer_norm = nn.LayerNorm(d_model)
 
         self.ffn = nn.Sequential(nn.Linear(self.d_model, self.dim_ff),
@@ -42,14 +42,17 @@ class TransformerSeq2SeqDecoderLayer(nn.Module):
 
         self.final_layer_norm = nn.LayerNorm(self.d_model)
 
-    def forward(self, x, encoder_output, encoder_mask=None, self_attn_mask=None, state=None):
+    def forward(self, x, encoder_output, encoder_mask=None, self_attn_mask=None, state=None, need_weights=True,
+                num_blocks=1):
         """
         :param x: (batch, seq_len, dim), decoder端的输入
         :param encoder_output: (batch,src_seq_len,dim), encoder的输出
         :param encoder_mask: batch,src_seq_len, 为1的地方需要attend
         :param self_attn_mask: seq_len, seq_len，下三角的mask矩阵，只在训练时传入
         :param TransformerState state: 只在inference阶段传入
-        :return:
+        :param bool need_weights: 是否返回encoder attention的权重，只有最后一层的权重会用于copy
+        :param int num_blocks: decoder端的序列由多少个互不attend的等长块组成，大于1时self_attn_mask为块内的mask
+        :return: (batch, seq_len, dim); encoder attention的权重，need_weights为False时为None
         """
 
         # self attention part
@@ -59,7 +62,9 @@ class TransformerSeq2SeqDecoderLayer(nn.Module):
                               key=x,
                               value=x,
                               attn_mask=self_attn_mask,
-                              state=state)
+                              state=state,
+                              need_weights=False,
+                              num_blocks=num_blocks)
 
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
@@ -71,7 +76,8 @@ class TransformerSeq2SeqDecoderLayer(nn.Module):
                                            key=encoder_output,
                                            value=encoder_output,
                                            key_mask=encoder_mask,
-                                           state=state)
+                                           state=state,
+                                           need_weights=need_weights)
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
 
@@ -87,7 +93,7 @@ class TransformerSeq2SeqDecoderLayer(nn.Module):
 class TransformerSeq2SeqDecoder(nn.Module):
     def __init__(self, embed, pos_embed,
                  d_model=512, num_layers=6, n_head=8, dim_ff=2048, dropout=0.1, copy_attn=False,
-                 fix_kp_num_len=False, max_kp_len=6, max_kp_num=20):
+                 fix_kp_num_len=False, max_kp_len=6, max_kp_num=20, attn_impl='einsum'):
         """
         :param embed: 输入token的embedding
         :param nn.Module pos_embed: 位置embedding
@@ -96,6 +102,7 @@ class TransformerSeq2SeqDecoder(nn.Module):
         :param int n_head: 多少个head
         :param int dim_ff: FFN 的中间大小
         :param float dropout: Self-Attention和FFN中的dropout的大小
+        :param str attn_impl: attention的实现，einsum或sdpa
         """
         super().__init__()
 
@@ -109,9 +116,9 @@ class TransformerSeq2SeqDecoder(nn.Module):
         self.dropout = dropout
 
         self.input_fc = nn.Linear(self.embed.embedding_dim, d_model)
-        self.layer_stacks = nn.ModuleList([TransformerSeq2SeqDecoderLayer(d_model, n_head, dim_ff, dropout, layer_idx,
-                                                                          fix_kp_num_len, max_kp_num)
-                                           for layer_idx in range(num_layers)])
+        self.layer_stacks = nn.ModuleList(
+            [TransformerSeq2SeqDecoderLayer(d_model, n_head, dim_ff, dropout, layer_idx, attn_impl)
+             for layer_idx in range(num_layers)])
         self.embed_scale = math.sqrt(d_model)
         self.layer_norm = nn.LayerNorm(d_model)
 
@@ -130,6 +137,8 @@ class TransformerSeq2SeqDecoder(nn.Module):
             self.control_code = nn.Embedding(max_kp_num, self.embed.embedding_dim)
             self.control_code.weight.data.uniform_(-0.1, 0.1)
             self.self_attn_mask = self._get_self_attn_mask(max_kp_num, max_kp_len)
+            # 训练时self attention按control code分块计算，为False时使用完整的mask（用于对比两者的结果）
+            self.block_self_attn = True
 
     @classmethod
     def from_opt(cls, opt, embed, pos_embed):
@@ -143,7 +152,8 @@ class TransformerSeq2SeqDecoder(nn.Module):
                    copy_attn=opt.copy_attention,
                    fix_kp_num_len=opt.fix_kp_num_len,
                    max_kp_len=opt.max_kp_len,
-                   max_kp_num=opt.max_kp_num)
+                   max_kp_num=opt.max_kp_num,
+                   attn_impl=opt.attn_impl)
 
     def forward_seg(self, state):
         encoder_output = state.encoder_output
@@ -155,11 +165,14 @@ class TransformerSeq2SeqDecoder(nn.Module):
 
         return control_embed
 
-    def forward(self, tokens, state, src_oov, max_num_oov, control_embed=None):
+    def forward(self, tokens, state, src_oov, max_num_oov, control_embed=None, target=None):
         """
         :param torch.LongTensor tokens: batch x tgt_len，decode的词
         :param TransformerState state: 用于记录encoder的输出以及decode状态的对象，可以通过init_state()获取
-        :return: bsz x max_len x vocab_size; 如果return_attention=True, 还会返回bsz x max_len x encode_length
+        :param torch.LongTensor target: 与tokens形状相同，扩展词表中的下标。不为None时只计算每个位置target的log概率，
+            不生成整个扩展词表上的分布，只用于计算loss
+        :return: bsz x max_len x vocab_size（给定target时为 bsz x max_len x 1 的log(p + EPS)）;
+            以及bsz x max_len x encode_length
         """
 
         encoder_output = state.encoder_output
@@ -184,19 +197,28 @@ class TransformerSeq2SeqDecoder(nn.Module):
             if self.self_attn_mask.device is not tokens.device:
                 self.self_attn_mask = self.self_attn_mask.to(tokens.device)
 
-            if kp_len > 1:  # training
+            if kp_len > 1 and self.block_self_attn:  # training
+                # 每个control code的序列只attend自己，self attention按max_kp_num个块分别计算，块内为下三角mask
+                self_attn_mask = self.self_attn_mask[:kp_len, :kp_len]
+                num_blocks = max_kp_num
+            elif kp_len > 1:
                 self_attn_mask = self.self_attn_mask
+                num_blocks = 1
             else:
+                # state中缓存的kv先按decode的步、再按slot排列
                 self_attn_mask = self.self_attn_mask.reshape(max_kp_num, self.max_kp_len, max_kp_num, self.max_kp_len)\
-                    [:, decode_length, :, :decode_length + 1] \
-                    .reshape(max_kp_num, max_kp_num * (decode_length + 1))
+                    [:, decode_length, :, :decode_length + 1].transpose(1, 2) \
+                    .reshape(max_kp_num, (decode_length + 1) * max_kp_num)
+                num_blocks = 1
 
             for layer in self.layer_stacks:
                 x, attn_dist = layer(x=x,
                                      encoder_output=encoder_output,
                                      encoder_mask=encoder_mask,
                                      self_attn_mask=self_attn_mask,
-                                     state=state
+                                     state=state,
+                                     need_weights=layer.layer_idx == self.num_layers - 1,
+                                     num_blocks=num_blocks
                                      )
         else:
             assert state.decode_length < tokens.size(1), "The decoded tokens in State should be less than tokens."
@@ -220,13 +242,17 @@ class TransformerSeq2SeqDecoder(nn.Module):
                                      encoder_output=encoder_output,
                                      encoder_mask=encoder_mask,
                                      self_attn_mask=self_attn_mask,
-                                     state=state
+                                     state=state,
+                                     need_weights=layer.layer_idx == self.num_layers - 1
                                      )
         x = self.layer_norm(x)  # batch, tgt_len, dim
         x = self.output_fc(x)
+        attn_dist = attn_dist[:, :, :, 0]
+
+        if target is not None:
+            return self._target_log_prob(x, attn_dist, target.reshape(batch_size, max_tgt_len), src_oov), attn_dist
 
         vocab_dist = F.softmax(self.output_layer(x), -1)
-        attn_dist = attn_dist[:, :, :, 0]
 
         if self.copy_attn:
             p_gen = self.p_gen_linear(x).sigmoid()
@@ -245,11 +271,46 @@ class TransformerSeq2SeqDecoder(nn.Module):
             assert final_dist.size() == torch.Size([batch_size, max_tgt_len, self.vocab_size])
         return final_dist, attn_dist
 
-    def init_state(self, encoder_output, encoder_mask):
+    def _target_log_prob(self, x, attn_dist, target, src_oov):
+        """
+        计算final_dist中target的log(p + EPS)而不生成final_dist：生成部分在log空间中由target的logit减去logsumexp得到，
+        copy概率为source中与target相同的词上的attention之和，两部分用logaddexp相加
+        :param x: batch x tgt_len x embed_dim, output_fc的输出
+        :param attn_dist: batch x tgt_len x src_len
+        :param target: batch x tgt_len, 扩展词表中的下标
+        :param src_oov: batch x src_len
+        :return: batch x tgt_len x 1
+        """
+        logits = self.output_layer(x)
+        in_vocab = target.lt(self.vocab_size).unsqueeze(2)
+        target_logit = logits.gather(2, target.unsqueeze(2).masked_fill(~in_vocab, 0))
+        vocab_log_prob = target_logit - torch.logsumexp(logits, dim=2, keepdim=True)
+        vocab_log_prob = vocab_log_prob.masked_fill(~in_vocab, -float('inf'))  # oov词只能copy
+        if not self.copy_attn:
+            return torch.logaddexp(vocab_log_prob, vocab_log_prob.new_tensor(math.log(EPS)))
+
+        p_gen_logit = self.p_gen_linear(x)
+        copy_prob = (attn_dist * src_oov.unsqueeze(1).eq(target.unsqueeze(2))).sum(2, keepdim=True)
+        return torch.logaddexp(F.logsigmoid(p_gen_logit) + vocab_log_prob,
+                               torch.log(torch.sigmoid(-p_gen_logit) * copy_prob + EPS))
+
+    def prepare_memory(self, encoder_output):
+        """
+        将encoder的输出投影为每一层encoder attention的key和value，由同一个encoder输出初始化的多个state可以共享
+        :param torch.FloatTensor encoder_output: bsz x max_len x d_model, encoder的输出
+        :return: (encoder_key, encoder_value), 每一层一个 bsz x max_len x d_model 的tensor
+        """
+        encoder_key = [layer.encoder_attn.k_proj(encoder_output) for layer in self.layer_stacks]
+        encoder_value = [layer.encoder_attn.v_proj(encoder_output) for layer in self.layer_stacks]
+        return encoder_key, encoder_value
+
+    def init_state(self, encoder_output, encoder_mask, max_decode_length=None, memory=None):
         """
         初始化一个TransformerState用于forward
         :param torch.FloatTensor encoder_output: bsz x max_len x d_model, encoder的输出
         :param torch.ByteTensor encoder_mask: bsz x max_len, 为1的位置需要attend。
+        :param int max_decode_length: 最多decode多少步，用于预分配kv buffer，fix_kp_num_len时默认为max_kp_len
+        :param tuple memory: prepare_memory(encoder_output)的结果，为None时在这里计算
         :return: TransformerState
         """
         if isinstance(encoder_output, torch.Tensor):
@@ -258,7 +319,16 @@ class TransformerSeq2SeqDecoder(nn.Module):
             encoder_output = encoder_output[0]  # 防止是LSTMEncoder的输出结果
         else:
             raise TypeError("Unsupported `encoder_output` for TransformerSeq2SeqDecoder")
-        state = TransformerState(encoder_output, encoder_mask, num_decoder_layer=self.num_layers)
+        if self.fix_kp_num_len:
+            state = TransformerState(encoder_output, encoder_mask, num_decoder_layer=self.num_layers,
+                                     max_decode_length=max_decode_length or self.max_kp_len,
+                                     num_slots=self.max_kp_num)
+        else:
+            state = TransformerState(encoder_output, encoder_mask, num_decoder_layer=self.num_layers,
+                                     max_decode_length=max_decode_length)
+        if memory is None:
+            memory = self.prepare_memory(encoder_output)
+        state.encoder_key, state.encoder_value = list(memory[0]), list(memory[1])
         return state
 
     @staticmethod
@@ -273,3 +343,37 @@ class TransformerSeq2SeqDecoder(nn.Module):
         for i in range(1, max_kp_num + 1):
             mask[i * max_kp_len:(i + 1) * max_kp_len, :i * max_kp_len] = 0
         return mask
+
+
+if __name__ == '__main__':
+    # 检查分块计算的self attention与使用完整mask的结果一致
+    from pykp.modules.position_embed import get_sinusoid_encoding_table
+
+    batch_size, src_len, vocab_size, d_model, max_kp_num, max_kp_len = 4, 50, 300, 64, 20, 6
+    for attn_impl in ['einsum', 'sdpa']:
+        torch.manual_seed(0)
+        embed = nn.Embedding(vocab_size, d_model, 0)
+        pos_embed = nn.Embedding.from_pretrained(get_sinusoid_encoding_table(100, d_model, padding_idx=0), freeze=True)
+        decoder = TransformerSeq2SeqDecoder(embed, pos_embed, d_model=d_model, num_layers=3, n_head=4, dim_ff=256,
+                                            dropout=0.0, copy_attn=True, fix_kp_num_len=True, max_kp_len=max_kp_len,
+                                            max_kp_num=max_kp_num, attn_impl=attn_impl)
+        encoder_output = torch.randn(batch_size, src_len, d_model)
+        src_lens = torch.randint(src_len // 2, src_len + 1, (batch_size,))
+        encoder_mask = torch.arange(src_len)[None] < src_lens[:, None]
+        src_oov = torch.randint(1, vocab_size + 1, (batch_size, src_len))  # 第vocab_size个词为oov
+        tokens = torch.randint(1, vocab_size, (batch_size, max_kp_num, max_kp_len))
+
+        results = {}
+        for block_self_attn in [True, False]:
+            decoder.block_self_attn = block_self_attn
+            decoder.zero_grad()
+            state = decoder.init_state(encoder_output, encoder_mask)
+            final_dist, attn_dist = decoder(tokens, state, src_oov, 1, decoder.forward_seg(state))
+            final_dist.clamp_min(1e-12).log().mean().backward()
+            results[block_self_attn] = [final_dist.detach(), attn_dist.detach()] + \
+                                       [p.grad.clone() for p in decoder.parameters() if p.grad is not None]
+
+        max_diff = max((block - dense).abs().max().item() for block, dense in zip(results[True], results[False]))
+        assert len(results[True]) == len(results[False]) and max_diff < 1e-5, max_diff
+        print('%s: block-sparse vs dense self attention, max difference of outputs and gradients %.2e' % (
+            attn_impl, max_diff))
@@ -10,13 +10,14 @@ from pykp.modules.multi_head_attn import MultiHeadAttention
 
 class TransformerSeq2SeqEncoderLayer(nn.Module):
     def __init__(self, d_model: int = 512, n_head: int = 8, dim_ff: int = 2048,
-                 dropout: float = 0.1):
+                 dropout: float = 0.1, attn_impl: str = 'einsum'):
         """
         Self-Attention的Layer，
         :param int d_model: input和output的输出维度
         :param int n_head: 多少个head，每个head的维度为d_model/n_head
         :param int dim_ff: FFN的维度大小
         :param float dropout: Self-attention和FFN的dropout大小，0表示不drop
+        :param str attn_impl: attention的实现，einsum或sdpa
         """
         super(TransformerSeq2SeqEncoderLayer, self).__init__()
         self.d_model = d_model
@@ -24,7 +25,7 @@ class TransformerSeq2SeqEncoderLayer(nn.Module):
         self.dim_ff = dim_ff
         self.dropout = dropout
 
-        self.self_attn = MultiHeadAttention(d_model, n_head, dropout)
+        self.self_attn = MultiHeadAttention(d_model, n_head, dropout, attn_impl=attn_impl)
         self.attn_layer_norm = nn.LayerNorm(d_model)
         self.ffn_layer_norm = nn.LayerNorm(d_model)
 
@@ -46,7 +47,8 @@ class TransformerSeq2SeqEncoderLayer(nn.Module):
         x, _ = self.self_attn(query=x,
                               key=x,
                               value=x,
-                              key_mask=mask)
+                              key_mask=mask,
+                              need_weights=False)
         x = F.dropout(x, p=self.dropout, training=self.training)
         x = residual + x
 
@@ -59,7 +61,8 @@ class TransformerSeq2SeqEncoderLayer(nn.Module):
         return x
 
 class TransformerSeq2SeqEncoder(nn.Module):
-    def __init__(self, embed, pos_embed=None, num_layers=6, d_model=512, n_head=8, dim_ff=2048, dropout=0.1):
+    def __init__(self, embed, pos_embed=None, num_layers=6, d_model=512, n_head=8, dim_ff=2048, dropout=0.1,
+                 attn_impl='einsum'):
         """
         基于Transformer的Encoder
         :param embed: encoder输入token的embedding
@@ -69,6 +72,7 @@ class TransformerSeq2SeqEncoder(nn.Module):
         :param int n_head: 多少个head
         :param int dim_ff: FFN中间的维度大小
         :param float dropout: Attention和FFN的dropout大小
+        :param str attn_impl: attention的实现，einsum或sdpa
         """
         super(TransformerSeq2SeqEncoder, self).__init__()
         self.embed = embed
@@ -81,7 +85,7 @@ class TransformerSeq2SeqEncoder(nn.Module):
         self.dropout = dropout
 
         self.input_fc = nn.Linear(self.embed.embedding_dim, d_model)
-        self.layer_stacks = nn.ModuleList([TransformerSeq2SeqEncoderLayer(d_model, n_head, dim_ff, dropout)
+        self.layer_stacks = nn.ModuleList([TransformerSeq2SeqEncoderLayer(d_model, n_head, dim_ff, dropout, attn_impl)
                                            for _ in range(num_layers)])
         self.layer_norm = nn.LayerNorm(d_model)
 
@@ -93,7 +97,8 @@ class TransformerSeq2SeqEncoder(nn.Module):
                    d_model=opt.d_model,
                    n_head=opt.n_head,
                    dim_ff=opt.dim_ff,
-                   dropout=opt.dropout)
+                   dropout=opt.dropout,
+                   attn_impl=opt.attn_impl)
 
     def forward(self, src, src_lens, src_mask):
         """
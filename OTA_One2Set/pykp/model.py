@@ -32,7 +32,7 @@ class Seq2SeqModel(nn.Module):
         :param trg: a LongTensor containing the word indices of target sentences, [batch, trg_seq_len]
         :param src_oov: a LongTensor containing the word indices of source sentences, [batch, src_seq_len], contains the index of oov words (used by copy)
         :param max_num_oov: int, max number of oov for each batch
-        :param src_mask: a FloatTensor, [batch, src_seq_len]
+        :param src_mask: a BoolTensor, [batch, src_seq_len]
         :return:
         """
         # Encoding
@@ -10,26 +10,31 @@ class MultiHeadAttention(nn.Module):
 
     """
     def __init__(self, d_model: int = 512, n_head: int = 8, dropout: float = 0.0, layer_idx: int = None,
-                 fix_kp_num_len=False, max_kp_num=20):
+                 attn_impl: str = 'einsum'):
+        """
+        :param str attn_impl: einsum: 逐步计算并返回所有head的attention权重;
+            sdpa: 调用F.scaled_dot_product_attention（有fused kernel时使用fused kernel，CPU上为math实现），
+            只返回第0个head的attention权重
+        """
         super(MultiHeadAttention, self).__init__()
         self.d_model = d_model
         self.n_head = n_head
         self.dropout = dropout
         self.head_dim = d_model // n_head
         self.layer_idx = layer_idx
+        self.attn_impl = attn_impl
         assert d_model % n_head == 0, "d_model should be divisible by n_head"
+        assert attn_impl in ('einsum', 'sdpa'), "attn_impl should be einsum or sdpa"
         self.scaling = self.head_dim ** -0.5
 
         self.q_proj = nn.Linear(d_model, d_model)
         self.k_proj = nn.Linear(d_model, d_model)
         self.v_proj = nn.Linear(d_model, d_model)
         self.out_proj = nn.Linear(d_model, d_model)
-
-        self.fix_kp_num_len = fix_kp_num_len
-        self.max_kp_num = max_kp_num
         self.reset_parameters()
 
-    def forward(self, query, key, value, key_mask=None, attn_mask=None, state=None):
+    def forward(self, query, key, value, key_mask=None, attn_mask=None, state=None, need_weights=True,
+                num_blocks=1):
         """
 
         :param query: batch x seq x dim
@@ -38,7 +43,11 @@ class MultiHeadAttention(nn.Module):
         :param key_mask: batch x seq 用于指示哪些key不要attend到；注意到mask为1的地方是要attend到的
         :param attn_mask: seq x seq, 用于mask掉attention map。 主要是用在训练时decoder端的self attention，下三角为1
         :param state: 过去的信息，在inference的时候会用到，比如encoder output、decoder的prev kv。这样可以减少计算。
-        :return:
+        :param bool need_weights: 为False时不返回attention权重，sdpa时也不再单独计算第0个head的权重
+        :param int num_blocks: self attention的序列由num_blocks个等长、互不attend的连续块组成（如set decoder中每个
+            control code的序列），每块单独计算attention，此时attn_mask为块内的 block_len x block_len 的mask
+        :return: batch x q_len x dim; attention权重 batch x q_len x k_len x n_head（sdpa时最后一维只有第0个head，
+            num_blocks>1时为 batch*num_blocks x block_len x block_len x n_head），need_weights为False时为None
         """
         assert key.size() == value.size()
         if state is not None:
@@ -48,37 +57,21 @@ class MultiHeadAttention(nn.Module):
         q = self.q_proj(query)  # batch x seq x dim
         q *= self.scaling
         k = v = None
-        prev_k = prev_v = None
 
         # 从state中取kv
-        if isinstance(state, TransformerState):  # 说明此时在inference阶段
-            if qkv_same:  # 此时在decoder self attention
-                prev_k = state.decoder_prev_key[self.layer_idx]
-                prev_v = state.decoder_prev_value[self.layer_idx]
-            else:  # 此时在decoder-encoder attention，直接将保存下来的key装载起来即可
-                k = state.encoder_key[self.layer_idx]
-                v = state.encoder_value[self.layer_idx]
+        if isinstance(state, TransformerState) and not qkv_same:
+            # 此时在decoder-encoder attention，直接将保存下来的key装载起来即可
+            k = state.encoder_key[self.layer_idx]
+            v = state.encoder_value[self.layer_idx]
 
         if k is None:
             k = self.k_proj(key)
             v = self.v_proj(value)
 
-        if prev_k is not None:
-            if self.fix_kp_num_len:
-                batch_size, max_len, d = prev_k.size()
-                prev_k = prev_k.reshape(batch_size, self.max_kp_num, -1, d)
-                prev_v = prev_v.reshape(batch_size, self.max_kp_num, -1, d)
-                k = torch.cat((prev_k, k.unsqueeze(-2)), dim=-2).reshape(batch_size, -1, d)
-                v = torch.cat((prev_v, v.unsqueeze(-2)), dim=-2).reshape(batch_size, -1, d)
-            else:
-                k = torch.cat((prev_k, k), dim=1)
-                v = torch.cat((prev_v, v), dim=1)
-
         # 更新state
         if isinstance(state, TransformerState):
-            if qkv_same:
-                state.decoder_prev_key[self.layer_idx] = k
-                state.decoder_prev_value[self.layer_idx] = v
+            if qkv_same:  # 此时在decoder self attention，新的kv写入state的buffer，attend到所有已decode的步
+                k, v = state.update_decoder_cache(self.layer_idx, k, v)
             else:
                 state.encoder_key[self.layer_idx] = k
                 state.encoder_value[self.layer_idx] = v
@@ -90,25 +83,71 @@ class MultiHeadAttention(nn.Module):
         k = k.reshape(batch_size, k_len, self.n_head, self.head_dim)
         v = v.reshape(batch_size, v_len, self.n_head, self.head_dim)
 
-        attn_weights = torch.einsum('bqnh,bknh->bqkn', q, k)  # bs,q_len,k_len,n_head
+        if num_blocks > 1:
+            # 块之间没有attention，拆成 batch*num_blocks 个短序列，代价从(num*len)^2降为num*len^2
+            assert q_len == k_len and key_mask is None, "Blocks are only supported in self attention without key_mask"
+            q = q.reshape(batch_size * num_blocks, q_len // num_blocks, self.n_head, self.head_dim)
+            k = k.reshape(batch_size * num_blocks, k_len // num_blocks, self.n_head, self.head_dim)
+            v = v.reshape(batch_size * num_blocks, v_len // num_blocks, self.n_head, self.head_dim)
 
-        if key_mask is not None:
-            _key_mask = ~key_mask[:, None, :, None].bool()  # batch,1,k_len,1
-            attn_weights = attn_weights.masked_fill(_key_mask, -float('inf'))
+        if self.attn_impl == 'sdpa':
+            output, attn_weights = self._sdpa_attention(q, k, v, key_mask, attn_mask, need_weights)
+        else:
+            attn_weights = torch.einsum('bqnh,bknh->bqkn', q, k)  # bs,q_len,k_len,n_head
 
-        if attn_mask is not None:
-            _attn_mask = attn_mask[None, :, :, None].eq(0)  # 1,q_len,k_len,n_head
-            attn_weights = attn_weights.masked_fill(_attn_mask, -float('inf'))
+            if key_mask is not None:
+                _key_mask = ~key_mask[:, None, :, None].bool()  # batch,1,k_len,1
+                attn_weights = attn_weights.masked_fill(_key_mask, -float('inf'))
 
-        attn_weights = F.softmax(attn_weights, dim=2)
-        attn_weights = F.dropout(attn_weights, p=self.dropout, training=self.training)
+            if attn_mask is not None:
+                _attn_mask = attn_mask[None, :, :, None].eq(0)  # 1,q_len,k_len,n_head
+                attn_weights = attn_weights.masked_fill(_attn_mask, -float('inf'))
+
+            attn_weights = F.softmax(attn_weights, dim=2)
+            attn_weights = F.dropout(attn_weights, p=self.dropout, training=self.training)
 
-        output = torch.einsum('bqkn,bknh->bqnh', attn_weights, v)  # batch,q_len,n_head,head_dim
+            output = torch.einsum('bqkn,bknh->bqnh', attn_weights, v)  # batch,q_len,n_head,head_dim
+            if not need_weights:
+                attn_weights = None
         output = output.reshape(batch_size, q_len, -1)
         output = self.out_proj(output)  # batch,q_len,dim
 
         return output, attn_weights
 
+    def _sdpa_attention(self, q, k, v, key_mask=None, attn_mask=None, need_weights=True):
+        """
+        key_mask和attn_mask合并为一个加性的bias后调用F.scaled_dot_product_attention。
+        fused kernel不返回attention权重，copy机制用到的第0个head的权重单独计算，dropout与其余head的输出独立采样
+
+        :param q: batch x q_len x n_head x head_dim, 已乘过scaling
+        :param k: batch x k_len x n_head x head_dim
+        :param v: batch x k_len x n_head x head_dim
+        :param bool need_weights: 为False时只调用fused kernel，不计算第0个head的权重
+        :return: batch x q_len x n_head x head_dim; batch x q_len x k_len x 1 或 None
+        """
+        q, k, v = q.transpose(1, 2), k.transpose(1, 2), v.transpose(1, 2)  # batch,n_head,len,head_dim
+
+        attn_bias = None
+        if key_mask is not None:
+            attn_bias = q.new_zeros(key_mask.size(0), 1, 1, key_mask.size(1))  # batch,1,1,k_len
+            attn_bias = attn_bias.masked_fill(~key_mask[:, None, None, :].bool(), -float('inf'))
+        if attn_mask is not None:
+            _attn_bias = q.new_zeros(attn_mask.size()).masked_fill(attn_mask.eq(0), -float('inf'))[None, None]
+            attn_bias = _attn_bias if attn_bias is None else attn_bias + _attn_bias  # batch,1,q_len,k_len
+
+        output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias,
+                                                dropout_p=self.dropout if self.training else 0.0, scale=1.0)
+        if not need_weights:
+            return output.transpose(1, 2), None
+
+        attn_weights = torch.matmul(q[:, :1], k[:, :1].transpose(2, 3))  # batch,1,q_len,k_len
+        if attn_bias is not None:
+            attn_weights = attn_weights + attn_bias
+        attn_weights = F.softmax(attn_weights, dim=-1)
+        attn_weights = F.dropout(attn_weights, p=self.dropout, training=self.training)
+
+        return output.transpose(1, 2), attn_weights.permute(0, 2, 3, 1)
+
     def reset_parameters(self):
         nn.init.xavier_uniform_(self.q_proj.weight)
         nn.init.xavier_uniform_(self.k_proj.weight)
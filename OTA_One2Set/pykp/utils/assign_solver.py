@@ -0,0 +1,230 @@
+"""
+Process based backend of `linear_sum_assignment` for the hungarian target assignment.
+The score tensor of a whole batch is copied to the host once, into a shared memory buffer that is reused
+across steps, and the per-instance problems are solved by a persistent pool of worker processes.
+"""
+
+import atexit
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+import torch
+from scipy.optimize import linear_sum_assignment
+
+__all__ = [
+    'HungarianSolver',
+    'get_hungarian_solver'
+]
+
+_solvers = {}
+_attached_shm = {}  # shared memory attached by the worker process, name -> SharedMemory
+
+
+def _attach(name):
+    if name not in _attached_shm:
+        if len(_attached_shm) > 16:  # buffers released by the main process
+            for shm in _attached_shm.values():
+                shm.close()
+            _attached_shm.clear()
+        _attached_shm[name] = shared_memory.SharedMemory(name=name)
+    return _attached_shm[name]
+
+
+def _solve_chunk(score_name, cols_name, shape, start, end):
+    batch_size, n_row, n_col = shape
+    score = np.ndarray(shape, dtype=np.float32, buffer=_attach(score_name).buf)
+    cols = np.ndarray((batch_size, min(n_row, n_col)), dtype=np.int64, buffer=_attach(cols_name).buf)
+    for b in range(start, end):
+        _, cols[b] = linear_sum_assignment(score[b], maximize=True)
+
+
+class _SharedBuffer:
+    def __init__(self, shape):
+        batch_size, n_row, n_col = shape
+        self.capacity = batch_size * n_row * n_col
+        self.score_shm = shared_memory.SharedMemory(create=True, size=self.capacity * 4)
+        self.cols_shm = shared_memory.SharedMemory(create=True, size=self.capacity * 8)
+
+    def views(self, shape):
+        batch_size, n_row, n_col = shape
+        score = np.ndarray(shape, dtype=np.float32, buffer=self.score_shm.buf)
+        cols = np.ndarray((batch_size, min(n_row, n_col)), dtype=np.int64, buffer=self.cols_shm.buf)
+        return score, cols
+
+    def release(self):
+        for shm in (self.score_shm, self.cols_shm):
+            shm.close()
+            shm.unlink()
+
+
+class _AssignHandle:
+    def __init__(self, solver, buffer, shape, async_result):
+        self.solver = solver
+        self.buffer = buffer
+        self.shape = shape
+        self.async_result = async_result
+        self.result = None
+
+    def get(self):
+        """
+        :return: reorder_cols, (batch_size, n_row) np.ndarray, blocks until all the workers are done
+        """
+        if self.result is None:
+            try:
+                self.async_result.get()
+                self.result = self.buffer.views(self.shape)[1].copy()
+            finally:
+                self._release()
+        return self.result
+
+    def _release(self):
+        if self.buffer is not None:
+            self.solver._release_buffer(self.buffer, self.async_result)
+            self.buffer = None
+
+    def __del__(self):
+        # a handle abandoned before `get()`, e.g. by an exception in the training step, still returns its buffer
+        self._release()
+
+
+class HungarianSolver:
+    def __init__(self, num_workers=4):
+        """
+        :param int num_workers: number of worker processes solving the per-instance assignments
+        """
+        self.num_workers = num_workers
+        # spawn instead of fork, the workers must not inherit the CUDA context of the training process
+        self.pool = mp.get_context('spawn').Pool(num_workers)
+        self._buffers = []
+        self._free_buffers = []
+        self._pending_buffers = []  # (buffer, async_result) of abandoned handles whose workers may still be running
+        atexit.register(self.close)
+
+    def _release_buffer(self, buffer, async_result):
+        if self.pool is None:  # already closed, the buffer is unlinked
+            return
+        if async_result.ready():
+            self._free_buffers.append(buffer)
+        else:
+            self._pending_buffers.append((buffer, async_result))
+
+    def _acquire_buffer(self, shape):
+        batch_size, n_row, n_col = shape
+        for buffer, async_result in [p for p in self._pending_buffers if p[1].ready()]:
+            self._pending_buffers.remove((buffer, async_result))
+            self._free_buffers.append(buffer)
+        for buffer in self._free_buffers:
+            if buffer.capacity >= batch_size * n_row * n_col:
+                self._free_buffers.remove(buffer)
+                return buffer
+        buffer = _SharedBuffer(shape)
+        self._buffers.append(buffer)
+        return buffer
+
+    def submit(self, score):
+        """
+        Start solving `linear_sum_assignment(score[b], maximize=True)` for every instance in the batch.
+        :param score: (batch_size, n_row, n_col) tensor, on any device
+        :return: a handle whose `get()` returns the column indices, (batch_size, n_row)
+        """
+        shape = tuple(score.size())
+        buffer = self._acquire_buffer(shape)
+        score_np, _ = buffer.views(shape)
+        # single device to host copy, directly into the shared buffer
+        torch.from_numpy(score_np).copy_(score.detach())
+
+        bounds = np.linspace(0, shape[0], min(self.num_workers, shape[0]) + 1).astype(int)
+        chunks = [(buffer.score_shm.name, buffer.cols_shm.name, shape, start, end)
+                  for start, end in zip(bounds[:-1], bounds[1:])]
+        async_result = self.pool.starmap_async(_solve_chunk, chunks)
+        return _AssignHandle(self, buffer, shape, async_result)
+
+    def solve(self, score):
+        return self.submit(score).get()
+
+    def close(self):
+        if self.pool is None:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+        for buffer in self._buffers:
+            buffer.release()
+        self._buffers, self._free_buffers, self._pending_buffers = [], [], []
+
+
+def get_hungarian_solver(opt):
+    """
+    :return: the process-wide `HungarianSolver` selected by `opt.hungarian_backend`, None for the serial backend
+    """
+    if opt.hungarian_backend == 'serial':
+        return None
+    if opt.hungarian_workers not in _solvers:
+        _solvers[opt.hungarian_workers] = HungarianSolver(opt.hungarian_workers)
+    return _solvers[opt.hungarian_workers]
+
+
+if __name__ == '__main__':
+    # python -m pykp.utils.assign_solver [model options], from the root of the repository
+    import argparse
+    import time
+
+    import config
+    from pykp.encoder.transformer import TransformerSeq2SeqEncoder
+    from pykp.utils.label_assign import hungarian_assign_async
+
+    parser = argparse.ArgumentParser(description='Time of the seperate_pre_ab assignment step of train_one_batch: '
+                                                 'both hungarian assignments, overlapped with the encoder forward')
+    config.vocab_opts(parser)
+    config.model_opts(parser)
+    parser.add_argument('-assign_steps', type=int, default=2)
+    parser.add_argument('-batch_sizes', type=int, nargs='+', default=[12, 32, 64, 128])
+    parser.add_argument('-src_len', type=int, default=100)
+    parser.add_argument('-n_steps', type=int, default=20)
+    opt = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    encoder = TransformerSeq2SeqEncoder.from_opt(opt, torch.nn.Embedding(opt.vocab_size, opt.word_vec_size), None)
+    encoder = encoder.to(device).train()
+    solver = HungarianSolver(opt.hungarian_workers)
+    mid_idx = opt.max_kp_num // 2
+    ignore_indices = [0, 1]  # stand-ins of the ids of NULL_WORD and PAD_WORD
+
+    def train_step(decode_dist, target, src, src_mask, solver, encode=True):
+        # same order as train_one_batch: launch both assignments, encoder forward, then wait for the assignments
+        wait_pre_reorder_index = hungarian_assign_async(decode_dist[:, :mid_idx], target[:, :mid_idx],
+                                                        ignore_indices, solver=solver)
+        wait_ab_reorder_index = hungarian_assign_async(decode_dist[:, mid_idx:], target[:, mid_idx:],
+                                                       ignore_indices, solver=solver)
+        if encode:
+            encoder(src, None, src_mask)
+        reorder_cols = np.concatenate([wait_pre_reorder_index()[1], wait_ab_reorder_index()[1]], axis=1)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        return reorder_cols
+
+    def time_step(*args):
+        train_step(*args)  # warm up
+        start_time = time.time()
+        for _ in range(opt.n_steps):
+            reorder_cols = train_step(*args)
+        return (time.time() - start_time) / opt.n_steps * 1000, reorder_cols
+
+    for batch_size in opt.batch_sizes:
+        decode_dist = torch.rand(batch_size, opt.max_kp_num, opt.assign_steps, opt.vocab_size, device=device)
+        decode_dist = decode_dist.softmax(-1)
+        target = torch.randint(2, opt.vocab_size, (batch_size, opt.max_kp_num, opt.assign_steps), device=device)
+        target[:, ::3] = 0  # NULL_WORD slots
+        src = torch.randint(2, opt.vocab_size, (batch_size, opt.src_len), device=device)
+        inputs = (decode_dist, target, src, src.ne(0))
+
+        serial_assign_time, _ = time_step(*inputs, None, False)
+        process_assign_time, _ = time_step(*inputs, solver, False)
+        serial_time, serial_cols = time_step(*inputs, None)
+        process_time, process_cols = time_step(*inputs, solver)
+        assert (serial_cols == process_cols).all()
+        print('batch_size: %3d, assignment only: serial %.2fms, process %.2fms | '
+              'assignment + encoder forward: serial %.2fms/step, process %.2fms/step' % (
+                  batch_size, serial_assign_time, process_assign_time, serial_time, process_time))
+    solver.close()
@@ -0,0 +1,96 @@
+import logging
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping the examples of similar source length, so that the batches are padded to a length close to
+    the one of their examples.
+    Every epoch the examples are shuffled, cut into pools of `bucket_size` batches, sorted by length inside each pool
+    and split into batches, and the order of the batches is shuffled again.
+    """
+
+    def __init__(self, lengths, batch_size, max_tokens=0, shuffle=True, bucket_size=100, generator=None):
+        """
+        :param lengths: source length of each example in the dataset
+        :param int batch_size: number of examples per batch, only used if max_tokens is 0
+        :param int max_tokens: if > 0, the batches have as many examples as possible with
+                               `max source length in the batch * number of examples <= max_tokens`
+        :param bool shuffle: without shuffling the pools follow the order of the dataset, and so do the batches
+        :param int bucket_size: number of batches in a pool sorted by length
+        :param torch.Generator generator: to draw the permutations from, the global torch RNG if None
+        """
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.generator = generator
+        if max_tokens > 0:
+            pool_size = bucket_size * max(1, max_tokens // max(1, int(self.lengths.mean())))
+        else:
+            pool_size = bucket_size * batch_size
+        self.pool_size = pool_size
+        self._batches = None  # batches of the next (or current) epoch
+        self._iterated = False
+
+    def _split_pool(self, pool):
+        if self.max_tokens <= 0:
+            return [pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size)]
+        # the pool is sorted by length, the last example of a batch is the longest one
+        lengths = self.lengths[pool]
+        batches = []
+        batch_start = 0
+        for i in range(1, len(pool)):
+            if lengths[i] * (i - batch_start + 1) > self.max_tokens:
+                batches.append(pool[batch_start:i].tolist())
+                batch_start = i
+        if len(pool) > batch_start:
+            batches.append(pool[batch_start:].tolist())
+        return batches
+
+    def _make_batches(self):
+        n = len(self.lengths)
+        generator = self.generator
+        if self.shuffle and generator is None:
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+        order = torch.randperm(n, generator=generator).numpy() if self.shuffle else np.arange(n)
+
+        batches = []
+        for start in range(0, n, self.pool_size):
+            pool = order[start:start + self.pool_size]
+            batches.extend(self._split_pool(pool[np.argsort(self.lengths[pool], kind='stable')]))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        # the same number of batches drawn without bucketing, for comparison
+        unbucketed = np.array_split(order, max(1, len(batches)))
+        logging.info('Length bucketing: %d batches, source padding ratio %.2f%% (%.2f%% without bucketing)' % (
+            len(batches), 100 * self.padding_ratio(batches), 100 * self.padding_ratio(unbucketed)))
+        return batches
+
+    def padding_ratio(self, batches):
+        """
+        :return: the fraction of padding in the padded source tensors of the batches
+        """
+        n_padded = sum(len(batch) * self.lengths[batch].max() for batch in batches if len(batch) > 0)
+        return 1 - self.lengths.sum() / max(1, n_padded)
+
+    def __iter__(self):
+        if self._batches is None or self._iterated:
+            self._batches = self._make_batches()
+        self._iterated = True
+        return iter(self._batches)
+
+    def __len__(self):
+        # with max_tokens the number of batches changes with the permutation, the batches of the next epoch are
+        # drawn here once the previous ones have been iterated, and used by the next __iter__, so that the length
+        # and the batches come from the same draw. Called during an epoch, it returns the length of the next one.
+        if self._batches is None or self._iterated:
+            self._batches = self._make_batches()
+            self._iterated = False
+        return len(self._batches)
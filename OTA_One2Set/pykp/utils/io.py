@@ -1,10 +1,13 @@
 # -*- coding: utf-8 -*-
+import itertools
 import logging
 
 import numpy as np
 import torch
 import torch.utils.data
 
+from pykp.utils.mmap_dataset import MmapExamples
+
 PAD_WORD = '<pad>'
 UNK_WORD = '<unk>'
 BOS_WORD = '<bos>'
@@ -16,76 +19,127 @@ NULL_WORD = '<null>'
 
 
 class KeyphraseDataset(torch.utils.data.Dataset):
-    def __init__(self, examples, word2idx, idx2word, device, load_train=True,
-                 fix_kp_num_len=False, max_kp_len=6, max_kp_num=20, seperate_pre_ab=False):
-        keys = ['src', 'src_oov', 'oov_dict', 'oov_list', 'src_str', 'trg_str', 'trg', 'trg_copy']
+    def __init__(self, examples, word2idx, idx2word, load_train=True,
+                 fix_kp_num_len=False, max_kp_len=6, max_kp_num=20, seperate_pre_ab=False,
+                 pin_memory=False, num_pad_buffers=3):
+        if isinstance(examples, MmapExamples):
+            # 内存映射的数据，__getitem__ 时才读取单条数据
+            self.examples = examples
+        else:
+            keys = ['src', 'src_oov', 'oov_dict', 'oov_list', 'src_str', 'trg_str', 'trg', 'trg_copy']
 
-        filtered_examples = []
+            filtered_examples = []
 
-        for e in examples:
-            filtered_example = {}
-            for k in keys:
-                filtered_example[k] = e[k]
-            if 'oov_list' in filtered_example:
-                filtered_example['oov_number'] = len(filtered_example['oov_list'])
-            filtered_examples.append(filtered_example)
+            for e in examples:
+                filtered_example = {}
+                for k in keys:
+                    filtered_example[k] = e[k]
+                if 'oov_list' in filtered_example:
+                    filtered_example['oov_number'] = len(filtered_example['oov_list'])
+                filtered_examples.append(filtered_example)
 
-        self.examples = filtered_examples
+            self.examples = filtered_examples
         self.word2idx = word2idx
         self.id2xword = idx2word
         self.load_train = load_train
-        self.device = device
+
+        # padding 用的 buffer，在 batch 之间复用
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.num_pad_buffers = num_pad_buffers
+        self._pad_buffers = {}
+        self._pad_slots = {}
 
         # for one2set
         self.fix_kp_num_len = fix_kp_num_len
+        self.trg_array, self.trg_oov_array = None, None
         if self.fix_kp_num_len:
             self.max_kp_len = max_kp_len
             self.max_kp_num = max_kp_num
             self.seperate_pre_ab = seperate_pre_ab
+            if self.load_train:
+                self.trg_array, self.trg_oov_array = self._build_set_targets()
 
     @classmethod
     def build(cls, examples, opt, load_train):
         return cls(examples,
-                   device=opt.device,
                    word2idx=opt.vocab['word2idx'],
                    idx2word=opt.vocab['idx2word'],
                    load_train=load_train,
                    fix_kp_num_len=opt.fix_kp_num_len,
                    max_kp_len=opt.max_kp_len,
                    max_kp_num=opt.max_kp_num,
-                   seperate_pre_ab=opt.seperate_pre_ab)
+                   seperate_pre_ab=opt.seperate_pre_ab,
+                   pin_memory=torch.device(opt.device).type == 'cuda')
 
     def __getitem__(self, index):
-        return self.examples[index]
+        if self.trg_array is None:
+            return self.examples[index]
+        example = dict(self.examples[index])
+        example['trg_set'] = self.trg_array[index]
+        example['trg_oov_set'] = self.trg_oov_array[index]
+        return example
 
     def __len__(self):
         return len(self.examples)
 
-    def _pad(self, input_list):
+    def src_lengths(self):
+        if isinstance(self.examples, MmapExamples):
+            return self.examples.lengths('src')
+        return np.array([len(e['src']) for e in self.examples])
+
+    def _buffer(self, key, shape, dtype=torch.int64):
+        """
+        A tensor of the given shape in the preallocated (pinned if pin_memory) buffers, reused across batches.
+        The buffers of a key are used in turn, so a padded tensor stays valid while the next num_pad_buffers - 1
+        batches are built.
+        """
+        if torch.utils.data.get_worker_info() is not None:
+            # batch_workers > 0: the batch is sent to the main process in shared memory, the buffer can not be reused
+            return torch.empty(shape, dtype=dtype)
+        slot = self._pad_slots.get(key, 0)
+        self._pad_slots[key] = (slot + 1) % self.num_pad_buffers
+        numel = int(np.prod(shape))
+        buffer = self._pad_buffers.get((key, slot))
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=dtype, pin_memory=self.pin_memory)
+            self._pad_buffers[(key, slot)] = buffer
+        return buffer[:numel].view(shape)
+
+    def _pad(self, input_list, key='src'):
+        """
+        :param input_list: a list of token id lists
+        :param key: name of the padded tensor, selects the buffers to write into
+        :return: padded int64 tensor (batch, max_len), lengths, bool mask (batch, max_len)
+        """
         input_list_lens = [len(l) for l in input_list]
-        max_seq_len = max(input_list_lens)
-        padded_batch = self.word2idx[PAD_WORD] * np.ones((len(input_list), max_seq_len))
+        lens = np.array(input_list_lens, dtype=np.int64)
+        shape = (len(input_list), int(lens.max()))
 
-        for j in range(len(input_list)):
-            current_len = input_list_lens[j]
-            padded_batch[j][:current_len] = input_list[j]
+        padded_batch = self._buffer(key, shape)
+        padded_batch.fill_(self.word2idx[PAD_WORD])
+        flat = np.fromiter(itertools.chain.from_iterable(input_list), dtype=np.int64, count=int(lens.sum()))
+        padded_batch.numpy()[np.arange(shape[1]) < lens[:, None]] = flat
 
-        padded_batch = torch.LongTensor(padded_batch)
-
-        input_mask = torch.ne(padded_batch, self.word2idx[PAD_WORD]).type(torch.FloatTensor)
+        input_mask = torch.ne(padded_batch, self.word2idx[PAD_WORD], out=self._buffer(key + '_mask', shape, torch.bool))
 
         return padded_batch, input_list_lens, input_mask
 
-    def _pad2d(self, input_list):
-        input_list_lens = [[len(t) for t in ts] for ts in input_list]
+    def _pad2d(self, input_array, key='trg'):
+        """
+        :param input_array: (batch, max_kp_num, max_kp_len) array of padded targets
+        """
+        input_list_lens = [[self.max_kp_len] * self.max_kp_num] * len(input_array)
 
-        padded_batch = torch.LongTensor(input_list)
+        padded_batch = self._buffer(key, input_array.shape)
+        padded_batch.numpy()[...] = input_array
 
-        input_mask = torch.ne(padded_batch, self.word2idx[PAD_WORD]).type(torch.FloatTensor)
+        input_mask = torch.ne(padded_batch, self.word2idx[PAD_WORD],
+                              out=self._buffer(key + '_mask', input_array.shape, torch.bool))
 
         return padded_batch, input_list_lens, input_mask
 
     def collate_fn_common(self, batches, trg=None, trg_oov=None):
+        # the tensors of the batch stay on the CPU, they are moved to the device by BatchPrefetcher
         # source with oov words replaced by <unk>
         src = [b['src'] for b in batches]
         # extended src (oov words are replaced with temporary idx, e.g. 50000, 50001 etc.)
@@ -104,34 +158,27 @@ class KeyphraseDataset(torch.utils.data.Dataset):
         # sort all the sequences in the order of source lengths, to meet the requirement of pack_padded_sequence
         src_lens = [len(i) for i in src]
 
-        seq_pairs = sorted(zip(src_lens, src, src_oov, oov_lists, src_str, trg_str, original_indices),
-                           key=lambda p: p[0], reverse=True)
-        _, src, src_oov, oov_lists, src_str, trg_str, original_indices = zip(
-            *seq_pairs)
+        order = sorted(original_indices, key=lambda i: src_lens[i], reverse=True)
+        src, src_oov, oov_lists, src_str, trg_str, original_indices = [
+            [l[i] for i in order] for l in (src, src_oov, oov_lists, src_str, trg_str, original_indices)]
 
         if self.load_train:
-            seq_pairs = sorted(zip(src_lens, trg, trg_oov), key=lambda p: p[0], reverse=True)
-            _, trg, trg_oov = zip(*seq_pairs)
+            if self.fix_kp_num_len:
+                trg, trg_oov = trg[order], trg_oov[order]
+            else:
+                trg, trg_oov = [trg[i] for i in order], [trg_oov[i] for i in order]
 
         # pad the src and target sequences with <pad> token and convert to LongTensor
-        src, src_lens, src_mask = self._pad(src)
-        src_oov, _, _ = self._pad(src_oov)
-
-        src = src.to(self.device)
-        src_mask = src_mask.to(self.device)
-        src_oov = src_oov.to(self.device)
+        src, src_lens, src_mask = self._pad(src, 'src')
+        src_oov, _, _ = self._pad(src_oov, 'src_oov')
 
         if self.load_train:
             if self.fix_kp_num_len:
-                trg, trg_lens, trg_mask = self._pad2d(trg)
-                trg_oov, _, _ = self._pad2d(trg_oov)
+                trg, trg_lens, trg_mask = self._pad2d(trg, 'trg')
+                trg_oov, _, _ = self._pad2d(trg_oov, 'trg_oov')
             else:
-                trg, trg_lens, trg_mask = self._pad(trg)
-                trg_oov, _, _ = self._pad(trg_oov)
-
-            trg = trg.to(self.device)
-            trg_mask = trg_mask.to(self.device)
-            trg_oov = trg_oov.to(self.device)
+                trg, trg_lens, trg_mask = self._pad(trg, 'trg')
+                trg_oov, _, _ = self._pad(trg_oov, 'trg_oov')
         else:
             trg_lens, trg_mask = None, None
 
@@ -174,65 +221,78 @@ class KeyphraseDataset(torch.utils.data.Dataset):
         else:
             return self.collate_fn_common(batches)
 
+    def _pad_set_target(self, trg, trg_copy):
+        """
+        :return: the target and the target with oov ids of one example, padded to max_kp_num x max_kp_len
+        """
+        if self.seperate_pre_ab:
+            targets = [t for t in trg if len(t) <= (self.max_kp_len - 1)]
+            oov_targets = [t for t in trg_copy if len(t) <= (self.max_kp_len - 1)]
+            assert [self.word2idx[PEOS_WORD]] in targets, \
+                "the original training keyphrases must be seperated by <peos> !"
+            peos_idx = targets.index([self.word2idx[PEOS_WORD]])
+
+            # 只取[:self.max_kp_num // 2]的原因是要分割present和absent
+            present_targets = targets[:peos_idx][:self.max_kp_num // 2]
+            absent_targets = targets[peos_idx + 1:][:self.max_kp_num // 2]
+            present_targets_oov = oov_targets[:peos_idx][:self.max_kp_num // 2]
+            absent_targets_oov = oov_targets[peos_idx + 1:][:self.max_kp_num // 2]
+
+            # padding present keyphrase
+            present_targets = [
+                t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (self.max_kp_len - len(t) - 1)
+                for t in present_targets]
+            present_targets_oov = [
+                t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (self.max_kp_len - len(t) - 1)
+                for t in present_targets_oov]
+            extra_present_targets = [[self.word2idx[NULL_WORD]] + [self.word2idx[PAD_WORD]] * (
+                   self.max_kp_len - 1)] * (self.max_kp_num // 2 - len(present_targets))
+            #extra_present_targets = []
+
+            # padding absent keyphrase
+            absent_targets = [
+                t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (self.max_kp_len - len(t) - 1)
+                for t in absent_targets]
+            absent_targets_oov = [
+                t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (self.max_kp_len - len(t) - 1)
+                for t in absent_targets_oov]
+            extra_absent_targets = [[self.word2idx[NULL_WORD]] + [self.word2idx[PAD_WORD]] * (
+                    self.max_kp_len - 1)] * (self.max_kp_num // 2 - len(absent_targets))
+            #extra_absent_targets = []
+
+            return present_targets + extra_present_targets + absent_targets + extra_absent_targets, \
+                present_targets_oov + extra_present_targets + absent_targets_oov + extra_absent_targets
+        else:
+            targets = [t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (
+                    self.max_kp_len - len(t) - 1)
+                       for t in trg if len(t) <= (self.max_kp_len - 1)][:self.max_kp_num]
+            oov_targets = [t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (
+                    self.max_kp_len - len(t) - 1)
+                           for t in trg_copy if len(t) <= (self.max_kp_len - 1)][:self.max_kp_num]
+
+            extra_targets = [[self.word2idx[NULL_WORD]] + [self.word2idx[PAD_WORD]] * (
+                    self.max_kp_len - 1)] * (self.max_kp_num - len(targets))
+            return targets + extra_targets, oov_targets + extra_targets
+
+    def _build_set_targets(self):
+        """
+        Pad the targets of all the examples once when the dataset is built, instead of in every batch
+        :return: target, target with oov ids, (num_examples, max_kp_num, max_kp_len) int32 arrays
+        """
+        if isinstance(self.examples, MmapExamples):
+            targets = zip(self.examples.iter_column('trg'), self.examples.iter_column('trg_copy'))
+        else:
+            targets = ((e['trg'], e['trg_copy']) for e in self.examples)
+        trg_array = np.empty((len(self.examples), self.max_kp_num, self.max_kp_len), dtype=np.int32)
+        trg_oov_array = np.empty_like(trg_array)
+        for i, (trg, trg_copy) in enumerate(targets):
+            trg_array[i], trg_oov_array[i] = self._pad_set_target(trg, trg_copy)
+        return trg_array, trg_oov_array
+
     def collate_fn_fixed_tgt(self, batches):
         if self.load_train:
-            if self.seperate_pre_ab:
-                trg = []
-                trg_oov = []
-                for b in batches:
-                    targets = [t for t in b['trg'] if len(t) <= (self.max_kp_len - 1)]
-                    oov_targets = [t for t in b['trg_copy'] if len(t) <= (self.max_kp_len - 1)]
-                    assert [self.word2idx[PEOS_WORD]] in targets, \
-                        "the original training keyphrases must be seperated by <peos> !"
-                    peos_idx = targets.index([self.word2idx[PEOS_WORD]])
-
-                    # 只取[:self.max_kp_num // 2]的原因是要分割present和absent
-                    present_targets = targets[:peos_idx][:self.max_kp_num // 2]
-                    absent_targets = targets[peos_idx + 1:][:self.max_kp_num // 2]
-                    present_targets_oov = oov_targets[:peos_idx][:self.max_kp_num // 2]
-                    absent_targets_oov = oov_targets[peos_idx + 1:][:self.max_kp_num // 2]
-
-                    # padding present keyphrase
-                    present_targets = [
-                        t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (self.max_kp_len - len(t) - 1)
-                        for t in present_targets]
-                    present_targets_oov = [
-                        t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (self.max_kp_len - len(t) - 1)
-                        for t in present_targets_oov]
-                    extra_present_targets = [[self.word2idx[NULL_WORD]] + [self.word2idx[PAD_WORD]] * (
-                           self.max_kp_len - 1)] * (self.max_kp_num // 2 - len(present_targets))
-                    #extra_present_targets = []
-
-                    # padding absent keyphrase
-                    absent_targets = [
-                        t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (self.max_kp_len - len(t) - 1)
-                        for t in absent_targets]
-                    absent_targets_oov = [
-                        t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (self.max_kp_len - len(t) - 1)
-                        for t in absent_targets_oov]
-                    extra_absent_targets = [[self.word2idx[NULL_WORD]] + [self.word2idx[PAD_WORD]] * (
-                            self.max_kp_len - 1)] * (self.max_kp_num // 2 - len(absent_targets))
-                    #extra_absent_targets = []
-
-                    trg.append(present_targets + extra_present_targets + absent_targets + extra_absent_targets)
-                    trg_oov.append(
-                        present_targets_oov + extra_present_targets + absent_targets_oov + extra_absent_targets)
-            else:
-                trg = []
-                trg_oov = []
-                for b in batches:
-                    targets = [t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (
-                            self.max_kp_len - len(t) - 1)
-                               for t in b['trg'] if len(t) <= (self.max_kp_len - 1)][:self.max_kp_num]
-                    oov_targets = [t + [self.word2idx[EOS_WORD]] + [self.word2idx[PAD_WORD]] * (
-                            self.max_kp_len - len(t) - 1)
-                                   for t in b['trg_copy'] if len(t) <= (self.max_kp_len - 1)][:self.max_kp_num]
-
-                    extra_targets = [[self.word2idx[NULL_WORD]] + [self.word2idx[PAD_WORD]] * (
-                            self.max_kp_len - 1)] * (self.max_kp_num - len(targets))
-                    trg.append(targets + extra_targets)
-                    trg_oov.append(oov_targets + extra_targets)
-
+            trg = np.stack([b['trg_set'] for b in batches])
+            trg_oov = np.stack([b['trg_oov_set'] for b in batches])
             return self.collate_fn_common(batches, trg, trg_oov)
         else:
             return self.collate_fn_common(batches)
@@ -253,8 +313,16 @@ def build_dataset(src_trgs_pairs, opt, mode='one2one', include_original=True):
     :param include_original: keep the original texts of source and target
     :return:
     '''
+    return list(iter_dataset(src_trgs_pairs, opt, mode=mode, include_original=include_original))
+
+
+def iter_dataset(src_trgs_pairs, opt, mode='one2one', include_original=True):
+    '''
+    Streaming version of build_dataset, yield the examples one by one
+    :param src_trgs_pairs: an iterable of (src_word_list, [trg_1_word_list, trg_2_word_list, ...])
+    '''
     word2idx = opt.vocab['word2idx']
-    return_examples = []
+    num_examples = 0
     oov_target = 0
     max_oov_len = 0
     max_oov_sent = ''
@@ -298,7 +366,8 @@ def build_dataset(src_trgs_pairs, opt, mode='one2one', include_original=True):
                 oov_target += 1
 
             if mode == 'one2one':
-                return_examples.append(example)
+                num_examples += 1
+                yield example
             else:
                 examples.append(example)
 
@@ -319,14 +388,13 @@ def build_dataset(src_trgs_pairs, opt, mode='one2one', include_original=True):
                 assert len(o2m_example['oov_dict']) == len(o2m_example['oov_list'])
                 assert len(o2m_example['trg']) == len(o2m_example['trg_copy'])
 
-            return_examples.append(o2m_example)
+            num_examples += 1
+            yield o2m_example
 
-    logging.info('Find #(oov_target)/#(all) = %d/%d' % (oov_target, len(return_examples)))
+    logging.info('Find #(oov_target)/#(all) = %d/%d' % (oov_target, num_examples))
     logging.info('Find max_oov_len = %d' % max_oov_len)
     logging.info('max_oov sentence: %s' % str(max_oov_sent))
 
-    return return_examples
-
 
 def extend_vocab_OOV(source_words, word2idx, vocab_size, max_unk_words):
     """
@@ -351,3 +419,53 @@ def extend_vocab_OOV(source_words, word2idx, vocab_size, max_unk_words):
 
     oov_list = [w for w, w_id in sorted(oov_dict.items(), key=lambda x: x[1])]
     return src_oov, oov_dict, oov_list
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    class _LegacyPadDataset(KeyphraseDataset):
+        # the padding before the preallocated buffers, for comparison
+        def _pad(self, input_list, key='src'):
+            input_list_lens = [len(l) for l in input_list]
+            padded_batch = self.word2idx[PAD_WORD] * np.ones((len(input_list), max(input_list_lens)))
+            for j in range(len(input_list)):
+                padded_batch[j][:input_list_lens[j]] = input_list[j]
+            padded_batch = torch.LongTensor(padded_batch)
+            input_mask = torch.ne(padded_batch, self.word2idx[PAD_WORD]).type(torch.FloatTensor)
+            return padded_batch, input_list_lens, input_mask
+
+        def _pad2d(self, input_array, key='trg'):
+            input_list_lens = [[len(t) for t in ts] for ts in input_array]
+            padded_batch = torch.LongTensor(input_array.tolist())
+            input_mask = torch.ne(padded_batch, self.word2idx[PAD_WORD]).type(torch.FloatTensor)
+            return padded_batch, input_list_lens, input_mask
+
+    random.seed(0)
+    vocab_size, n_steps = 50000, 50
+    word2idx = {w: i for i, w in enumerate([PAD_WORD, UNK_WORD, BOS_WORD, EOS_WORD, SEP_WORD, PEOS_WORD, NULL_WORD])}
+
+    def random_example():
+        src = [random.randint(7, vocab_size - 1) for _ in range(random.randint(20, 400))]
+        trg = [[random.randint(7, vocab_size - 1) for _ in range(random.randint(1, 5))]
+               for _ in range(random.randint(1, 8))]
+        trg = trg[:len(trg) // 2] + [[word2idx[PEOS_WORD]]] + trg[len(trg) // 2:]
+        return {'src': src, 'src_oov': src, 'oov_dict': {}, 'oov_list': [], 'src_str': [], 'trg_str': [],
+                'trg': trg, 'trg_copy': trg}
+
+    examples = [random_example() for _ in range(1024)]
+    for name, kwargs in [('collate_fn_one2seq', {}),
+                         ('collate_fn_fixed_tgt', {'fix_kp_num_len': True, 'seperate_pre_ab': True})]:
+        for batch_size in [32, 64, 128]:
+            batches = [random.sample(range(len(examples)), batch_size) for _ in range(n_steps)]
+            times = []
+            for dataset_cls in [_LegacyPadDataset, KeyphraseDataset]:
+                dataset = dataset_cls(examples, word2idx, None, **kwargs)
+                batches_examples = [[dataset[i] for i in batch] for batch in batches]
+                start_time = time.perf_counter()
+                for batch_examples in batches_examples:
+                    getattr(dataset, name)(batch_examples)
+                times.append((time.perf_counter() - start_time) / n_steps)
+            print('%s batch_size: %3d, before: %.2fms/batch, after: %.2fms/batch' % (
+                name, batch_size, times[0] * 1000, times[1] * 1000))
@@ -8,12 +8,21 @@ from scipy.optimize import linear_sum_assignment
 EPS = 1e-8
 
 
-def hungarian_assign(decode_dist, target, ignore_indices, random=False):
+def hungarian_assign(decode_dist, target, ignore_indices, random=False, solver=None):
     """
     :param decode_dist: (batch_size, max_kp_num, kp_len, vocab_size)
     :param target: (batch_size, max_kp_num, kp_len)
+    :param solver: `HungarianSolver` solving the assignments in worker processes, None to solve them serially
     :return:
     """
+    return hungarian_assign_async(decode_dist, target, ignore_indices, random, solver)()
+
+
+def hungarian_assign_async(decode_dist, target, ignore_indices, random=False, solver=None):
+    """
+    Same as `hungarian_assign`, but returns a function that waits for and returns `(reorder_rows, reorder_cols)`,
+    so that other work can run while `solver` is solving the assignments.
+    """
     batch_size, max_kp_num, kp_len = target.size()
     reorder_rows = torch.arange(batch_size)[..., None]
     if random:
@@ -22,23 +31,41 @@ def hungarian_assign(decode_dist, target, ignore_indices, random=False):
         score_mask = target.new_zeros(target.size()).bool()
         for i in ignore_indices:
             score_mask |= (target == i)
-        score_mask = score_mask.unsqueeze(1)  # (batch_size, 1, max_kp_num, kp_len)
 
-        score = decode_dist.new_zeros(batch_size, max_kp_num, max_kp_num, kp_len)
-        
-        for b in range(batch_size):
-            for l in range(kp_len):
-                score[b, :, :, l] = decode_dist[b, :, l, target[b, :, l]]
-        score = score.masked_fill(score_mask, 0)
-        score = score.sum(-1)  # batch_size, max_kp_num, max_kp_num
+        score = build_match_score(decode_dist, target, score_mask)  # batch_size, max_kp_num, max_kp_num
+
+        if solver is not None:
+            handle = solver.submit(score)
+            return lambda: (reorder_rows, handle.get())
 
+        score = score.detach().cpu().numpy()
         reorder_cols = []
         for b in range(batch_size):
-            row_ind, col_ind = linear_sum_assignment(score[b].detach().cpu().numpy(), maximize=True)
+            row_ind, col_ind = linear_sum_assignment(score[b], maximize=True)
             reorder_cols.append(col_ind.reshape(1, -1))
             # total_score += sum(score[b][row_ind, col_ind])
         reorder_cols = np.concatenate(reorder_cols, axis=0)
-    return reorder_rows, reorder_cols
+    return lambda: (reorder_rows, reorder_cols)
+
+
+def build_match_score(decode_dist, target, score_mask=None, dtype=None):
+    """
+    Matching score between every prediction and every target, gathered over the vocabulary axis in one pass.
+    :param decode_dist: (batch_size, pred_kp_num, kp_len, vocab_size)
+    :param target: (batch_size, trg_kp_num, kp_len)
+    :param score_mask: (batch_size, trg_kp_num, kp_len), True for the target tokens ignored in matching
+    :param dtype: if given, the gathered probabilities are cast to it before they are summed
+    :return: score, (batch_size, pred_kp_num, trg_kp_num), score[b, p, t] = \sum_l decode_dist[b, p, l, target[b, t, l]]
+    """
+    batch_size, pred_kp_num, kp_len, _ = decode_dist.size()
+    trg_kp_num = target.size(1)
+    target = target.transpose(1, 2).unsqueeze(1)  # (batch_size, 1, kp_len, trg_kp_num)
+    score = torch.gather(decode_dist, 3, target.expand(batch_size, pred_kp_num, kp_len, trg_kp_num))
+    if dtype is not None:
+        score = score.to(dtype)
+    if score_mask is not None:
+        score = score.masked_fill(score_mask.transpose(1, 2).unsqueeze(1), 0)
+    return score.sum(2)
 
 
 def report_instance_assign_stats(b, trg_kp_num, rematch_cols, has_null, solution, k, score, score_nor, lr_adp=None):
@@ -125,22 +152,11 @@ def dynamic_k_strategy_np(b, score_nor, k_strategy: str, has_null, top_candidate
             supply_gt_demand_cnt[b] = -left_k
             # print(-left_k)
             k[-1] = 0.0  # null token不应再分配有k值
-            k_sorted_arg = (k - sum_topk_score_nor)[:-1].argsort()[::-1]
-            loop_idx, xxcnt = 0, 0
-            while left_k < 0:  # 从最高的供应量依次-1, 直到供给不超过现有的总control code数为止
-                xxcnt += 1
-                if xxcnt > 2000:  # debug
-                    print("Error: endless loop in k assignment!")
-                    print("[%d]: k_sorted_arg: " % b, k_sorted_arg)
-                    print("[%d]: k: " % b, k)
-                    print("[%d]: sum(k): " % b, torch.sum(k))
-                    print("[%d]: sum_topk_score_nor: " % b, sum_topk_score_nor)
-                    print("[%d]: sum(sum_topk_score_nor): " % b, np.sum(sum_topk_score_nor))
-                    exit()
-                if k[k_sorted_arg[loop_idx]] >= 2:
-                    k[k_sorted_arg[loop_idx]] -= 1
-                    left_k += 1
-                loop_idx = (loop_idx + 1) % (k.shape[0] - 1)
+            k[:-1] = reduce_k_overflow(
+                torch.from_numpy(k[None, :-1]),
+                torch.from_numpy((k - sum_topk_score_nor)[None, :-1]),
+                torch.tensor([-left_k])
+            ).numpy()[0]
     # debug, check `k`
     if k[:-1].__contains__(0.):
         print("expected `k` are assigned as zero! \n[%d]: k: " % b, k)
@@ -177,12 +193,8 @@ def assign_for_one_instance_np(b, target, decode_dist, pred_kp_num, kp_len, has_
     trg = trg[:, :opt.assign_steps]
     # decode_dist[b, :, l] 即第b个batch输出的任意kp的第l个词（记为 pr_w ）的分布
     # 因此 decode_dist[b, :, l, target[:, l]] 就是上述分布中 pr_w 对应位置的target的概率值
-    score = np.zeros((pred_kp_num, trg_kp_num, kp_len))
-    for l in range(kp_len):
-        score[:, :, l] = decode_dist[b, :, l, trg[:, l]].T
-    
-    # score_first_step = score[:, :, 0].T
-    score = score.sum(-1).T  # trg_kp_num, pred_kp_num
+    score = decode_dist[b][:, np.arange(kp_len)[:, None], trg.T].astype(np.float64)  # pred_kp_num, kp_len, trg_kp_num
+    score = score.sum(1).T  # trg_kp_num, pred_kp_num
 
     score_nor = normalize_score_np(
         b, score, 
@@ -214,7 +226,152 @@ def assign_for_one_instance_np(b, target, decode_dist, pred_kp_num, kp_len, has_
     return rematch_col
 
 
-def optimal_transport_assign(opt, decode_dist, target, epsilon=1e-3, n_iterations=100, has_null=None):
+def pad_target_list(target, pad_idx=0):
+    """
+    Pad the ragged per-instance targets into a single tensor.
+    :param target: list of (trg_kp_num_b, kp_len) tensors, `len(target) == batch_size`
+    :param pad_idx: index used to fill the padded target rows
+    :return: padded target (batch_size, max_trg_kp_num, kp_len), bool mask (batch_size, max_trg_kp_num)
+    """
+    trg_kp_nums = torch.tensor([trg.size(0) for trg in target], device=target[0].device)
+    padded_target = torch.nn.utils.rnn.pad_sequence(target, batch_first=True, padding_value=pad_idx)
+    trg_mask = torch.arange(padded_target.size(1), device=padded_target.device)[None, :] < trg_kp_nums[:, None]
+    return padded_target, trg_mask
+
+
+def normalize_score(score, trg_mask, null_mask, temperature, null_weaken_ratio=1.0):
+    """
+    Batched version of `normalize_score_np`.
+    :param score: (batch_size, trg_kp_num, pred_kp_num)
+    :param trg_mask: (batch_size, trg_kp_num), False for padded target rows
+    :param null_mask: (batch_size, trg_kp_num), True for the appended null target
+    """
+    score_nor = torch.where(null_mask[..., None], score * null_weaken_ratio, score)
+    score_nor = score_nor ** (1 / temperature)
+    score_nor = score_nor.masked_fill(~trg_mask[..., None], 0)
+    # instances with a zero-weighted null as their only target are left unnormalized, as in `normalize_score_np`
+    score_sum = score_nor.sum(1, keepdim=True)
+    score_nor = score_nor / torch.where(score_sum > 0, score_sum, torch.ones_like(score_sum))
+    return score_nor
+
+
+def dynamic_k_strategy(score_nor, k_strategy: str, trg_mask, null_mask, top_candidates, supply_gt_demand_cnt):
+    """
+    Batched version of `dynamic_k_strategy_np`.
+    :param score_nor: (batch_size, trg_kp_num, pred_kp_num)
+    :return: k, (batch_size, trg_kp_num), zero on padded target rows
+    """
+    if k_strategy not in ['normal']:
+        raise NotImplementedError
+    batch_size, trg_kp_num, pred_kp_num = score_nor.shape
+    has_null = null_mask.any(-1)
+    gt_mask = trg_mask & ~null_mask
+
+    sum_topk_score_nor = score_nor.topk(top_candidates, dim=-1)[0].sum(-1)
+    k = torch.where(has_null[:, None], torch.ceil(sum_topk_score_nor), torch.ones_like(sum_topk_score_nor))
+    k = k.masked_fill(~gt_mask, 0)
+    left_k = pred_kp_num - k.sum(-1)
+    k = torch.where(null_mask, left_k.clamp(min=0)[:, None].expand_as(k), k)
+
+    # ground-truth期望分配得到的control code数超出了总的control code数, 从最高的供应量依次-1
+    overflow = has_null & (left_k < 0)
+    supply_gt_demand_cnt.copy_(torch.where(overflow, -left_k, supply_gt_demand_cnt))
+    excess = (k - sum_topk_score_nor).masked_fill(~gt_mask, -float('inf'))
+    reduced_k = reduce_k_overflow(k.masked_fill(~gt_mask, 0), excess, (-left_k).clamp(min=0))
+    k = torch.where(overflow[:, None] & gt_mask, reduced_k, k)
+    return k
+
+
+def reduce_k_overflow(k, priority, n_reduce):
+    """
+    Closed form of the round-robin reduction in `dynamic_k_strategy_np`: visit the entries in descending `priority`
+    order, decrement every entry that is still >= 2 by 1, and stop once `n_reduce` units have been removed.
+    Every entry keeps at least 1, so at most `sum(k) - n` units can be removed. That is always enough when the
+    instance has a null target, since then `n < pred_kp_num`.
+    :param k: (batch_size, n), padded entries must be 0
+    :param priority: (batch_size, n)
+    :param n_reduce: (batch_size, ), number of units to remove from each instance
+    :return: reduced k, (batch_size, n)
+    """
+    capacity = (k - 1).clamp(min=0)
+    rounds = capacity.new_tensor(range(int(capacity.max()) + 1))
+    # removed[b, r]: units removed after r full rounds
+    removed = torch.minimum(capacity.unsqueeze(-1), rounds).sum(1)
+    n_rounds = (removed <= n_reduce.unsqueeze(-1)).sum(-1) - 1
+    n_left = n_reduce - removed.gather(1, n_rounds.unsqueeze(-1)).squeeze(-1)
+
+    # the remaining units come from the first `n_left` entries, in priority order, still above 1 in the next round
+    order = priority.argsort(dim=-1, descending=True)
+    eligible = (capacity > n_rounds.unsqueeze(-1)).gather(1, order)
+    extra = eligible & (eligible.cumsum(-1) <= n_left.unsqueeze(-1))
+    extra = torch.zeros_like(extra).scatter(1, order, extra)
+
+    return k - torch.minimum(capacity, n_rounds.unsqueeze(-1).to(capacity.dtype)) - extra.to(k.dtype)
+
+
+def sinkhorn_iter(suppliers, demanders, cost, trg_mask, epsilon, n_iterations, tol=0.):
+    """
+    Log-domain Sinkhorn iterations for a whole batch, padded target rows receive no mass.
+    :param suppliers: (batch_size, trg_kp_num)
+    :param demanders: (batch_size, pred_kp_num)
+    :param cost: (batch_size, trg_kp_num, pred_kp_num)
+    :param trg_mask: (batch_size, trg_kp_num), False for padded target rows
+    :param tol: stop early once every column marginal is within `tol` of `demanders`, 0 disables the check
+    :return: transport plan (batch_size, trg_kp_num, pred_kp_num)
+    """
+    def M(u, v):
+        return ((-cost + u.unsqueeze(-1) + v.unsqueeze(-2)) / epsilon).masked_fill(~trg_mask.unsqueeze(-1), -float('inf'))
+
+    log_suppliers = torch.log(suppliers + 1e-8)
+    log_demanders = torch.log(demanders + 1e-8)
+    u = torch.ones_like(suppliers)
+    v = torch.ones_like(demanders)
+
+    for _ in range(n_iterations):
+        log_col_sum = torch.logsumexp(M(u, v), dim=1)
+        if tol > 0 and (log_col_sum.exp() - demanders).abs().max() < tol:
+            break
+        v = v + epsilon * (log_demanders - log_col_sum)
+        u = u + epsilon * (log_suppliers - torch.logsumexp(M(u, v), dim=2)).masked_fill(~trg_mask, 0)
+
+    # Transport plan pi = diag(a)*K*diag(b)
+    return torch.exp(M(u, v))
+
+
+def assign_batch(target, trg_mask, decode_dist, has_null, k_strategy, supply_gt_demand_cnt, epsilon, n_iterations, opt):
+    """
+    Solve the optimal transport assignment of the whole batch at once on the device of `decode_dist`.
+    :param target: (batch_size, trg_kp_num, kp_len), padded targets
+    :param trg_mask: (batch_size, trg_kp_num), False for padded target rows
+    :return: rematch_cols, (batch_size, pred_kp_num)
+    """
+    batch_size, pred_kp_num, kp_len, _ = decode_dist.shape
+
+    trg_kp_num = target.size(1)
+    trg = target[:, :, :opt.assign_steps]
+    has_null = torch.as_tensor(has_null, dtype=torch.bool, device=decode_dist.device)
+    null_mask = has_null[:, None] & \
+                (torch.arange(trg_kp_num, device=decode_dist.device)[None, :] == trg_mask.sum(-1, keepdim=True) - 1)
+
+    # gather from the distribution in its own dtype, only the gathered probabilities are cast
+    score = build_match_score(decode_dist, trg, dtype=torch.float64).transpose(1, 2)  # batch, trg_kp_num, pred_kp_num
+
+    score_nor = normalize_score(score, trg_mask, null_mask, opt.assign_temperature)
+
+    k = dynamic_k_strategy(score_nor, k_strategy, trg_mask, null_mask, opt.top_candidates, supply_gt_demand_cnt)
+
+    cost = -score_nor
+    if opt.null_cost_zero:
+        cost = cost.masked_fill(null_mask.unsqueeze(-1), 0)
+    if opt.interrupt_cost:
+        cost = cost + torch.randn_like(cost) / 10
+    solution = sinkhorn_iter(k, score_nor.new_ones(batch_size, pred_kp_num), cost, trg_mask,
+                             epsilon, n_iterations, tol=opt.sinkhorn_tol)
+
+    return solution.argmax(1)
+
+
+def optimal_transport_assign(opt, decode_dist, target, epsilon=1e-3, n_iterations=100, has_null=None, target_mask=None):
     """
     # params
         * `decode_dist`: 
@@ -228,8 +385,11 @@ def optimal_transport_assign(opt, decode_dist, target, epsilon=1e-3, n_iteration
         * `n_iterations`:
             * param for Sinkhorn Iteration (number of iterations)
         * `has_null`: 
-            * list, `len(has_null) == batch_size`
+            * list or bool tensor, `len(has_null) == batch_size`
             * which group of data is appended with background (null token)
+        * `target_mask`:
+            * None if `target` is a list of (trg_kp_num, kp_len) tensors
+            * otherwise (batch_size, trg_kp_num) bool tensor, `target` is already padded and the True rows are real
     # return
         * `rematch_rows`:
             * a simple list of `[0, 1, ..., batch_size - 1]`.
@@ -244,6 +404,25 @@ def optimal_transport_assign(opt, decode_dist, target, epsilon=1e-3, n_iteration
     batch_size, pred_kp_num, kp_len, _ = decode_dist.shape
     supply_gt_demand_cnt = decode_dist.new_zeros((batch_size, ))  # 当前batch中每条数据是否满足“预计总供应量大于总需求量, 需要从最高供应量开始向下-1”
 
+    rematch_rows = torch.arange(batch_size)[..., None]
+
+    if opt.ot_backend == 'torch':
+        if target_mask is None:
+            target, target_mask = pad_target_list(target)
+        rematch_cols = assign_batch(
+            target, target_mask, decode_dist.detach(),
+            has_null=has_null, k_strategy=k_strategy,
+            supply_gt_demand_cnt=supply_gt_demand_cnt,
+            epsilon=epsilon, n_iterations=n_iterations,
+            opt=opt
+        )
+        return rematch_rows, rematch_cols.to(opt.device), supply_gt_demand_cnt.to(opt.device)
+
+    if target_mask is not None:
+        target = [trg[mask] for trg, mask in zip(target, target_mask)]
+    if torch.is_tensor(has_null):
+        has_null = has_null.tolist()
+
     decode_dist_np = decode_dist.detach().cpu().numpy()
     target_np = [trg.detach().cpu().numpy() for trg in target]
     supply_gt_demand_cnt_np = supply_gt_demand_cnt.detach().cpu().numpy()
@@ -273,7 +452,6 @@ def optimal_transport_assign(opt, decode_dist, target, epsilon=1e-3, n_iteration
     pool.close()
     pool.join()
 
-    rematch_rows = torch.arange(batch_size)[..., None]
     # rematch_cols = torch.cat(rematch_cols, dim=0)
 
     rematch_cols = torch.from_numpy(np.concatenate(rematch_cols)).to(opt.device)
@@ -282,6 +460,55 @@ def optimal_transport_assign(opt, decode_dist, target, epsilon=1e-3, n_iteration
     return rematch_rows, rematch_cols, supply_gt_demand_cnt
 
 
+def compact_set_targets(target, trg_mask, background, bg_mask):
+    """
+    Drop the null slots of a fixed-slot target set, move the real targets to the front (keeping their order), and put
+    one background (null) target right after them for the instances that have null slots.
+    :param target: (batch_size, kp_num, kp_len)
+    :param trg_mask: (batch_size, kp_num, kp_len)
+    :param background: (kp_len, ), the target of a null slot
+    :param bg_mask: (kp_len, ), the trg_mask of a null slot
+    :return: compacted target (batch_size, kp_num, kp_len), compacted trg_mask (batch_size, kp_num, kp_len),
+             target_mask (batch_size, kp_num), True for the real targets and the appended background,
+             has_null (batch_size, )
+    """
+    batch_size, kp_num, kp_len = target.size()
+    is_real = (target != background).any(-1)  # 去掉null kp，只保留真实的target kp
+    n_real = is_real.sum(-1, keepdim=True)
+    has_null = n_real.squeeze(-1) != kp_num
+
+    order = (~is_real).long().argsort(dim=-1, stable=True)[..., None].expand_as(target)
+    target = target.gather(1, order)
+    trg_mask = trg_mask.gather(1, order)
+
+    slot = torch.arange(kp_num, device=target.device)[None, :]
+    is_background = (slot == n_real)[..., None]  # 补上一个null kp作为学习的目标
+    target = torch.where(is_background, background.to(target.dtype), target)
+    trg_mask = torch.where(is_background, bg_mask.to(trg_mask.dtype), trg_mask)
+    target_mask = slot < n_real + has_null[:, None]
+    return target, trg_mask, target_mask, has_null
+
+
+def optimal_transport_assign_set(opt, decode_dist, target, trg_mask, background, bg_mask):
+    """
+    Optimal transport assignment of one half (present or absent) of a fixed-slot target set, see `compact_set_targets`.
+    :param decode_dist: (batch_size, kp_num, assign_steps, vocab_size)
+    :param target: (batch_size, kp_num, kp_len)
+    :param trg_mask: (batch_size, kp_num, kp_len)
+    :return: reordered target, reordered trg_mask, supply_gt_demand_cnt,
+             and the (trg_kp_nums, rematch_cols, has_null) arguments of `learning_info`
+    """
+    target, trg_mask, target_mask, has_null = compact_set_targets(target, trg_mask, background, bg_mask)
+    _, rematch_cols, supply_gt_demand_cnt = optimal_transport_assign(
+        opt, decode_dist, target,
+        has_null=has_null,
+        target_mask=target_mask
+    )
+    index = rematch_cols[..., None].expand(-1, -1, target.size(-1))
+    assign_info = (target_mask.sum(-1).tolist(), rematch_cols, has_null.tolist())
+    return target.gather(1, index), trg_mask.gather(1, index), supply_gt_demand_cnt, assign_info
+
+
 if __name__ == '__main__':
     np.set_printoptions(linewidth=250)
 
@@ -6,26 +6,28 @@ import torch
 EPS = 1e-8
 
 
-def masked_cross_entropy(class_dist, target, trg_mask, loss_scales=None, scale_indices=None):
+def masked_cross_entropy(class_dist, target, trg_mask, loss_scales=None, scale_indices=None, gathered=False,
+                         log_probs=False):
     """
     :param class_dist: [batch_size, trg_seq_len, num_classes]
     :param target: [batch_size, trg_seq_len]
     :param trg_mask: [batch_size, trg_seq_len]
+    :param gathered: class_dist是已经取出的target的概率 [batch_size, trg_seq_len, 1]（decoder给定target时的输出）
+    :param log_probs: class_dist是log概率（如decoder给定target时输出的log(p + EPS)），直接取负作为loss
     :return:
     """
-    num_classes = class_dist.size(2)
-    class_dist_flat = class_dist.reshape(-1, num_classes)  # [batch_size*trg_seq_len, num_classes]
-    target_flat = target.reshape(-1, 1)  # [batch*trg_seq_len, 1]
-    log_dist_flat = torch.log(class_dist_flat + EPS)
-    # 挑选每个词对应到匹配的trg的概率分布
-    losses_flat = -torch.gather(log_dist_flat, dim=1, index=target_flat)  # [batch * trg_seq_len, 1]
-    losses = losses_flat.view(*target.size())  # [batch, trg_seq_len]
+    if not gathered:
+        # 先挑选每个词对应到匹配的trg的概率，只对这batch*trg_seq_len个值取log
+        num_classes = class_dist.size(2)
+        class_dist_flat = class_dist.reshape(-1, num_classes)  # [batch_size*trg_seq_len, num_classes]
+        target_flat = target.reshape(-1, 1)  # [batch*trg_seq_len, 1]
+        class_dist = torch.gather(class_dist_flat, dim=1, index=target_flat)  # [batch * trg_seq_len, 1]
+    target_dist = class_dist.reshape(*target.size())  # [batch, trg_seq_len]
+    losses = -target_dist if log_probs else -torch.log(target_dist + EPS)
 
     if loss_scales is not None:
         for loss_scale, scale_index in zip(loss_scales, scale_indices):
-            scale = losses.new_ones(losses.size()).detach()  # [batch, trg_seq_len]
-            scale.masked_fill_(target == scale_index, loss_scale)
-            losses = losses * scale
+            losses = torch.where(target == scale_index, losses * loss_scale, losses)
 
     if trg_mask is not None:
         losses = losses * trg_mask
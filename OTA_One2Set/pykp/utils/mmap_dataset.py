@@ -0,0 +1,352 @@
+"""
+Columnar, memory-mapped storage of the preprocessed examples.
+A split (e.g. `train.one2many.mmap/`) is a directory holding one flat binary file per column and the offsets needed to
+cut it back into examples, so that a single example can be read without deserializing the whole corpus.
+    * token columns (`src`, `src_oov`, `trg`, `trg_copy`) are stored as int32 values
+    * word columns (`src_str`, `trg_str`, `oov_list`) are stored as utf-8 bytes, one more offset level for the words
+    * `oov_dict` is not stored, it is rebuilt from `oov_list` (the i-th oov word has id `vocab_size + i`)
+    * `<column>.offsets<level>` are int64, the i-th nested list of a level spans `[offsets[i], offsets[i + 1])`
+      of the next level (or of `<column>.data` for the last level)
+A split written in several shards (streaming or multiprocess preprocess) is merged into a single split by
+`merge_mmap_shards`: every shard would map its own ~20 files, each mapping holding a file descriptor.
+"""
+
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+__all__ = [
+    'MmapExampleWriter',
+    'ShardedMmapExampleWriter',
+    'MmapExamples',
+    'write_mmap_examples',
+    'merge_mmap_shards',
+    'convert_pt_to_mmap'
+]
+
+META_FILE = 'meta.json'
+
+# column -> (kind, nesting depth of the column in one example)
+COLUMNS = {
+    'one2one': {'src': ('int', 1), 'src_oov': ('int', 1), 'trg': ('int', 1), 'trg_copy': ('int', 1),
+                'src_str': ('str', 1), 'trg_str': ('str', 1), 'oov_list': ('str', 1)},
+    'one2many': {'src': ('int', 1), 'src_oov': ('int', 1), 'trg': ('int', 2), 'trg_copy': ('int', 2),
+                 'src_str': ('str', 1), 'trg_str': ('str', 2), 'oov_list': ('str', 1)},
+}
+
+DTYPES = {'int': np.int32, 'str': np.uint8}
+
+
+def _num_levels(kind, depth):
+    return depth + 1 if kind == 'str' else depth
+
+
+def _memmap(path, dtype):
+    if os.path.getsize(path) == 0:  # np.memmap can not map an empty file
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+
+class _RaggedColumnWriter:
+    def __init__(self, path, name, kind, depth):
+        self.kind = kind
+        self.n_levels = _num_levels(kind, depth)
+        self.data = open(os.path.join(path, name + '.data'), 'wb')
+        self.offsets = [open(os.path.join(path, '%s.offsets%d' % (name, level)), 'wb')
+                        for level in range(self.n_levels)]
+        self.sizes = [0] * self.n_levels
+        for f in self.offsets:
+            f.write(np.int64(0).tobytes())
+
+    def append(self, value, level=0):
+        if level == self.n_levels - 1:
+            if self.kind == 'str':
+                values = np.frombuffer(value.encode('utf-8'), dtype=np.uint8)
+            else:
+                values = np.asarray(value, dtype=np.int32)
+            self.data.write(values.tobytes())
+            self.sizes[level] += len(values)
+        else:
+            for v in value:
+                self.append(v, level + 1)
+            self.sizes[level] += len(value)
+        self.offsets[level].write(np.int64(self.sizes[level]).tobytes())
+
+    def close(self):
+        for f in [self.data] + self.offsets:
+            f.close()
+
+
+class _RaggedColumn:
+    def __init__(self, path, name, kind, depth):
+        self.kind = kind
+        self.data = _memmap(os.path.join(path, name + '.data'), DTYPES[kind])
+        self.offsets = [_memmap(os.path.join(path, '%s.offsets%d' % (name, level)), np.int64)
+                        for level in range(_num_levels(kind, depth))]
+
+    def get(self, index, level=0):
+        start, end = self.offsets[level][index:index + 2]
+        if level < len(self.offsets) - 1:
+            return [self.get(i, level + 1) for i in range(start, end)]
+        if self.kind == 'str':
+            return self.data[start:end].tobytes().decode('utf-8')
+        return self.data[start:end].tolist()
+
+
+class MmapExampleWriter:
+    def __init__(self, path, mode, vocab_size):
+        """
+        :param str path: directory of the split, created if it does not exist
+        :param str mode: one2one or one2many
+        :param int vocab_size: the `vocab_size` used to build the examples, needed to rebuild `oov_dict`
+        """
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = {'mode': mode, 'vocab_size': vocab_size, 'num_examples': 0,
+                     'columns': {name: list(spec) for name, spec in COLUMNS[mode].items()}}
+        self.columns = {name: _RaggedColumnWriter(path, name, kind, depth)
+                        for name, (kind, depth) in COLUMNS[mode].items()}
+
+    def write(self, example):
+        for name, column in self.columns.items():
+            column.append(example[name])
+        self.meta['num_examples'] += 1
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(self.meta, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ShardedMmapExampleWriter:
+    def __init__(self, path, mode, vocab_size, shard_size=100000):
+        """
+        Write a split as consecutive shards of at most `shard_size` examples, only one shard is open at a time.
+        The shards are merged into a single split by `close`.
+        """
+        self.path = path
+        self.mode = mode
+        self.vocab_size = vocab_size
+        self.shard_size = shard_size
+        self.shards = []
+        self.writer = None
+
+    def write(self, example):
+        if self.writer is None or self.writer.meta['num_examples'] == self.shard_size:
+            if self.writer is not None:
+                self.writer.close()
+            self.shards.append('shard_%05d' % len(self.shards))
+            self.writer = MmapExampleWriter(os.path.join(self.path, self.shards[-1]), self.mode, self.vocab_size)
+        self.writer.write(example)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.num_examples = merge_mmap_shards(self.path, self.mode, self.vocab_size, self.shards)
+        return self.num_examples
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def merge_mmap_shards(path, mode, vocab_size, shards):
+    """
+    Merge the shard directories of `path` into a single split in `path` and remove them:
+    the data files are concatenated and the offsets of each shard shifted by the sizes of the shards before it.
+    :param shards: the shard directories in `path` (each one a split written by `MmapExampleWriter`), in order
+    :return: number of examples in all the shards
+    """
+    if not shards:
+        MmapExampleWriter(path, mode, vocab_size).close()
+        return 0
+    shard_paths = [os.path.join(path, shard) for shard in shards]
+    for name, (kind, depth) in COLUMNS[mode].items():
+        # the first shard is moved in place, the others are appended to it
+        data_file = os.path.join(path, name + '.data')
+        os.replace(os.path.join(shard_paths[0], name + '.data'), data_file)
+        with open(data_file, 'ab') as f:
+            for shard_path in shard_paths[1:]:
+                with open(os.path.join(shard_path, name + '.data'), 'rb') as shard_f:
+                    shutil.copyfileobj(shard_f, f)
+        for level in range(_num_levels(kind, depth)):
+            offsets_name = '%s.offsets%d' % (name, level)
+            with open(os.path.join(path, offsets_name), 'wb') as f:
+                size = 0
+                f.write(np.int64(size).tobytes())
+                for shard_path in shard_paths:
+                    offsets = np.fromfile(os.path.join(shard_path, offsets_name), dtype=np.int64)
+                    f.write((offsets[1:] + size).tobytes())
+                    size += int(offsets[-1])
+
+    num_examples = 0
+    for shard_path in shard_paths:
+        with open(os.path.join(shard_path, META_FILE)) as f:
+            num_examples += json.load(f)['num_examples']
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump({'mode': mode, 'vocab_size': vocab_size, 'num_examples': num_examples,
+                   'columns': {name: list(spec) for name, spec in COLUMNS[mode].items()}}, f)
+    for shard_path in shard_paths:
+        shutil.rmtree(shard_path)
+    return num_examples
+
+
+class MmapExamples:
+    """
+    Read-only list of the examples in a split written by `MmapExampleWriter` or `merge_mmap_shards`,
+    same dicts as `io.build_dataset`.
+    The files are mapped lazily, so the object is cheap to pickle to the DataLoader workers.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        self.mode = self.meta['mode']
+        self.vocab_size = self.meta['vocab_size']
+        self.columns = None
+
+    def _open(self):
+        self.columns = {name: _RaggedColumn(self.path, name, kind, depth)
+                        for name, (kind, depth) in self.meta['columns'].items()}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['columns'] = None
+        return state
+
+    def __len__(self):
+        return self.meta['num_examples']
+
+    def lengths(self, name):
+        """
+        :return: the number of items of a column in every example, e.g. the source lengths for `src`, read from the offsets
+        """
+        if self.columns is None:
+            self._open()
+        return np.diff(self.columns[name].offsets[0])
+
+    def iter_column(self, name):
+        """
+        :return: a generator of the values of one column, in the order of the examples, without decoding the others
+        """
+        if self.columns is None:
+            self._open()
+        for index in range(len(self)):
+            yield self.columns[name].get(index)
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError('example index %d out of range' % index)
+        if self.columns is None:
+            self._open()
+        example = {name: column.get(index) for name, column in self.columns.items()}
+        example['oov_dict'] = {w: self.vocab_size + i for i, w in enumerate(example['oov_list'])}
+        example['oov_number'] = len(example['oov_list'])
+        return example
+
+
+def write_mmap_examples(examples, path, mode, vocab_size):
+    """
+    :param examples: iterable of the example dicts built by `io.build_dataset`
+    :return: number of examples written
+    """
+    with MmapExampleWriter(path, mode, vocab_size) as writer:
+        for example in examples:
+            writer.write(example)
+    return writer.meta['num_examples']
+
+
+def convert_pt_to_mmap(pt_path, save_path=None, vocab_size=None):
+    """
+    Convert a split saved by `torch.save` in the old preprocess (e.g. `train.one2many.pt`) to the memory-mapped format.
+    :param str save_path: default to `pt_path` with the `.pt` suffix replaced by `.mmap`
+    :param int vocab_size: inferred from the `oov_dict` of the examples if not given
+    """
+    examples = torch.load(pt_path)
+    if save_path is None:
+        save_path = os.path.splitext(pt_path)[0] + '.mmap'
+    mode = 'one2many' if len(examples) > 0 and isinstance(examples[0]['trg'][0], list) else 'one2one'
+    if vocab_size is None:
+        # the first oov word of an example is numbered `vocab_size`
+        vocab_size = min((min(e['oov_dict'].values()) for e in examples if len(e['oov_dict']) > 0), default=0)
+    write_mmap_examples(examples, save_path, mode, vocab_size)
+    return save_path
+
+
+def _check_merged_shards(n_shards=64, fd_limit=256):
+    """
+    Write `n_shards` shards, more files than `fd_limit` allows to map at once, and read the merged split back
+    with the soft limit of open files lowered to `fd_limit`.
+    """
+    import pickle
+    import random
+    import resource
+    import tempfile
+
+    rng = random.Random(0)
+    words = ['key', 'phrase', 'généré', 'модель', '集合', 'x']
+
+    def random_example():
+        src_str = [rng.choice(words) for _ in range(rng.randint(0, 8))]
+        trg_str = [[rng.choice(words) for _ in range(rng.randint(1, 3))] for _ in range(rng.randint(0, 4))]
+        return {'src': [rng.randint(0, 99) for _ in src_str], 'src_oov': [rng.randint(0, 105) for _ in src_str],
+                'trg': [[rng.randint(0, 99) for _ in kp] for kp in trg_str],
+                'trg_copy': [[rng.randint(0, 105) for _ in kp] for kp in trg_str],
+                'src_str': src_str, 'trg_str': trg_str, 'oov_list': rng.sample(words, rng.randint(0, 3))}
+
+    examples = [random_example() for _ in range(n_shards * 3 - 1)]
+    path = tempfile.mkdtemp()
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        with ShardedMmapExampleWriter(path, 'one2many', 100, shard_size=3) as writer:
+            for example in examples:
+                writer.write(example)
+        assert len(writer.shards) == n_shards and sorted(os.listdir(path)) == sorted(
+            [META_FILE] + ['%s.data' % name for name in COLUMNS['one2many']] +
+            ['%s.offsets%d' % (name, level) for name, (kind, depth) in COLUMNS['one2many'].items()
+             for level in range(_num_levels(kind, depth))])
+        print('%d shards, %d files mapped per shard' % (n_shards, len(os.listdir(path)) - 1))
+
+        resource.setrlimit(resource.RLIMIT_NOFILE, (fd_limit, hard_limit))
+        dataset = MmapExamples(path)
+        assert len(dataset) == len(examples)
+        assert dataset.lengths('src').tolist() == [len(e['src']) for e in examples]
+        assert dataset.lengths('trg').tolist() == [len(e['trg']) for e in examples]
+        assert list(dataset.iter_column('trg_str')) == [e['trg_str'] for e in examples]
+        worker_dataset = pickle.loads(pickle.dumps(dataset))  # as in a DataLoader worker
+        for index in rng.sample(range(len(examples)), len(examples)):
+            example = worker_dataset[index]
+            assert all(example[name] == examples[index][name] for name in COLUMNS['one2many'])
+            assert example['oov_dict'] == {w: 100 + i for i, w in enumerate(examples[index]['oov_list'])}
+        print('merged split read back correctly with at most %d open files' % fd_limit)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft_limit, hard_limit))
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert preprocessed *.pt splits to the memory-mapped format')
+    parser.add_argument('pt_files', nargs='*', help='e.g. data/kp20k_separated/train.one2many.pt')
+    parser.add_argument('-vocab_size', type=int, default=None,
+                        help='vocab_size used by preprocess.py, inferred from the oov words if not given')
+    parser.add_argument('-check_shards', action='store_true',
+                        help='check that many merged shards are read back correctly under a low limit of open files')
+    args = parser.parse_args()
+    if args.check_shards:
+        _check_merged_shards()
+    for pt_file in args.pt_files:
+        print('%s -> %s' % (pt_file, convert_pt_to_mmap(pt_file, vocab_size=args.vocab_size)))
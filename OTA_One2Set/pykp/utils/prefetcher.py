@@ -0,0 +1,57 @@
+import torch
+
+
+class BatchPrefetcher:
+    """
+    Iterate over the batches of a DataLoader (CPU tensors) on `device`.
+    On CUDA the tensors are pinned and copied with non_blocking on a side stream, the copy of batch N + 1 is issued
+    before batch N is returned, so that it overlaps the computation on batch N.
+    """
+
+    def __init__(self, data_loader, device):
+        """
+        :param data_loader: yields tuples of tensors and other objects, e.g. the batches of `KeyphraseDataset`
+        :param device: where the tensors of the batches are copied
+        """
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+        self.copy_event = None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _preload(self, iterator):
+        if self.copy_event is not None:
+            # the pinned padding buffers of KeyphraseDataset are reused by the next batches, the copy reading them
+            # must be done before the next collate writes into them
+            self.copy_event.synchronize()
+        batch = next(iterator, None)
+        if batch is None:
+            return None
+        if not self.use_cuda:
+            return tuple(t.to(self.device) if isinstance(t, torch.Tensor) else t for t in batch)
+        with torch.cuda.stream(self.stream):
+            # pin_memory() returns the tensor itself if it is already pinned
+            batch = tuple(t.pin_memory().to(self.device, non_blocking=True) if isinstance(t, torch.Tensor) else t
+                          for t in batch)
+            self.copy_event = torch.cuda.Event()
+            self.copy_event.record(self.stream)
+        return batch
+
+    def __iter__(self):
+        iterator = iter(self.data_loader)
+        self.copy_event = None
+        next_batch = self._preload(iterator)
+        while next_batch is not None:
+            batch = next_batch
+            if self.use_cuda:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_stream(self.stream)
+                for t in batch:
+                    if isinstance(t, torch.Tensor):
+                        # allocated on the side stream, used on the current one
+                        t.record_stream(current_stream)
+            next_batch = self._preload(iterator)
+            yield batch
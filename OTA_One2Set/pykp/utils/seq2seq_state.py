@@ -115,31 +115,84 @@ class LSTMState(State):
 
 
 class TransformerState(State):
-    def __init__(self, encoder_output, encoder_mask, num_decoder_layer):
+    def __init__(self, encoder_output, encoder_mask, num_decoder_layer, max_decode_length=None, num_slots=1):
         """
         与TransformerSeq2SeqDecoder对应的State，
 
         :param torch.FloatTensor encoder_output: bsz x encode_max_len x encoder_output_size, encoder的输出
         :param torch.ByteTensor encoder_mask: bsz x encode_max_len 为1的地方需要attend
         :param int num_decoder_layer: decode有多少层
+        :param int max_decode_length: 每个序列最多decode多少步，用于预分配decoder的key/value buffer，为None时buffer按需倍增
+        :param int num_slots: 每个sample并行decode多少个序列，fix_kp_num_len时为max_kp_num
         """
         super().__init__(encoder_output, encoder_mask)
+        self.max_decode_length = max_decode_length
+        self.num_slots = num_slots
         self.encoder_key = [None] * num_decoder_layer  # 每一个元素 bsz x encoder_max_len x key_dim
         self.encoder_value = [None] * num_decoder_layer  # 每一个元素 bsz x encoder_max_len x value_dim
-        self.decoder_prev_key = [None] * num_decoder_layer  # 每一个元素 bsz x decode_length x key_dim
-        self.decoder_prev_value = [None] * num_decoder_layer  # 每一个元素 bsz x decode_length x key_dim
+        # 每一个元素 bsz x capacity x num_slots x key_dim 的buffer, 前decoder_cache_length步已写入
+        self.decoder_prev_key = [None] * num_decoder_layer
+        self.decoder_prev_value = [None] * num_decoder_layer
+        self.decoder_cache_length = [0] * num_decoder_layer
+
+    def update_decoder_cache(self, layer_idx, key, value):
+        """
+        将新decode的步的key/value原地写入该层的buffer，buffer在第一步时按max_decode_length步分配，写满时容量倍增。
+
+        :param int layer_idx: 第几层decoder
+        :param torch.FloatTensor key: bsz x (num_slots * new_steps) x key_dim, 同一个slot的各步是连续的
+        :param torch.FloatTensor value: bsz x (num_slots * new_steps) x value_dim
+        :return: 需要attend的所有已decode步的key, value，为buffer已写入部分的view，按步再按slot排列；
+            若是第一次写入且多于一步(例如teacher forcing)，则直接返回传入的key, value，并不经拷贝地缓存
+        """
+        bsz, length, dim = key.size()
+        num_slots = self.num_slots
+        new_steps = length // num_slots
+        filled = self.decoder_cache_length[layer_idx]
+        if filled == 0 and new_steps > 1:
+            self.decoder_prev_key[layer_idx] = key.reshape(bsz, num_slots, new_steps, dim).transpose(1, 2)
+            self.decoder_prev_value[layer_idx] = value.reshape(bsz, num_slots, new_steps, -1).transpose(1, 2)
+            self.decoder_cache_length[layer_idx] = new_steps
+            return key, value
+        assert num_slots == 1 or new_steps == 1, "Only one step at a time can be appended to the cached slots."
+
+        key_cache = self.decoder_prev_key[layer_idx]
+        value_cache = self.decoder_prev_value[layer_idx]
+        capacity = 0 if key_cache is None else key_cache.size(1)
+        if filled + new_steps > capacity:
+            capacity = max(filled + new_steps, 2 * capacity, self.max_decode_length or 0)
+            new_key_cache = key.new_empty(bsz, capacity, num_slots, dim)
+            new_value_cache = value.new_empty(bsz, capacity, num_slots, value.size(-1))
+            if filled > 0:
+                new_key_cache[:, :filled] = key_cache[:, :filled]
+                new_value_cache[:, :filled] = value_cache[:, :filled]
+            key_cache = self.decoder_prev_key[layer_idx] = new_key_cache
+            value_cache = self.decoder_prev_value[layer_idx] = new_value_cache
+
+        # 只有一个slot或只有一步时，按slot排列即按步排列
+        key_cache[:, filled:filled + new_steps] = key.reshape(bsz, new_steps, num_slots, dim)
+        value_cache[:, filled:filled + new_steps] = value.reshape(bsz, new_steps, num_slots, -1)
+        filled += new_steps
+        self.decoder_cache_length[layer_idx] = filled
+        return key_cache[:, :filled].reshape(bsz, filled * num_slots, dim), \
+            value_cache[:, :filled].reshape(bsz, filled * num_slots, -1)
 
     def reorder_state(self, indices: torch.LongTensor):
         super().reorder_state(indices)
         self.encoder_key = self._reorder_state(self.encoder_key, indices)
         self.encoder_value = self._reorder_state(self.encoder_value, indices)
-        self.decoder_prev_key = self._reorder_state(self.decoder_prev_key, indices)
-        self.decoder_prev_value = self._reorder_state(self.decoder_prev_value, indices)
+        for layer_idx, filled in enumerate(self.decoder_cache_length):
+            if filled == 0:
+                continue
+            for cache in (self.decoder_prev_key, self.decoder_prev_value):
+                if cache[layer_idx].size(0) == indices.size(0) and cache[layer_idx].is_contiguous():
+                    # only the filled steps are copied, the buffer is kept
+                    cache[layer_idx][:, :filled] = cache[layer_idx][:, :filled].index_select(0, indices)
+                else:
+                    cache[layer_idx] = cache[layer_idx].index_select(0, indices)
 
     @property
     def decode_length(self):
-        if self.decoder_prev_key[0] is not None:
-            return self.decoder_prev_key[0].size(1)
-        return 0
+        return self.decoder_cache_length[0] * self.num_slots
 
 
@@ -22,6 +22,10 @@ def process_opt(opt):
     if opt.set_loss and (not opt.fix_kp_num_len or not opt.one2many):
         raise ValueError("Set fix_kp_num_len and one2many when using set loss!")
 
+    if opt.sparse_copy_loss and opt.adaptive_lr_scale:
+        raise ValueError("adaptive_lr_scale reads the whole decoder distribution, it can not be used with "
+                         "sparse_copy_loss!")
+
     if not os.path.exists(opt.exp_path):
         os.makedirs(opt.exp_path)
     if not os.path.exists(opt.model_path):
@@ -9,8 +9,11 @@ import torch.nn as nn
 
 import pykp.utils.io as io
 from inference.evaluate import evaluate_loss
-from pykp.utils.label_assign import hungarian_assign, optimal_transport_assign
+from pykp.utils.assign_solver import get_hungarian_solver
+from pykp.utils.label_assign import hungarian_assign_async, optimal_transport_assign, \
+    optimal_transport_assign_set
 from pykp.utils.masked_loss import masked_cross_entropy
+from pykp.utils.prefetcher import BatchPrefetcher
 from utils.functions import time_since
 from utils.report import export_train_and_valid_loss
 from utils.statistics import LossStatistics, learning_info
@@ -44,8 +47,10 @@ def train_model(model, optimizer, train_data_loader, valid_data_loader, opt):
         if early_stop_flag:
             break
 
-        logging.info(f"len of train_data_loader: {len(train_data_loader)}")
-        for batch_i, batch in enumerate(train_data_loader):
+        # with bucketing by max_tokens the number of batches changes every epoch, it is read once before the epoch
+        num_train_batches = len(train_data_loader)
+        logging.info(f"len of train_data_loader: {num_train_batches}")
+        for batch_i, batch in enumerate(BatchPrefetcher(train_data_loader, opt.device)):
             total_batch += 1
 
             batch_loss_stat = train_one_batch(batch, model, optimizer, opt)
@@ -78,7 +83,7 @@ def train_model(model, optimizer, train_data_loader, valid_data_loader, opt):
                             "control code null assignment ratio: %.3f" % report_train_loss_statistics.cc_null_assignment_ratio())
                      
             if not opt.stats_only and epoch >= opt.start_checkpoint_at:
-                if (opt.checkpoint_interval == -1 and batch_i == len(train_data_loader) - 1) or \
+                if (opt.checkpoint_interval == -1 and batch_i == num_train_batches - 1) or \
                         (opt.checkpoint_interval > -1 and total_batch > 1 and
                          total_batch % opt.checkpoint_interval == 0):
                     valid_loss_stat = evaluate_loss(valid_data_loader, model, opt)
@@ -177,11 +182,22 @@ def train_one_batch(batch, model, optimizer, opt):
     start_time = time.time()
     if opt.fix_kp_num_len:
         y_t_init = target.new_ones(batch_size, opt.max_kp_num, 1) * word2idx[io.BOS_WORD]
+        share_memory = opt.set_loss and opt.share_assign_memory
+        if share_memory:
+            # the batch is encoded once for the training forward, the assignment uses the detached encoder output
+            # and encoder attention keys/values
+            memory_bank = model.encoder(src, src_lens, src_mask)
+            memory = model.decoder.prepare_memory(memory_bank)
         if opt.set_loss:  # K-step target assignment
             model.eval()
             with torch.no_grad():
-                memory_bank = model.encoder(src, src_lens, src_mask)
-                state = model.decoder.init_state(memory_bank, src_mask)
+                if share_memory:
+                    state = model.decoder.init_state(memory_bank.detach(), src_mask,
+                                                     max_decode_length=opt.assign_steps,
+                                                     memory=[[m.detach() for m in kv] for kv in memory])
+                else:
+                    memory_bank = model.encoder(src, src_lens, src_mask)
+                    state = model.decoder.init_state(memory_bank, src_mask, max_decode_length=opt.assign_steps)
                 control_embed = model.decoder.forward_seg(state)
 
                 input_tokens = src.new_zeros(batch_size, opt.max_kp_num, opt.assign_steps + 1)
@@ -203,111 +219,42 @@ def train_one_batch(batch, model, optimizer, opt):
                     
                     if opt.use_optimal_transport:
                         
-                        background = torch.tensor(
+                        background = target.new_tensor(
                             [word2idx[io.NULL_WORD]] + [word2idx[io.PAD_WORD]] * (opt.max_kp_len - 1)
-                        ).to(opt.device)
-                        bg_mask = torch.tensor([1] + [0] * (opt.max_kp_len - 1)).to(opt.device)
-                        pre_targets, pre_trg_masks, ab_targets, ab_trg_masks = [], [], [], []  # 一个batch里面每组数据对应的target数量是不一样的，用tensor无法对齐，所以用list
-                        pre_has_null, ab_has_null = [False] * batch_size, [False] * batch_size
-                        for b in range(batch_size):
-                            pre_target, pre_trg_mask, ab_target, ab_trg_mask = [], [], [], []
-
-                            for t in range(mid_idx):
-                                if any(target[b, t] != background): # 去掉null kp，只保留真实的target kp
-                                    pre_target.append(list(target[b, t]))
-                                    pre_trg_mask.append(list(trg_mask[b, t]))
-                            
-                            if len(pre_target) != opt.max_kp_num // 2:
-                                pre_has_null[b] = True
-                                pre_target.append(list(background))  # 补上一个null kp作为学习的目标
-                                pre_trg_mask.append(list(bg_mask))
-
-                            pre_targets.append(torch.tensor(pre_target).to(opt.device))
-                            pre_trg_masks.append(torch.tensor(pre_trg_mask).to(opt.device))
-
-                            for t in range(mid_idx, opt.max_kp_num):
-                                if any(target[b, t] != background):
-                                    ab_target.append(list(target[b, t]))
-                                    ab_trg_mask.append(list(trg_mask[b, t]))
-                            
-                            if len(ab_target) != opt.max_kp_num // 2:
-                                ab_has_null[b] = True
-                                ab_target.append(list(background))  # 补上一个null kp作为学习的目标
-                                ab_trg_mask.append(list(bg_mask))
-
-                            ab_targets.append(torch.tensor(ab_target).to(opt.device))
-                            ab_trg_masks.append(torch.tensor(ab_trg_mask).to(opt.device))
+                        )
+                        bg_mask = trg_mask.new_tensor([1] + [0] * (opt.max_kp_len - 1))
 
                         # present trg assignment
-                        _, pre_reorder_cols, pre_supply_gt_demand_cnt = optimal_transport_assign(
-                            opt, 
-                            decoder_dists[:, :mid_idx], 
-                            pre_targets, 
-                            has_null=pre_has_null
-                        )
-                    
-                        # absent trg assignment
-                        _, ab_reorder_cols, ab_supply_gt_demand_cnt = optimal_transport_assign(
-                            opt, 
-                            decoder_dists[:, mid_idx:],
-                            ab_targets, 
-                            has_null=ab_has_null
-                        )
-                        
-                        # 统计 control code 与 target 的匹配情况
-                        pre_assignment_info = learning_info(
-                            [pre_targets[i].shape[0] for i in range(batch_size)],
-                            pre_reorder_cols, 
-                            pre_has_null
-                        )
-                        ab_assignment_info = learning_info(
-                            [ab_targets[i].shape[0] for i in range(batch_size)], 
-                            ab_reorder_cols, 
-                            ab_has_null
-                        )
+                        target[:, :mid_idx], trg_mask[:, :mid_idx], pre_supply_gt_demand_cnt, pre_assign = \
+                            optimal_transport_assign_set(opt, decoder_dists[:, :mid_idx],
+                                                         target[:, :mid_idx], trg_mask[:, :mid_idx],
+                                                         background, bg_mask)
 
-                        new_pre_targets, new_pre_trg_masks, new_ab_targets, new_ab_trg_masks = [], [], [], []
-                        for b in range(batch_size):
-                            new_pre_targets.append(pre_targets[b][pre_reorder_cols[b]])
-                            new_pre_trg_masks.append(pre_trg_masks[b][pre_reorder_cols[b]])
-                            new_ab_targets.append(ab_targets[b][ab_reorder_cols[b]])
-                            new_ab_trg_masks.append(ab_trg_masks[b][ab_reorder_cols[b]])
+                        # absent trg assignment
+                        target[:, mid_idx:], trg_mask[:, mid_idx:], ab_supply_gt_demand_cnt, ab_assign = \
+                            optimal_transport_assign_set(opt, decoder_dists[:, mid_idx:],
+                                                         target[:, mid_idx:], trg_mask[:, mid_idx:],
+                                                         background, bg_mask)
 
-                        target[:, :mid_idx] = torch.stack(new_pre_targets, axis=0)
-                        trg_mask[:, :mid_idx] = torch.stack(new_pre_trg_masks, axis=0)
-                        target[:, mid_idx:] = torch.stack(new_ab_targets, axis=0)
-                        trg_mask[:, mid_idx:] = torch.stack(new_ab_trg_masks, axis=0)
+                        # 统计 control code 与 target 的匹配情况
+                        pre_assignment_info = learning_info(*pre_assign)
+                        ab_assignment_info = learning_info(*ab_assign)
 
                         
                     else:
-                        pre_reorder_index = hungarian_assign(decoder_dists[:, :mid_idx],
-                                                            target[:, :mid_idx, :opt.assign_steps],
-                                                            ignore_indices=[word2idx[io.NULL_WORD],
-                                                                            word2idx[io.PAD_WORD]])
-                        target[:, :mid_idx] = target[:, :mid_idx][pre_reorder_index]
-                        trg_mask[:, :mid_idx] = trg_mask[:, :mid_idx][pre_reorder_index]
-
-                        ab_reorder_index = hungarian_assign(decoder_dists[:, mid_idx:],
-                                                            target[:, mid_idx:, :opt.assign_steps],
-                                                            ignore_indices=[word2idx[io.NULL_WORD],
-                                                                            word2idx[io.PAD_WORD]])
-                        target[:, mid_idx:] = target[:, mid_idx:][ab_reorder_index]
-                        trg_mask[:, mid_idx:] = trg_mask[:, mid_idx:][ab_reorder_index]
-
-                        # 统计 control code 与 target 的匹配情况
-                        null_kp = decoder_dists.new_tensor(
-                            [word2idx[io.NULL_WORD]] + [word2idx[io.PAD_WORD]] * (opt.max_kp_len - 1)
-                        )
-                        n_cc_null = (target == null_kp).all(-1)
-
-                        EPS = 1e-8
-                        pre_assignment_info = (EPS, EPS, EPS, EPS, n_cc_null.sum().item(), target.size(0) * target.size(1))
-                        ab_assignment_info = (EPS, EPS, EPS, EPS, EPS, EPS)
-                        pre_supply_gt_demand_cnt, ab_supply_gt_demand_cnt = torch.tensor([0]), torch.tensor([0])
-
-                        # n_cc = target.size(0) * target.size(1)
-                        # print(f'{n_cc_null.shape = }\n{n_cc = }\n{n_cc_null = }')
-                        # print(f'cc_null_ratio = {pre_assignment_info[-2] / pre_assignment_info[-1]}')
+                        # the assignments are collected after the encoder forward below, so that they can be
+                        # solved by the worker processes of `solver` in the meantime
+                        solver = get_hungarian_solver(opt)
+                        wait_pre_reorder_index = hungarian_assign_async(decoder_dists[:, :mid_idx],
+                                                                        target[:, :mid_idx, :opt.assign_steps],
+                                                                        ignore_indices=[word2idx[io.NULL_WORD],
+                                                                                        word2idx[io.PAD_WORD]],
+                                                                        solver=solver)
+                        wait_ab_reorder_index = hungarian_assign_async(decoder_dists[:, mid_idx:],
+                                                                       target[:, mid_idx:, :opt.assign_steps],
+                                                                       ignore_indices=[word2idx[io.NULL_WORD],
+                                                                                       word2idx[io.PAD_WORD]],
+                                                                       solver=solver)
 
                 else:
                     if opt.use_optimal_transport:
@@ -317,30 +264,57 @@ def train_one_batch(batch, model, optimizer, opt):
                         target = target[reorder_index]
                         trg_mask = trg_mask[reorder_index]
                     else:
-                        reorder_index = hungarian_assign(decoder_dists, target[:, :, :opt.assign_steps],
-                                                         [word2idx[io.NULL_WORD],
-                                                          word2idx[io.PAD_WORD]])
-                        target = target[reorder_index]
-                        trg_mask = trg_mask[reorder_index]
+                        # collected after the encoder forward below, as in the seperate_pre_ab branch
+                        wait_reorder_index = hungarian_assign_async(decoder_dists, target[:, :, :opt.assign_steps],
+                                                                    [word2idx[io.NULL_WORD],
+                                                                     word2idx[io.PAD_WORD]],
+                                                                    solver=get_hungarian_solver(opt))
                 
             if opt.stats_only:
                 model.eval()
             else:
                 model.train()
 
-        memory_bank = model.encoder(src, src_lens, src_mask)
-        state = model.decoder.init_state(memory_bank, src_mask)
+        if not share_memory:
+            memory_bank = model.encoder(src, src_lens, src_mask)
+            memory = None
+        state = model.decoder.init_state(memory_bank, src_mask, memory=memory)
         control_embed = model.decoder.forward_seg(state)
 
+        if opt.set_loss and opt.seperate_pre_ab and not opt.use_optimal_transport:
+            pre_reorder_index = wait_pre_reorder_index()
+            target[:, :mid_idx] = target[:, :mid_idx][pre_reorder_index]
+            trg_mask[:, :mid_idx] = trg_mask[:, :mid_idx][pre_reorder_index]
+
+            ab_reorder_index = wait_ab_reorder_index()
+            target[:, mid_idx:] = target[:, mid_idx:][ab_reorder_index]
+            trg_mask[:, mid_idx:] = trg_mask[:, mid_idx:][ab_reorder_index]
+
+            # 统计 control code 与 target 的匹配情况
+            null_kp = target.new_tensor(
+                [word2idx[io.NULL_WORD]] + [word2idx[io.PAD_WORD]] * (opt.max_kp_len - 1)
+            )
+            n_cc_null = (target == null_kp).all(-1)
+
+            pre_assignment_info = (EPS, EPS, EPS, EPS, n_cc_null.sum().item(), target.size(0) * target.size(1))
+            ab_assignment_info = (EPS, EPS, EPS, EPS, EPS, EPS)
+            pre_supply_gt_demand_cnt, ab_supply_gt_demand_cnt = torch.tensor([0]), torch.tensor([0])
+        elif opt.set_loss and not opt.use_optimal_transport:
+            reorder_index = wait_reorder_index()
+            target = target[reorder_index]
+            trg_mask = trg_mask[reorder_index]
+
         input_tgt = torch.cat([y_t_init, target[:, :, :-1]], dim=-1)
         input_tgt = input_tgt.masked_fill(input_tgt.gt(opt.vocab_size - 1), word2idx[io.UNK_WORD])
-        decoder_dist, attention_dist = model.decoder(input_tgt, state, src_oov, max_num_oov, control_embed)
+        decoder_dist, attention_dist = model.decoder(input_tgt, state, src_oov, max_num_oov, control_embed,
+                                                     target=target if opt.sparse_copy_loss else None)
     else:
         y_t_init = trg.new_ones(batch_size, 1) * word2idx[io.BOS_WORD]  # [batch_size, 1]
         input_tgt = torch.cat([y_t_init, trg[:, :-1]], dim=-1)
         memory_bank = model.encoder(src, src_lens, src_mask)
         state = model.decoder.init_state(memory_bank, src_mask)
-        decoder_dist, attention_dist = model.decoder(input_tgt, state, src_oov, max_num_oov)
+        decoder_dist, attention_dist = model.decoder(input_tgt, state, src_oov, max_num_oov,
+                                                     target=target if opt.sparse_copy_loss else None)
 
     if opt.adaptive_lr_scale:
         # select the correctly predicted slots
@@ -437,7 +411,8 @@ def train_one_batch(batch, model, optimizer, opt):
                 target[:, :mid_idx].reshape(batch_size, -1),
                 trg_mask[:, :mid_idx].reshape(batch_size, -1),
                 loss_scales=[opt.loss_scale_pre],
-                scale_indices=[word2idx[io.NULL_WORD]]
+                scale_indices=[word2idx[io.NULL_WORD]],
+                gathered=opt.sparse_copy_loss, log_probs=opt.sparse_copy_loss
             )
             
             ab_loss = masked_cross_entropy(
@@ -446,7 +421,8 @@ def train_one_batch(batch, model, optimizer, opt):
                 target[:, mid_idx:].reshape(batch_size, -1),
                 trg_mask[:, mid_idx:].reshape(batch_size, -1),
                 loss_scales=[opt.loss_scale_ab],
-                scale_indices=[word2idx[io.NULL_WORD]]
+                scale_indices=[word2idx[io.NULL_WORD]],
+                gathered=opt.sparse_copy_loss, log_probs=opt.sparse_copy_loss
             )
             
             if opt.adaptive_lr_scale:
@@ -464,9 +440,11 @@ def train_one_batch(batch, model, optimizer, opt):
 
         else:
             loss = masked_cross_entropy(decoder_dist, target.reshape(batch_size, -1), trg_mask.reshape(batch_size, -1),
-                                        loss_scales=[opt.loss_scale], scale_indices=[word2idx[io.NULL_WORD]])
+                                        loss_scales=[opt.loss_scale], scale_indices=[word2idx[io.NULL_WORD]],
+                                        gathered=opt.sparse_copy_loss, log_probs=opt.sparse_copy_loss)
     else:
-        loss = masked_cross_entropy(decoder_dist, target, trg_mask)
+        loss = masked_cross_entropy(decoder_dist, target, trg_mask, gathered=opt.sparse_copy_loss,
+                                    log_probs=opt.sparse_copy_loss)
     loss_compute_time = time_since(start_time)
 
     total_trg_tokens = trg_mask.sum().item()
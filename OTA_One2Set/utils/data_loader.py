@@ -1,9 +1,12 @@
 import logging
+import os
 
 import torch
 from torch.utils.data import DataLoader
 
+from pykp.utils.bucket_sampler import BucketBatchSampler
 from pykp.utils.io import KeyphraseDataset
+from pykp.utils.mmap_dataset import MmapExamples
 
 
 def load_vocab(opt):
@@ -18,6 +21,16 @@ def load_vocab(opt):
     return vocab
 
 
+def load_examples(data_path):
+    """
+    :param data_path: a preprocessed split without suffix, e.g. `data/train.one2many`
+    :return: the memory-mapped examples of `data_path.mmap` if it exists, otherwise the examples in `data_path.pt`
+    """
+    if os.path.isdir(data_path + '.mmap'):
+        return MmapExamples(data_path + '.mmap')
+    return torch.load(data_path + '.pt', 'wb')
+
+
 def build_data_loader(data, opt, shuffle=True, load_train=True):
     keyphrase_dataset = KeyphraseDataset.build(examples=data, opt=opt, load_train=load_train)
     if not opt.one2many:
@@ -27,8 +40,16 @@ def build_data_loader(data, opt, shuffle=True, load_train=True):
     else:
         collect_fn = keyphrase_dataset.collate_fn_one2seq
 
-    data_loader = DataLoader(dataset=keyphrase_dataset, collate_fn=collect_fn, num_workers=opt.batch_workers,
-                             batch_size=opt.batch_size, shuffle=shuffle)
+    # with batch_workers the batches are pinned by the DataLoader, otherwise collate pads them into pinned buffers
+    pin_memory = keyphrase_dataset.pin_memory and opt.batch_workers > 0
+    if load_train and opt.bucket_batches:
+        batch_sampler = BucketBatchSampler(keyphrase_dataset.src_lengths(), opt.batch_size,
+                                           max_tokens=opt.max_tokens, shuffle=shuffle, bucket_size=opt.bucket_size)
+        data_loader = DataLoader(dataset=keyphrase_dataset, collate_fn=collect_fn, num_workers=opt.batch_workers,
+                                 batch_sampler=batch_sampler, pin_memory=pin_memory)
+    else:
+        data_loader = DataLoader(dataset=keyphrase_dataset, collate_fn=collect_fn, num_workers=opt.batch_workers,
+                                 batch_size=opt.batch_size, shuffle=shuffle, pin_memory=pin_memory)
     return data_loader
 
 
@@ -38,23 +59,23 @@ def load_data_and_vocab(opt, load_train=True):
     # constructor data loader
     logging.info("Loading train and validate data from '%s'" % opt.data)
     if opt.one2many:
-        data_path = opt.data + '/%s.one2many.pt'
+        data_path = opt.data + '/%s.one2many'
     else:
-        data_path = opt.data + '/%s.one2one.pt'
+        data_path = opt.data + '/%s.one2one'
 
     if load_train:
         # load training dataset
-        train_data = torch.load(data_path % "train", 'wb')
+        train_data = load_examples(data_path % "train")
         train_loader = build_data_loader(data=train_data, opt=opt, shuffle=True, load_train=True)
         logging.info('#(train data size: #(batch)=%d' % (len(train_loader)))
 
         # load validation dataset
-        valid_data = torch.load(data_path % "valid", 'wb')
+        valid_data = load_examples(data_path % "valid")
         valid_loader = build_data_loader(data=valid_data,  opt=opt, shuffle=False, load_train=True)
         logging.info('#(valid data size: #(batch)=%d' % (len(valid_loader)))
         return train_loader, valid_loader, vocab
     else:
-        test_data = torch.load(data_path % "test", 'wb')
+        test_data = load_examples(data_path % "test")
         test_loader = build_data_loader(data=test_data, opt=opt, shuffle=False, load_train=False)
         logging.info('#(test data size: #(batch)=%d' % (len(test_loader)))
         return test_loader, vocab
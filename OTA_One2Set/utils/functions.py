@@ -1,5 +1,7 @@
 import time
 import random
+import locale
+import os
 import numpy as np
 import logging
 
@@ -70,10 +72,21 @@ def read_tokenized_trg_file(path):
 
 
 def read_src_and_trg_files(src_file, trg_file, is_train, remove_title_eos=True):
-    tokenized_train_src = []
-    tokenized_train_trg = []
+    tokenized_train_pairs = list(iter_src_and_trg_files(src_file, trg_file, is_train, remove_title_eos))
+    return tokenized_train_pairs
+
+
+def iter_src_and_trg_files(src_file, trg_file, is_train, remove_title_eos=True):
+    """
+    Streaming version of read_src_and_trg_files, the files are read line by line
+    :return: a generator of (src_word_list, [trg_1_word_list, trg_2_word_list, ...])
+    """
+    return iter_src_and_trg_lines(open(src_file, 'r'), open(trg_file, 'r'), is_train, remove_title_eos)
+
+
+def iter_src_and_trg_lines(src_lines, trg_lines, is_train, remove_title_eos=True):
     filtered_cnt = 0
-    for line_idx, (src_line, trg_line) in enumerate(zip(open(src_file, 'r'), open(trg_file, 'r'))):
+    for line_idx, (src_line, trg_line) in enumerate(zip(src_lines, trg_lines)):
         # process source line
         if (len(src_line.strip()) == 0) and is_train:
             continue
@@ -99,15 +112,83 @@ def read_src_and_trg_files(src_file, trg_file, is_train, remove_title_eos=True):
             if len(src_word_list) > 400 or len(trg_word_list) > 14:
                 filtered_cnt += 1
                 continue
-        # Append the lines to the data
-        tokenized_train_src.append(src_word_list)
-        tokenized_train_trg.append(trg_word_list)
-
-    assert len(tokenized_train_src) == len(
-        tokenized_train_trg), 'the number of records in source and target are not the same'
+        yield src_word_list, trg_word_list
 
     logging.info("%d rows filtered" % filtered_cnt)
 
-    tokenized_train_pairs = list(zip(tokenized_train_src, tokenized_train_trg))
-    return tokenized_train_pairs
 
+def line_aligned_byte_ranges(path, n_ranges):
+    """
+    Split a file into at most n_ranges contiguous [start, end) byte ranges of similar size, each starting at a line
+    """
+    size = os.path.getsize(path)
+    starts = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, n_ranges):
+            if size * i // n_ranges == 0:
+                continue
+            f.seek(size * i // n_ranges - 1)
+            f.readline()  # move to the beginning of the next line
+            if starts[-1] < f.tell() < size:
+                starts.append(f.tell())
+    return list(zip(starts, starts[1:] + [size]))
+
+
+def count_lines_in_range(path, start, end, chunk_size=1 << 24):
+    """
+    :return: number of lines beginning in the line aligned byte range [start, end) of the file
+    """
+    n_lines = 0
+    last_byte = b'\n'
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while start < end:
+            chunk = f.read(min(chunk_size, end - start))
+            if not chunk:
+                break
+            n_lines += chunk.count(b'\n')
+            last_byte = chunk[-1:]
+            start += len(chunk)
+    if last_byte != b'\n':  # the last line of the file is not ended by a newline
+        n_lines += 1
+    return n_lines
+
+
+def find_line_offsets(path, line_indices, chunk_size=1 << 24):
+    """
+    :param line_indices: sorted line numbers, starting from 0
+    :return: the byte offset of the beginning of each line, the file size for the lines after the end of the file
+    """
+    pending = list(line_indices)
+    offsets = []
+    while pending and pending[0] == 0:
+        offsets.append(pending.pop(0))
+    n_newlines, pos = 0, 0
+    with open(path, 'rb') as f:
+        while pending:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            chunk_newlines = chunk.count(b'\n')
+            if pending[0] <= n_newlines + chunk_newlines:
+                newline_pos = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord('\n'))
+                # the i-th line begins right after the i-th newline
+                while pending and pending[0] <= n_newlines + chunk_newlines:
+                    offsets.append(pos + int(newline_pos[pending.pop(0) - n_newlines - 1]) + 1)
+            n_newlines += chunk_newlines
+            pos += len(chunk)
+    return offsets + [os.path.getsize(path)] * len(pending)
+
+
+def iter_lines_in_range(path, start, end):
+    """
+    Yield the decoded lines beginning in the byte range [start, end) of a file, with the same encoding as open(path, 'r')
+    """
+    encoding = locale.getpreferredencoding(False)
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            yield line.decode(encoding)
@@ -1,8 +1,89 @@
+import itertools
+import os
+import pickle
+
+import nltk
 from nltk.stem.porter import *
 
 stemmer = PorterStemmer()
 
 
+class StemCache(object):
+    """
+    Memo of the stems of the lowercased tokens, shared by the whole process.
+    When it holds max_size stems, the oldest half is dropped.
+    """
+
+    def __init__(self, max_size=1000000):
+        self.max_size = max_size
+        self.stems = {}
+        self.hits = 0
+        self.misses = 0
+
+    def stem(self, word):
+        """
+        :param word: a token, already stripped and lowercased
+        """
+        stem = self.stems.get(word)
+        if stem is not None:
+            self.hits += 1
+            return stem
+        self.misses += 1
+        if len(self.stems) >= self.max_size:
+            self.stems = dict(itertools.islice(self.stems.items(), len(self.stems) // 2, None))
+        stem = self.stems[word] = stemmer.stem(word)
+        return stem
+
+    def hit_rate(self):
+        return self.hits / max(1, self.hits + self.misses)
+
+    def newest(self, n):
+        """
+        :return: dict of the n stems added last
+        """
+        n = min(n, len(self.stems))
+        return dict(reversed(list(itertools.islice(reversed(self.stems.items()), n))))
+
+    def update(self, stems, hits=0, misses=0):
+        """
+        Add the stems and the counters of another cache, e.g. the one of a worker process.
+        """
+        for word, stem in stems.items():
+            if word not in self.stems:
+                if len(self.stems) >= self.max_size:
+                    self.stems = dict(itertools.islice(self.stems.items(), len(self.stems) // 2, None))
+                self.stems[word] = stem
+        self.hits += hits
+        self.misses += misses
+
+    def _signature(self):
+        # the stems are only reused with the same stemmer
+        return {'nltk_version': nltk.__version__, 'mode': stemmer.mode}
+
+    def load(self, path):
+        """
+        Add the stems saved by `save` to the cache, unless the file is missing or was written with another stemmer.
+        :return: number of stems loaded
+        """
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'rb') as f:
+            saved = pickle.load(f)
+        if saved['signature'] != self._signature():
+            return 0
+        stems = dict(itertools.islice(saved['stems'].items(), max(0, len(saved['stems']) - self.max_size), None))
+        stems.update(self.stems)
+        self.stems = stems
+        return len(stems)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({'signature': self._signature(), 'stems': self.stems}, f)
+
+
+stem_cache = StemCache()
+
+
 def stem_str_2d_list(str_2dlist):
     # stem every word in a list of word list
     # str_list is a list of word list
@@ -24,7 +105,49 @@ def stem_str_list(str_list):
 
 
 def stem_word_list(word_list):
-    return [stemmer.stem(w.strip().lower()) for w in word_list]
+    return [stem_cache.stem(w.strip().lower()) for w in word_list]
+
+
+class SourceNgramIndex(object):
+    """
+    Index of the n-grams of a (stemmed) source word list, checking if a keyphrase appears in the source is a single
+    set lookup instead of a scan of the source.
+    The n-grams of a length are only indexed the first time a keyphrase of this length is looked up.
+    """
+
+    def __init__(self, src_word_list):
+        self.src_word_list = src_word_list
+        self.ngrams = {}  # n -> set of the n-grams of the source, as tuples of words
+        self.joined_src = None
+
+    def _ngrams(self, n):
+        if n not in self.ngrams:
+            words = self.src_word_list
+            self.ngrams[n] = set(zip(*[words[i:] for i in range(n)]))
+        return self.ngrams[n]
+
+    def contains(self, keyphrase_word_list, match_by_str=False):
+        """
+        :param keyphrase_word_list: a (stemmed) keyphrase as a word list, never present if it is an empty string
+        :param match_by_str: match the joined keyphrase as a substring of the joined source instead of a word n-gram
+        """
+        joined_keyphrase_str = ' '.join(keyphrase_word_list)
+        if joined_keyphrase_str.strip() == "":
+            return False
+        if match_by_str:
+            if self.joined_src is None:
+                self.joined_src = ' '.join(self.src_word_list)
+            return joined_keyphrase_str in self.joined_src
+        return tuple(keyphrase_word_list) in self._ngrams(len(keyphrase_word_list))
+
+
+def build_source_index(src_word_list):
+    """
+    :param src_word_list: a word list, or an already built SourceNgramIndex which is returned as is
+    """
+    if isinstance(src_word_list, SourceNgramIndex):
+        return src_word_list
+    return SourceNgramIndex(src_word_list)
 
 
 def prediction_to_sentence(prediction, idx2word, vocab_size, oov, eos_idx, unk_idx=None, replace_unk=False,